@@ -0,0 +1,95 @@
+"""
+Compares the time needed to merge the chunks of a webcam recording by copying them through Python
+in 64 KiB reads and writes (previous approach) and by copying them inside the kernel (current approach).
+
+Usage: docker-compose exec web python benchmarks/chunk_merge.py [--chunks 500] [--chunk-size 1024]
+"""
+import argparse
+import filecmp
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ipl.settings')
+django.setup()
+
+from experiments.chunks import copy_file
+
+
+def merge_loop(target, chunks):
+    """
+    Merges chunks into a file by reading and writing 64 KiB at a time.
+    """
+    with open(target, 'wb') as outfile:
+        for chunk in chunks:
+            with open(chunk, 'rb') as infile:
+                while True:
+                    data = infile.read(65536)
+                    if not data:
+                        break
+                    outfile.write(data)
+
+
+def merge_copy_file(target, chunks):
+    """
+    Merges chunks into a file with copy_file, as done when chunks are appended to a recording.
+    """
+    with open(target, 'wb', buffering=0) as outfile:
+        for chunk in chunks:
+            with open(chunk, 'rb', buffering=0) as infile:
+                copy_file(infile, outfile)
+
+
+def create_chunks(folder, num_chunks, chunk_size):
+    """
+    Returns the paths of `num_chunks` chunks of `chunk_size` random bytes each.
+    """
+    chunks = []
+    for number in range(num_chunks):
+        path = os.path.join(folder, 'recording-%05d.webm' % number)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(chunk_size))
+        chunks.append(path)
+    return chunks
+
+
+def measure(function, target, chunks):
+    """
+    Returns the wall clock time, the user CPU time and the system CPU time in seconds of merging the chunks.
+    """
+    start = time.perf_counter()
+    start_times = os.times()
+    function(target, chunks)
+    os.sync()
+    times = os.times()
+    return time.perf_counter() - start, times.user - start_times.user, times.system - start_times.system
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--chunks', type=int, default=500, help='Number of chunks, e.g. one per second of recording.')
+    parser.add_argument('--chunk-size', type=int, default=1024, help='Size of a chunk in KiB.')
+    parser.add_argument('--dir', default=None, help='Folder to write the chunks to, e.g. on the webcam volume.')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(dir=args.dir)
+    try:
+        chunks = create_chunks(folder, args.chunks, args.chunk_size * 1024)
+        os.sync()
+        print('%s chunks of %s KiB (%.0f MiB)' % (args.chunks, args.chunk_size, args.chunks * args.chunk_size / 1024))
+        targets = []
+        for name, function in [('64 KiB loop', merge_loop), ('copy_file', merge_copy_file)]:
+            target = os.path.join(folder, name.replace(' ', '_') + '.webm')
+            duration, user, system = measure(function, target, chunks)
+            targets.append(target)
+            print('%-12s %8.3f s %8.3f s user %8.3f s system' % (name, duration, user, system))
+
+        assert filecmp.cmp(*targets, shallow=False)
+        print('Both approaches produce the same recording.')
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
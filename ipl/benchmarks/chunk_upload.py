@@ -0,0 +1,100 @@
+"""
+Compares the throughput of uploading webcam chunks as multipart forms (previous approach)
+and as raw request bodies (current approach), with several participants uploading at the same time.
+
+Usage: docker-compose exec web python benchmarks/chunk_upload.py [--participants 8] [--chunks 30] [--chunk-size 512]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ipl.settings')
+django.setup()
+
+from django.contrib.auth.models import User
+from django.test import Client, override_settings
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+from django.core.files.uploadedfile import SimpleUploadedFile
+
+from experiments.models import Experiment, SubjectData
+
+
+def multipart_requests(subject, recording, chunks):
+    """
+    Returns the encoded multipart requests uploading the chunks of a recording.
+    """
+    requests = []
+    for number, data in enumerate(chunks):
+        name = '%s-%05d.webm' % (recording, number)
+        body = encode_multipart(BOUNDARY, {'file': SimpleUploadedFile(name, data), 'type': 'video/webm'})
+        requests.append(('POST', '/%s/run/upload' % subject, body, MULTIPART_CONTENT))
+    return requests
+
+
+def raw_requests(subject, recording, chunks):
+    """
+    Returns the requests uploading the chunks of a recording as raw bodies.
+    """
+    return [('PUT', '/%s/run/upload/%s-%05d.webm' % (subject, recording, number), data, 'application/octet-stream')
+            for number, data in enumerate(chunks)]
+
+
+def upload(requests):
+    """
+    Sends the requests of a participant one after the other.
+    """
+    client = Client()
+    for method, url, body, content_type in requests:
+        response = client.generic(method, url, body, content_type=content_type)
+        assert response.status_code == 204, response.status_code
+
+
+def measure(create_requests, experiment, participants, num_chunks, chunk_size):
+    """
+    Returns the time in seconds of the server handling the uploads of all participants.
+    """
+    chunks = [os.urandom(chunk_size) for _ in range(num_chunks)]
+    uploads = []
+    for number in range(1, participants + 1):
+        subject = SubjectData.objects.create(id=str(uuid.uuid4()), participant_id=number, experiment=experiment)
+        uploads.append(create_requests(subject.pk, '%d_trial1_label_%s' % (number, subject.pk), chunks))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(participants) as executor:
+        list(executor.map(upload, uploads))
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--participants', type=int, default=8, help='Number of participants uploading at the same time.')
+    parser.add_argument('--chunks', type=int, default=30, help='Number of chunks uploaded per participant.')
+    parser.add_argument('--chunk-size', type=int, default=512, help='Size of a chunk in KiB.')
+    args = parser.parse_args()
+
+    total = args.participants * args.chunks * args.chunk_size / 1024
+    print('%s participants uploading %s chunks of %s KiB (%.0f MiB)' % (args.participants, args.chunks,
+                                                                      args.chunk_size, total))
+    # Chunks are only accepted for existing participants, who are deleted with their experiment afterwards
+    user = User.objects.create_user(username='chunk-upload-benchmark-' + uuid.uuid4().hex)
+    experiment = Experiment.objects.create(user=user, exp_name='Chunk upload benchmark')
+    try:
+        for name, create_requests in [('multipart', multipart_requests), ('raw body', raw_requests)]:
+            webcam_root = tempfile.mkdtemp()
+            try:
+                with override_settings(WEBCAM_ROOT=webcam_root):
+                    duration = measure(create_requests, experiment, args.participants, args.chunks, args.chunk_size * 1024)
+            finally:
+                shutil.rmtree(webcam_root, ignore_errors=True)
+            print('%-10s %8.3f s %8.1f MiB/s' % (name, duration, total / duration))
+    finally:
+        SubjectData.objects.filter(experiment=experiment).delete()
+        user.delete()
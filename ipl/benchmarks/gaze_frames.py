@@ -0,0 +1,123 @@
+"""
+Compares the time and memory needed to build the eye-tracking worksheets of a participant
+by concatenating a data frame per trial (previous approach) and by collecting columns (current approach),
+from gaze samples stored as JSON and from packed gaze samples.
+
+Usage: docker-compose exec web python benchmarks/gaze_frames.py [--trials 200] [--samples 300]
+"""
+import argparse
+from io import StringIO
+import os
+import random
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ipl.settings')
+django.setup()
+
+import pandas as pd
+import simplejson as json
+
+from experiments.aoi import get_grid
+from experiments.reporter import create_gaze_frames
+from experiments.gaze import encode_webgazer_data
+
+
+def concat_gaze_frames(trial_results):
+    """
+    Returns the eye-tracking and validation data frames by concatenating a data frame per trial.
+    """
+    validation_data = pd.DataFrame()
+    webgazer_data = pd.DataFrame()
+    for result in trial_results:
+        if result.trialitem.is_calibration:
+            curr_webgazer_data = pd.read_json(StringIO(json.dumps(result.webgazer_data[1:])))
+            curr_validation_data = pd.read_json(StringIO(json.dumps(result.webgazer_data[0]))).drop(columns=['trial_type'])
+            curr_validation_data.insert(0, 'Trial Number', result.report_trial_number)
+            curr_validation_data.insert(1, 'Trial Label', result.trialitem.label)
+            curr_validation_data.insert(2, 'Trial Code', result.trialitem.code)
+            validation_data = pd.concat([validation_data, curr_validation_data])
+        else:
+            curr_webgazer_data = pd.read_json(StringIO(json.dumps(result.webgazer_data)))
+        curr_webgazer_data.insert(0, 'Trial Number', result.report_trial_number)
+        curr_webgazer_data.insert(1, 'Trial Label', result.trialitem.label)
+        curr_webgazer_data.insert(2, 'Trial Code', result.trialitem.code)
+        curr_webgazer_data['Nrows'] = result.trialitem.grid_row
+        curr_webgazer_data['Ncols'] = result.trialitem.grid_col
+        grid = get_grid(result.resolution_w, result.resolution_h, result.trialitem.grid_row, result.trialitem.grid_col)
+        curr_webgazer_data['Gaze Area (row,col)'] = grid.label(curr_webgazer_data['x'], curr_webgazer_data['y'])
+        webgazer_data = pd.concat([webgazer_data, curr_webgazer_data])
+    return [webgazer_data, validation_data]
+
+
+def create_trial_results(num_trials, num_samples):
+    """
+    Returns trial results with random eye-tracking data, of which every 20th trial is a calibration trial.
+    """
+    rnd = random.Random(0)
+    results = []
+    for trial_number in range(1, num_trials + 1):
+        is_calibration = trial_number % 20 == 1
+        data = [{'x': rnd.randint(0, 1920), 'y': rnd.randint(0, 1080), 't': rnd.random() * 10000}
+                for _ in range(num_samples)]
+        if is_calibration:
+            data.insert(0, {'trial_type': 'validation', 'target_x': 960, 'target_y': 540,
+                            'x': [rnd.randint(0, 1920) for _ in range(50)], 'y': [rnd.randint(0, 1080) for _ in range(50)],
+                            'accuracy': 80, 'precision_rms': 1.5, 'precision_sd_x': 2.0, 'precision_sd_y': 3.0})
+        trialitem = SimpleNamespace(label='trial %s' % trial_number, code='', record_gaze=True,
+                                    is_calibration=is_calibration, grid_row=2, grid_col=2)
+        results.append(SimpleNamespace(trialitem=trialitem, webgazer_data=data, gaze_samples=None,
+                                       report_trial_number=trial_number, resolution_w=1920, resolution_h=1080))
+    return results
+
+
+def pack_trial_results(trial_results):
+    """
+    Returns copies of trial results with their gaze samples packed, as stored since samples are packed.
+    """
+    packed_results = []
+    for result in trial_results:
+        webgazer_data, gaze_samples = encode_webgazer_data(result.webgazer_data)
+        packed_results.append(SimpleNamespace(**dict(vars(result), webgazer_data=webgazer_data, gaze_samples=gaze_samples)))
+    return packed_results
+
+
+def measure(function, trial_results):
+    """
+    Returns the result, the time in seconds and the peak memory in MiB of building the data frames.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    frames = function(trial_results)
+    duration = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return frames, duration, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--trials', type=int, default=200, help='Number of trials with eye-tracking data.')
+    parser.add_argument('--samples', type=int, default=300, help='Number of gaze samples per trial.')
+    args = parser.parse_args()
+
+    trial_results = create_trial_results(args.trials, args.samples)
+    print('%s trials with %s gaze samples each' % (args.trials, args.samples))
+    packed_results = pack_trial_results(trial_results)
+    frames = {}
+    for name, function, results in [('concat per trial', concat_gaze_frames, trial_results),
+                                     ('collect columns', create_gaze_frames, trial_results),
+                                     ('collect packed', create_gaze_frames, packed_results)]:
+        frames[name], duration, peak = measure(function, results)
+        print('%-18s %8.3f s %10.1f MiB peak' % (name, duration, peak))
+
+    reference = frames.pop('concat per trial')
+    for name in frames:
+        for old, new in zip(reference, frames[name]):
+            pd.testing.assert_frame_equal(old.reset_index(drop=True), new.reset_index(drop=True), check_dtype=False)
+    print('All approaches produce the same worksheets.')
@@ -9,14 +9,17 @@ from django.urls import reverse
 from django.forms import Textarea
 from django.db import models
 from django.db.models import Q
+from django.db.models.functions import Substr
 from django.utils.safestring import mark_safe
 
 from filebrowser.base import FileObject
 from datetime import datetime
 
 from .models import Instrument, Experiment, ListItem, OuterBlockItem, BlockItem, TrialItem, TrialResult, CdiResult, SubjectData, \
-                    ConsentQuestion, Question, AnswerText, AnswerRadio, AnswerSelect, AnswerInteger, AnswerSelectMultiple
+                    ConsentQuestion, Question, AnswerText, AnswerRadio, AnswerSelect, AnswerInteger, AnswerSelectMultiple, ReportJob
 from .forms import ExperimentForm, QuestionInlineFormSet
+from .tidy import parquet_available
+from .gaze import HEADER, JSONArrayLength, count_packed_samples
 
 import os
 import uuid
@@ -178,12 +181,22 @@ class CdiResultInline(admin.TabularInline):
 class TrialResultInline(admin.TabularInline):
     model = TrialResult
     extra = 0
-    exclude = ('webcam_file', 'start_time', 'end_time')
+    exclude = ('webcam_file', 'start_time', 'end_time', 'webgazer_data')
     readonly_fields = ('trial_number', 'trialitem', 'trial_blockitem', 'trial_audio', 'trial_visual', 
                         'trial_input', 'trial_maxduration', 'response_time', 'key_pressed', 'webcam_file_link',
-                        'resolution_w', 'resolution_h', 'webgazer_data')
+                        'resolution_w', 'resolution_h', 'webgazer_data_link')
     ordering = ('id',)
 
+    def get_queryset(self, request):
+        """
+        Returns the trial results without their webgazer data, which is only counted and loaded on request.
+        """
+        qs = super(TrialResultInline, self).get_queryset(request)
+        return qs.defer(*TrialResult.GAZE_FIELDS).select_related('trialitem__blockitem').annotate(
+            num_webgazer_values=JSONArrayLength('webgazer_data'),
+            gaze_samples_header=Substr('gaze_samples', 1, HEADER.size, output_field=models.BinaryField()),
+        )
+
     def trial_blockitem(self, obj):
         return obj.trialitem.blockitem
 
@@ -225,6 +238,16 @@ class TrialResultInline(admin.TabularInline):
     webcam_file_link.allow_tags = True
     webcam_file_link.short_description = 'Webcam file'
 
+    def webgazer_data_link(self, obj):
+        count = obj.num_webgazer_values + count_packed_samples(obj.gaze_samples_header)
+        if count:
+            url = reverse('experiments:trialResultWebgazerData', args=(obj.pk,))
+            return format_html('<a href="{}" target="_blank">{}</a>', url, count)
+        else:
+            return "-"
+
+    webgazer_data_link.short_description = 'Webgazer values'
+
     def has_add_permission(self, request, obj=None):
         return False
 
@@ -352,13 +375,19 @@ class ExperimentAdmin(admin.ModelAdmin):
         """
         Displays action buttons for the Experiment admin interface.
         """
-        return format_html(
+        url_report = reverse('experiments:experimentReport', args=[obj.id])
+        buttons = format_html(
             '<a class="grp-button" href="{url_exp}">Go to Experiment</a>&nbsp;'
             + '<a class="grp-button" href="{url_report}">Download Results</a>&nbsp;'
-            + '<a class="grp-button" href="{url_export}">Export Experiment</a>',
+            + '<a class="grp-button" href="{url_report}?format={csv}">Download Tidy Data</a>&nbsp;',
             url_exp=reverse('experiments:informationPage', args=[obj.id]),
-            url_report=reverse('experiments:experimentReport', args=[obj.id]),
-            url_export=reverse('experiments:experimentExport', args=[obj.id]))
+            url_report=url_report,
+            csv=ReportJob.CSV)
+        if parquet_available():
+            buttons += format_html('<a class="grp-button" href="{url_report}?format={parquet}">Download Tidy Data (Parquet)</a>&nbsp;',
+                                   url_report=url_report, parquet=ReportJob.PARQUET)
+        return buttons + format_html('<a class="grp-button" href="{url_export}">Export Experiment</a>',
+                                     url_export=reverse('experiments:experimentExport', args=[obj.id]))
 
     experiment_buttons.allow_tags = True
     experiment_buttons.short_description = 'Actions'
@@ -382,6 +411,9 @@ class ExperimentAdmin(admin.ModelAdmin):
         json_data = {}
         json_data['experiment'] = json.loads(serializers.serialize("json", experiment))
         json_data['lists'] = json.loads(serializers.serialize("json", lists))
+        for list_data in json_data['lists']:
+            # Trial plans are compiled again from the imported blocks and trials
+            list_data['fields'].pop('trial_plan', None)
         json_data['outerblocks'] = json.loads(serializers.serialize("json", outerblocks))
         json_data['innerblocks'] = json.loads(serializers.serialize("json", innerblocks))
         json_data['trials'] = json.loads(serializers.serialize("json", trials))
@@ -609,7 +641,7 @@ class SubjectDataAdmin(admin.ModelAdmin):
     ]
     # specifies the order as well as which fields to act on
     readonly_fields = ('id', 'participant_id', 'experiment', 'listitem',
-                       'created', 'updated', 'resolution_w', 'resolution_h', 'cdi_estimate')
+                       'created', 'updated', 'resolution_w', 'resolution_h', 'cdi_estimate', 'random_seed', 'trial_order')
     ordering = (
         'experiment',
         'participant_id',
@@ -0,0 +1,53 @@
+from functools import lru_cache
+
+import numpy as np
+
+
+def grid_boundaries(length, num_areas):
+    """
+    Returns the boundaries of the areas along one axis of the screen, starting at 0 and ending at `length`.
+    """
+    step = int(length / num_areas)
+    if step == 0:
+        raise ValueError('Cannot divide a length of %s into %s areas.' % (length, num_areas))
+    return np.append(np.arange(0, length, step), length)
+
+
+class AOIGrid:
+    """
+    Grid of areas of interest (rows * cols) for a trial, used to determine
+    the row and col responded to (click/gaze) for whole arrays of coordinates.
+    """
+
+    def __init__(self, width, height, rows, cols):
+        self.boundaries_r = grid_boundaries(height, rows)
+        self.boundaries_c = grid_boundaries(width, cols)
+
+        # Labels of all areas, indexed by row and col number
+        self.labels = np.array([[f'({r},{c})' for c in range(len(self.boundaries_c))]
+                                for r in range(len(self.boundaries_r))], dtype=object)
+
+    def classify(self, x, y):
+        """
+        Returns the row and col numbers of the given coordinates.
+        Coordinates beyond the screen are assigned to the last row/col.
+        """
+        row_num = np.searchsorted(self.boundaries_r, np.asarray(y, dtype=float), side='left')
+        col_num = np.searchsorted(self.boundaries_c, np.asarray(x, dtype=float), side='left')
+        return (np.minimum(row_num, len(self.boundaries_r) - 1),
+                np.minimum(col_num, len(self.boundaries_c) - 1))
+
+    def label(self, x, y):
+        """
+        Returns the areas of the given coordinates, formatted as '(row,col)'.
+        """
+        row_num, col_num = self.classify(x, y)
+        return self.labels[row_num, col_num]
+
+
+@lru_cache(maxsize=256)
+def get_grid(width, height, rows, cols):
+    """
+    Returns the AOIGrid for a screen resolution and grid size, reusing grids that were already computed.
+    """
+    return AOIGrid(width, height, rows, cols)
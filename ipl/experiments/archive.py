@@ -0,0 +1,112 @@
+import os
+import uuid
+import zipfile
+
+# Extensions of files that are already compressed and are therefore stored in the archive as they are
+STORED_EXTENSIONS = {'.webm', '.mp4', '.mkv', '.ogg', '.oga', '.ogv', '.opus', '.mp3', '.m4a',
+                     '.png', '.jpg', '.jpeg', '.gif', '.zip', '.gz', '.parquet'}
+
+# Number of bytes copied into the archive at once
+CHUNK_SIZE = 1024 * 1024
+
+
+def member_compression(name):
+    """
+    Returns the compression method of an archive member: stored for already compressed media, deflated otherwise.
+    """
+    if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+class StreamBuffer:
+    """
+    Unseekable file object collecting the bytes written to it until they are taken with `pop`.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class ReportArchive:
+    """
+    Zip archive of a report, choosing the compression method per member.
+    The methods adding members are generators yielding after each chunk written,
+    which allows the archive to be streamed while it is written.
+    """
+
+    def __init__(self, file):
+        self.zip_file = zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED)
+
+    def add_file(self, path, name):
+        """
+        Adds a file to the archive in chunks, read into a single reused buffer.
+        The bytes still pass through Python, as their CRC is part of the archive.
+        """
+        zinfo = zipfile.ZipInfo.from_file(path, name)
+        zinfo.compress_type = member_compression(name)
+        buffer = bytearray(CHUNK_SIZE)
+        view = memoryview(buffer)
+        with open(path, 'rb', buffering=0) as source, self.zip_file.open(zinfo, 'w') as member:
+            while True:
+                size = source.readinto(buffer)
+                if not size:
+                    break
+                member.write(view[:size])
+                yield
+
+    def add_bytes(self, name, data):
+        """
+        Adds the content of a file created in memory to the archive.
+        """
+        self.zip_file.writestr(name, data, compress_type=member_compression(name))
+        yield
+
+    def close(self):
+        self.zip_file.close()
+
+
+def write_archive(path, write_members):
+    """
+    Writes an archive to a file, using `write_members(archive)` to add its members.
+    The archive is written to a temporary file first, so that an incomplete archive never replaces an existing one.
+    """
+    root, extension = os.path.splitext(path)
+    tmp_path = root + '.' + uuid.uuid4().hex + '.tmp' + extension
+    try:
+        with open(tmp_path, 'wb') as f:
+            archive = ReportArchive(f)
+            for _ in write_members(archive):
+                pass
+            archive.close()
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def stream_archive(write_members):
+    """
+    Returns an iterator over the bytes of an archive, using `write_members(archive)` to add its members,
+    e.g. to be sent as a StreamingHttpResponse without writing the archive to disk.
+    """
+    buffer = StreamBuffer()
+    archive = ReportArchive(buffer)
+    for _ in write_members(archive):
+        data = buffer.pop()
+        if data:
+            yield data
+    archive.close()
+    yield buffer.pop()
@@ -4,7 +4,7 @@ from django.urls import reverse
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
 from django.utils.text import get_valid_filename
-from django.template import Template, RequestContext
+from django.template import RequestContext
 
 from filebrowser.fields import FileBrowseField
 from scipy.stats import norm
@@ -12,14 +12,12 @@ from scipy.stats import norm
 from .models import SubjectData, ListItem, CdiResult, Experiment, Instrument, Question, AnswerText, AnswerRadio
 from .forms import VocabularyChecklistForm
 from .views import proceedToExperiment
+from .template_cache import get_page_template
+from .instruments import get_word_list, get_item_params, get_norm_tables, FEMALE, MALE
 
-import csv
 import datetime
 import logging
-import simplejson as json
 import numpy as np
-import os.path
-import pandas as pd
 import numexpr
 import tqdm
 import catsim
@@ -53,14 +51,7 @@ def estimateCDI(run_uuid):
     cdi_results = CdiResult.objects.filter(subject=run_uuid).order_by('given_label', '-id').distinct('given_label')
     
     try:
-        words_list = instrument.words_list
-       
-        # parse instrument word list
-        all_words_reader = csv.DictReader(open(os.path.join(settings.MEDIA_ROOT, instrument.words_list.path), mode='r', encoding='utf-8-sig'), delimiter = ',')
-        
-        all_words = {}
-        for row in all_words_reader:
-            all_words[row['word']] = int(row['word_id'])
+        word_ids = get_word_list(instrument).word_ids
 
         # get child's age and sex
         #age = (AnswerInteger.objects.filter(subject_data=subject_data, question__question_type='age').first()).body
@@ -70,23 +61,16 @@ def estimateCDI(run_uuid):
         choices = (Question.objects.filter(experiment=experiment, question_type='sex').first()).choices
         choices = list(filter(None, [x.strip() for x in choices.split(',')]))
 
-        # get lookup files for child's sex
+        # get lookup tables for child's sex
         if sex.strip().lower() == choices[0].lower(): # choices0 = female
-            lm_np_mean = pd.read_csv(os.path.join(settings.MEDIA_ROOT, instrument.f_lm_np_mean.path))
-            lm_np_sd = pd.read_csv(os.path.join(settings.MEDIA_ROOT, instrument.f_lm_np_sd.path))
-            lm_p_mean = pd.read_csv(os.path.join(settings.MEDIA_ROOT, instrument.f_lm_p_mean.path))
-            lm_p_sd = pd.read_csv(os.path.join(settings.MEDIA_ROOT, instrument.f_lm_p_sd.path))
-            bmin = pd.read_csv(os.path.join(settings.MEDIA_ROOT, instrument.f_bmin.path))
-            slope = pd.read_csv(os.path.join(settings.MEDIA_ROOT, instrument.f_slope.path))
+            norms = get_norm_tables(instrument, FEMALE)
         else: # choices1 = male
-            lm_np_mean = pd.read_csv(os.path.join(settings.MEDIA_ROOT, instrument.m_lm_np_mean.path))
-            lm_np_sd = pd.read_csv(os.path.join(settings.MEDIA_ROOT, instrument.m_lm_np_sd.path))
-            lm_p_mean = pd.read_csv(os.path.join(settings.MEDIA_ROOT, instrument.m_lm_p_mean.path))
-            lm_p_sd = pd.read_csv(os.path.join(settings.MEDIA_ROOT, instrument.m_lm_p_sd.path))
-            bmin = pd.read_csv(os.path.join(settings.MEDIA_ROOT, instrument.m_bmin.path))
-            slope = pd.read_csv(os.path.join(settings.MEDIA_ROOT, instrument.m_slope.path))
+            norms = get_norm_tables(instrument, MALE)
+        lm_np_mean, lm_np_sd = norms['lm_np_mean'], norms['lm_np_sd']
+        lm_p_mean, lm_p_sd = norms['lm_p_mean'], norms['lm_p_sd']
+        bmin, slope = norms['bmin'], norms['slope']
         
-        instr_num_words = len(lm_np_mean.index)
+        instr_num_words = len(lm_np_mean.values)
         basis = np.ones(instr_num_words+1)
         min_score = np.ones(instr_num_words+1)
         max_score = np.ones(instr_num_words+1)
@@ -94,18 +78,18 @@ def estimateCDI(run_uuid):
 
         for cr in cdi_results:
             # retrieve row number via word_id, assuming row numbers are the same across all data files
-            word_idx = lm_np_mean[lm_np_mean['word_id'] == all_words.get(cr.given_label)].index[0]
+            word_idx = lm_np_mean.row(word_ids[cr.given_label])
             if cr.response: # if can produce/comprehend word
-                basis = basis + np.log(norm.pdf(x_values, loc=lm_p_mean.at[word_idx,str(age)], scale=lm_p_sd.at[word_idx,str(age)]))
+                basis = basis + np.log(norm.pdf(x_values, loc=lm_p_mean.at(word_idx, age), scale=lm_p_sd.at(word_idx, age)))
             else: # cannot produce/comprehend word
-                basis = basis + np.log(norm.pdf(x_values, loc=lm_np_mean.at[word_idx,str(age)], scale=lm_np_sd.at[word_idx,str(age)]))
-            min_score = min_score + np.log(norm.pdf(x_values, loc=lm_np_mean.at[word_idx,str(age)], scale=lm_np_sd.at[word_idx,str(age)]))
-            max_score = max_score + np.log(norm.pdf(x_values, loc=lm_p_mean.at[word_idx,str(age)], scale=lm_p_sd.at[word_idx,str(age)]))
+                basis = basis + np.log(norm.pdf(x_values, loc=lm_np_mean.at(word_idx, age), scale=lm_np_sd.at(word_idx, age)))
+            min_score = min_score + np.log(norm.pdf(x_values, loc=lm_np_mean.at(word_idx, age), scale=lm_np_sd.at(word_idx, age)))
+            max_score = max_score + np.log(norm.pdf(x_values, loc=lm_p_mean.at(word_idx, age), scale=lm_p_sd.at(word_idx, age)))
 
         # get index of max value in basis
         B = np.where(basis == np.amax(basis))
         B = int(B[0][0]) + 1
-        estimate = (B-bmin.at[0,str(age)])/slope.at[0,str(age)]
+        estimate = (B-bmin.at(0, age))/slope.at(0, age)
 
         # store CDI estimate in subject_data
         subject_data.cdi_estimate = estimate
@@ -127,26 +111,14 @@ def cdiRun(request, run_uuid):
     instrument = get_object_or_404(Instrument, pk=experiment.instrument.pk)
 
     try:
-        # parse instrument word list
-        all_words_reader = csv.DictReader(open(os.path.join(settings.MEDIA_ROOT, instrument.words_list.path), mode='r', encoding='utf-8-sig'), delimiter = ',')
-        all_words = []
-        for row in all_words_reader:
-            all_words.append(row['word'])
-        request.session['all_words'] = json.dumps(all_words)
-        
-        # get IRT parameters
-        item_params = pd.read_csv(os.path.join(settings.MEDIA_ROOT, instrument.irt_params.path))
-        item_params = item_params.iloc[:, 1:5]
-        request.session['item_params'] = item_params.reset_index().to_json(orient='records')
-
         # administer first item
-        administered_items = sort_items(item_params.to_numpy())[0:1, ].tolist()
+        administered_items = sort_items(get_item_params(instrument))[0:1, ].tolist()
         request.session['administered_items'] = administered_items
         irt_run = 0
         request.session['irt_run'] = irt_run
         request.session['est_theta'] = FixedPointInitializer(-5).initialize() # start low, assume all poor learners
         words = []
-        words.append(all_words[administered_items[irt_run]])
+        words.append(get_word_list(instrument).words[administered_items[irt_run]])
         request.session['words'] = words
         request.session['responses'] = []
         
@@ -155,7 +127,7 @@ def cdiRun(request, run_uuid):
         logger.exception('Failed to generate CDI item: ' + str(e))
         return HttpResponseRedirect(reverse('experiments:experimentError', args=(run_uuid,)))
     else:
-        t = Template(experiment.cdi_page_tpl)
+        t = get_page_template(experiment, 'cdi_page_tpl')
         c = RequestContext(request, {'subject_data': subject_data, 'cdi_form':form, 'experiment': experiment,})
         return HttpResponse(t.render(c))
 
@@ -200,7 +172,7 @@ def cdiSubmit(request, run_uuid):
                 return proceedToExperiment(experiment, run_uuid)
             else:
                 return HttpResponseRedirect(reverse('experiments:experimentEnd', args=(run_uuid,)))
-    t = Template(experiment.cdi_page_tpl)
+    t = get_page_template(experiment, 'cdi_page_tpl')
     c = RequestContext(request, {'subject_data': subject_data, 'cdi_form':form, 'experiment': experiment,})
     return HttpResponse(t.render(c))
 
@@ -210,19 +182,19 @@ def cdiGenerateNextItem(request, run_uuid):
     """
     subject_data = get_object_or_404(SubjectData, pk=run_uuid)
     experiment = get_object_or_404(Experiment, pk=subject_data.experiment.pk)
+    instrument = get_object_or_404(Instrument, pk=experiment.instrument.pk)
 
     try:
         # estimate and update theta 
         irt_run = request.session.get('irt_run')
-        item_params = request.session.get('item_params')
-        item_params = pd.read_json(item_params).iloc[:, 1:5].to_numpy()
+        item_params = get_item_params(instrument)
         administered_items = request.session.get('administered_items')
         responses = request.session.get('responses')
         est_theta = request.session.get('est_theta')
         est_theta = NumericalSearchEstimator(method='bounded').estimate(items=item_params, administered_items=administered_items, response_vector=responses, est_theta=est_theta)
         request.session['est_theta'] = est_theta  
         words = request.session.get('words')
-        all_words = json.loads(request.session.get('all_words'))
+        all_words = get_word_list(instrument).words
 
         logger.info('est theta: ' + str(est_theta))
         
@@ -242,6 +214,6 @@ def cdiGenerateNextItem(request, run_uuid):
         logger.exception('Failed to generate cdi item: ' + str(e))
         return HttpResponseRedirect(reverse('experiments:experimentError', args=(run_uuid,)))
     else:
-        t = Template(experiment.cdi_page_tpl)
+        t = get_page_template(experiment, 'cdi_page_tpl')
         c = RequestContext(request, {'subject_data': subject_data, 'cdi_form': form, 'experiment': experiment,})
         return HttpResponse(t.render(c))
\ No newline at end of file
@@ -0,0 +1,368 @@
+from django.conf import settings
+from django.utils.text import get_valid_filename
+
+from contextlib import contextmanager
+
+import os
+import re
+import errno
+import fcntl
+import shutil
+import logging
+
+# Create a logger for this file
+logger = logging.getLogger(__name__)
+
+# Folder of WEBCAM_ROOT containing a folder per recording with the chunks uploaded so far
+CHUNK_FOLDER = 'chunks'
+
+# Name of an uploaded chunk: <recording>-<chunk number>.<extension>
+CHUNK_NAME = re.compile(r'^(?P<recording>.+)-(?P<number>\d+)\.(?P<extension>\w+)$')
+
+# Extension of a recording while it is being assembled
+PART_EXTENSION = '.part'
+
+# File in the folder of a recording containing the number of the next chunk to be appended and the size of the .part file
+STATE_FILE = 'state'
+
+# Number of bytes copied at once when appending chunks inside the kernel, and otherwise through a buffer
+KERNEL_COPY_SIZE = 64 * 1024 * 1024
+COPY_SIZE = 1024 * 1024
+
+
+def valid_name(name):
+    """
+    Returns a name which is safe to be used as a file or folder name in WEBCAM_ROOT.
+    """
+    if not name or name.strip().startswith('.'):
+        raise ValueError('Invalid file name %r.' % name)
+    return get_valid_filename(name)
+
+
+def split_chunk_name(name):
+    """
+    Returns the name of the recording and the number of an uploaded chunk.
+    """
+    match = CHUNK_NAME.match(valid_name(name))
+    if not match:
+        raise ValueError('Invalid chunk name %r.' % name)
+    return match.group('recording'), int(match.group('number'))
+
+
+def is_subject_recording(subject, recording):
+    """
+    Returns whether a recording was named for a participant by experiment.js:
+    <participant number>_trial<trial number>_<trial label>_<participant id>
+    """
+    recording = valid_name(recording)
+    return recording.startswith('%s_' % subject.participant_id) and recording.endswith('_' + valid_name(subject.pk))
+
+
+def kernel_copy(in_fd, out_fd, count):
+    """
+    Copies up to `count` bytes between the current positions of two file descriptors inside the kernel,
+    with copy_file_range or else sendfile. Returns the number of bytes copied, or None if neither is supported.
+    """
+    for copy in [getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)]:
+        if copy is None:
+            continue
+        try:
+            if copy is os.sendfile:
+                return os.sendfile(out_fd, in_fd, None, count)
+            return copy(in_fd, out_fd, count)
+        except OSError as e:
+            # Not supported between these files, e.g. across file systems on older kernels
+            if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise
+    return None
+
+
+def copy_file(infile, outfile):
+    """
+    Copies the rest of a file to the current position of another file and returns the number of bytes copied.
+    The data is copied inside the kernel where possible, falling back to copying it through large buffers.
+    Both files have to be opened unbuffered (buffering=0), so that their positions are those of their descriptors.
+    """
+    in_fd = infile.fileno()
+    out_fd = outfile.fileno()
+    copied = 0
+    while True:
+        sent = kernel_copy(in_fd, out_fd, KERNEL_COPY_SIZE)
+        if sent is None:
+            break
+        if sent == 0:
+            return copied
+        copied += sent
+    while True:
+        data = memoryview(infile.read(COPY_SIZE))
+        if not data:
+            return copied
+        copied += len(data)
+        # Unbuffered writes may be partial
+        while data:
+            data = data[outfile.write(data):]
+
+
+class IncompleteChunk(Exception):
+    """
+    Raised when the upload of a chunk ended before all its bytes arrived.
+    """
+    pass
+
+
+class RecordingFinished(Exception):
+    """
+    Raised when a chunk arrives for a recording which has already been finished.
+    """
+    pass
+
+
+class MissingRecording(Exception):
+    """
+    Raised when a recording is finished of which no chunks have been received.
+    """
+    pass
+
+
+def write_chunk(f, chunk, length=None):
+    """
+    Writes a chunk, given as an iterable of bytes, to a file.
+    Raises IncompleteChunk if fewer than `length` bytes were written.
+    """
+    written = 0
+    for data in chunk:
+        f.write(data)
+        written += len(data)
+    if length is not None and written != length:
+        raise IncompleteChunk('Received %d of %d bytes.' % (written, length))
+
+
+class ChunkStore:
+    """
+    Storage of the chunks of webcam/audio recordings uploaded during an experiment.
+    Each recording is assembled while its chunks arrive: a chunk following the chunks received so far is appended
+    to a growing .part file, a chunk arriving early is kept in the folder of the recording until its predecessors
+    have been appended. Finishing a recording then only renames the .part file into a folder per experiment and
+    participant. Uploading a chunk and finishing a recording can both be repeated safely.
+    """
+
+    def __init__(self, root=None):
+        self.root = root or settings.WEBCAM_ROOT
+        self.chunk_root = os.path.join(self.root, CHUNK_FOLDER)
+
+    def get_chunk_folder(self, recording):
+        """
+        Returns the folder containing the .part file and the early chunks of a recording.
+        """
+        return os.path.join(self.chunk_root, valid_name(recording))
+
+    @contextmanager
+    def lock(self, recording):
+        """
+        Locks a recording, so that its chunks are appended by one request at a time.
+        """
+        os.makedirs(self.chunk_root, exist_ok=True)
+        lock_path = self.get_chunk_folder(recording) + '.lock'
+        while True:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # Retry if the lock file was removed by the request finishing the recording while we were waiting
+            try:
+                if os.stat(lock_path).st_ino == os.fstat(fd).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+        try:
+            yield lock_path
+        finally:
+            os.close(fd)
+
+    def read_state(self, folder):
+        """
+        Returns the number of the next chunk to be appended to a recording and the size of its .part file.
+        """
+        try:
+            with open(os.path.join(folder, STATE_FILE)) as f:
+                number, size = f.read().split()
+            return int(number), int(size)
+        except FileNotFoundError:
+            return 0, 0
+
+    def write_state(self, folder, number, size):
+        """
+        Records the chunks appended to a recording. The state is replaced atomically,
+        so that it never describes an append that was interrupted.
+        """
+        tmp_path = os.path.join(folder, STATE_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write('%d %d' % (number, size))
+        os.replace(tmp_path, os.path.join(folder, STATE_FILE))
+
+    def get_early_chunks(self, folder):
+        """
+        Returns the numbers and paths of the chunks of a recording which have not been appended yet, ordered by number.
+        """
+        chunks = []
+        for name in os.listdir(folder):
+            if CHUNK_NAME.match(name):
+                chunks.append((split_chunk_name(name)[1], os.path.join(folder, name)))
+        return sorted(chunks)
+
+    def append(self, part, path):
+        """
+        Appends a chunk file to the .part file of a recording, which has to be opened unbuffered.
+        """
+        with open(path, 'rb', buffering=0) as infile:
+            copy_file(infile, part)
+
+    def save_chunk(self, subject, name, chunk, length=None):
+        """
+        Saves an uploaded chunk of a participant's recording, given as an iterable of bytes: the chunk is appended
+        to the recording directly if all its predecessors have been appended, together with any early chunks
+        following it, otherwise it is kept until they arrive. A chunk which has already been appended is ignored.
+        If the `length` of the chunk is given, a chunk of which fewer bytes arrived is discarded.
+        Raises RecordingFinished if the recording has already been finished.
+        """
+        recording, number = split_chunk_name(name)
+        folder = self.get_chunk_folder(recording)
+        with self.lock(recording) as lock_path:
+            if os.path.exists(self.get_recording_path(subject, recording)):
+                os.remove(lock_path)
+                raise RecordingFinished('Recording %s has already been finished.' % recording)
+            os.makedirs(folder, exist_ok=True)
+            next_number, size = self.read_state(folder)
+            if number < next_number:
+                logger.info('Chunk %s has already been appended.' % name)
+                return recording, number
+
+            if number == next_number:
+                # Data written after the recorded size is discarded by the next append if the chunk is incomplete
+                part_path = os.path.join(folder, valid_name(recording) + PART_EXTENSION)
+                with open(os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b') as part:
+                    part.truncate(size)
+                    part.seek(size)
+                    write_chunk(part, chunk, length)
+                    size = part.tell()
+                self.write_state(folder, number + 1, size)
+                self.append_chunks(folder, recording, number + 1, size)
+            else:
+                chunk_path = os.path.join(folder, valid_name(name))
+                tmp_path = chunk_path + '.tmp'
+                try:
+                    with open(tmp_path, 'wb') as f:
+                        write_chunk(f, chunk, length)
+                    os.replace(tmp_path, chunk_path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+        return recording, number
+
+    def append_chunks(self, folder, recording, next_number, size, complete=False):
+        """
+        Appends the early chunks of a recording which follow the chunks appended so far, or all of them
+        if the recording is complete. The .part file is truncated to the size recorded in the state first,
+        which discards an append that was interrupted.
+        """
+        part_path = os.path.join(folder, valid_name(recording) + PART_EXTENSION)
+        with open(os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b', buffering=0) as part:
+            part.truncate(size)
+            part.seek(size)
+            for number, path in self.get_early_chunks(folder):
+                if number < next_number:
+                    # Uploaded again while it was being appended
+                    os.remove(path)
+                    continue
+                if number > next_number and not complete:
+                    break
+                self.append(part, path)
+                next_number = number + 1
+                size = part.tell()
+                self.write_state(folder, next_number, size)
+                os.remove(path)
+        return part_path
+
+    def get_manifest(self, subject, recording):
+        """
+        Returns the numbers of the chunks of a recording received so far and whether the recording has been finished,
+        so that a client reconnecting after a dropped connection only uploads the missing chunks.
+        """
+        folder = self.get_chunk_folder(recording)
+        path = self.get_recording_path(subject, recording)
+        received = []
+        with self.lock(recording) as lock_path:
+            if os.path.isdir(folder):
+                next_number, size = self.read_state(folder)
+                received = list(range(next_number))
+                received += [number for number, chunk in self.get_early_chunks(folder) if number >= next_number]
+            else:
+                os.remove(lock_path)
+        return {
+            'filename': recording,
+            'received': received,
+            'finished': not received and os.path.exists(path),
+        }
+
+    def get_recording_name(self, subject, recording):
+        """
+        Returns the name of a merged recording relative to WEBCAM_ROOT: <experiment>/<participant>/<recording>.webm
+        """
+        return '/'.join([str(subject.experiment_id), valid_name(subject.pk), valid_name(recording) + '.webm'])
+
+    def get_recording_path(self, subject, recording):
+        """
+        Returns the path of a merged recording.
+        """
+        return os.path.join(self.root, *self.get_recording_name(subject, recording).split('/'))
+
+    def merge(self, subject, recording):
+        """
+        Finishes a recording: appends any chunks still waiting for a missing predecessor and renames the .part file.
+        A recording which has already been finished is left as it is.
+        Returns the name of the recording relative to WEBCAM_ROOT, or raises MissingRecording if it has no chunks.
+        """
+        name = self.get_recording_name(subject, recording)
+        path = self.get_recording_path(subject, recording)
+        folder = self.get_chunk_folder(recording)
+        with self.lock(recording) as lock_path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):
+                logger.info('Recording %s has already been finished.' % name)
+                # Chunks which arrived after the recording was finished, before they were refused
+                shutil.rmtree(folder, ignore_errors=True)
+            elif os.path.isdir(folder):
+                next_number, size = self.read_state(folder)
+                part_path = self.append_chunks(folder, recording, next_number, size, complete=True)
+                os.replace(part_path, path)
+                shutil.rmtree(folder, ignore_errors=True)
+            else:
+                chunks = self.get_flat_chunks(recording)
+                if not chunks:
+                    os.remove(lock_path)
+                    raise MissingRecording('No chunks of recording %s have been received.' % name)
+                self.merge_flat_chunks(chunks, path)
+            os.remove(lock_path)
+        logger.info('Finished recording %s.' % name)
+        return name
+
+    def get_flat_chunks(self, recording):
+        """
+        Returns the paths of the chunks of a recording uploaded into WEBCAM_ROOT itself, before recordings
+        were assembled while their chunks arrive, ordered by chunk number.
+        """
+        prefix = valid_name(recording) + '-'
+        chunks = [(split_chunk_name(name)[1], os.path.join(self.root, name))
+                  for name in os.listdir(self.root) if name.startswith(prefix) and CHUNK_NAME.match(name)]
+        return [path for number, path in sorted(chunks)]
+
+    def merge_flat_chunks(self, chunks, path):
+        """
+        Merges the chunks of a recording uploaded into WEBCAM_ROOT itself (see `get_flat_chunks`) into a file and deletes them.
+        """
+        tmp_path = path + PART_EXTENSION
+        with open(tmp_path, 'wb', buffering=0) as outfile:
+            for chunk in chunks:
+                self.append(outfile, chunk)
+        os.replace(tmp_path, path)
+        for chunk in chunks:
+            os.remove(chunk)
@@ -0,0 +1,230 @@
+from django.db.models import Func, IntegerField
+from .aoi import get_grid
+
+import struct
+import zlib
+import logging
+import numpy as np
+import pandas as pd
+
+# Create a logger for this file
+logger = logging.getLogger(__name__)
+
+# Header of packed gaze samples: format version, flags and number of samples,
+# followed by the x and y coordinates as int32 and the timestamps as float64 (or int64), all little-endian
+HEADER = struct.Struct('<BBI')
+VERSION = 1
+
+# Flags of packed gaze samples
+COMPRESSED = 1
+INTEGER_TIMES = 2
+
+# Keys of a gaze sample recorded by webgazer-calibration.js
+SAMPLE_KEYS = ('x', 'y', 't')
+
+INT32_MIN = -2 ** 31
+INT32_MAX = 2 ** 31 - 1
+
+# Resampled gaze is left empty where no sample was recorded within this many intervals before
+MAX_GAP_INTERVALS = 2
+
+
+def is_sample(value):
+    """
+    Returns whether a value recorded during a trial is a gaze sample which can be packed without loss,
+    i.e. a dict {'x', 'y', 't'} with integer coordinates.
+    """
+    if type(value) is not dict or value.keys() != set(SAMPLE_KEYS):
+        return False
+    if any(type(value[key]) is not int or not INT32_MIN <= value[key] <= INT32_MAX for key in ('x', 'y')):
+        return False
+    return type(value['t']) in (int, float)
+
+
+def pack_samples(samples, compress=True):
+    """
+    Returns gaze samples ({'x', 'y', 't'} dicts) packed into bytes, compressed with zlib if that makes them smaller.
+    Returns None if there are no samples or some cannot be packed without loss.
+    """
+    if not samples or not all(is_sample(sample) for sample in samples):
+        return None
+    flags = 0
+    times = [sample['t'] for sample in samples]
+    if all(type(t) is int for t in times):
+        flags |= INTEGER_TIMES
+        times = np.array(times, dtype='<i8')
+    else:
+        times = np.array(times, dtype='<f8')
+    body = b''.join([
+        np.array([sample['x'] for sample in samples], dtype='<i4').tobytes(),
+        np.array([sample['y'] for sample in samples], dtype='<i4').tobytes(),
+        times.tobytes(),
+    ])
+    if compress:
+        compressed = zlib.compress(body)
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= COMPRESSED
+    return HEADER.pack(VERSION, flags, len(samples)) + body
+
+
+def unpack_samples(data):
+    """
+    Returns packed gaze samples as a dictionary of NumPy arrays {'x', 'y', 't'}, with the dtypes
+    the samples would have been given by pandas if they were read from JSON.
+    """
+    version, flags, count = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError('Unknown version %d of packed gaze samples.' % version)
+    body = memoryview(data)[HEADER.size:]
+    if flags & COMPRESSED:
+        body = zlib.decompress(body)
+    return {
+        'x': np.frombuffer(body, dtype='<i4', count=count).astype(np.int64),
+        'y': np.frombuffer(body, dtype='<i4', count=count, offset=4 * count).astype(np.int64),
+        't': np.frombuffer(body, dtype='<i8' if flags & INTEGER_TIMES else '<f8', count=count, offset=8 * count) \
+               .astype(np.int64 if flags & INTEGER_TIMES else np.float64),
+    }
+
+
+def encode_webgazer_data(webgazer_data):
+    """
+    Splits the webgazer data of a trial into the values kept as JSON and the packed gaze samples.
+    Leading values which are not gaze samples, e.g. the validation results of a calibration trial, are kept as JSON,
+    the samples following them are packed. Everything is kept as JSON if the samples cannot be packed.
+    """
+    if not isinstance(webgazer_data, list):
+        return webgazer_data, None
+    start = 0
+    while start < len(webgazer_data) and not is_sample(webgazer_data[start]):
+        start += 1
+    packed = pack_samples(webgazer_data[start:])
+    if packed is None:
+        return webgazer_data, None
+    return webgazer_data[:start], packed
+
+
+def decode_webgazer_data(webgazer_data, packed):
+    """
+    Returns the webgazer data of a trial as recorded, i.e. the values kept as JSON followed by the packed samples as dicts.
+    """
+    webgazer_data = list(webgazer_data or [])
+    if packed is not None:
+        columns = unpack_samples(packed)
+        webgazer_data += [dict(zip(SAMPLE_KEYS, values)) for values in zip(*[columns[key].tolist() for key in SAMPLE_KEYS])]
+    return webgazer_data
+
+
+def get_sample_columns(samples, packed=None):
+    """
+    Returns the gaze samples of a trial, given as dicts and/or packed, as a dictionary of arrays per key
+    and the number of samples. Values missing in some samples are left empty.
+    """
+    columns = {key: pd.Series([sample.get(key) for sample in samples]).to_numpy()
+               for key in dict.fromkeys(key for sample in samples for key in sample)}
+    length = len(samples)
+    if packed is not None:
+        packed_columns = unpack_samples(packed)
+        count = len(packed_columns['x'])
+        if not length:
+            return packed_columns, count
+        for key in dict.fromkeys(list(columns) + list(packed_columns)):
+            columns[key] = np.concatenate([columns.get(key, np.full(length, np.nan)),
+                                           packed_columns.get(key, np.full(count, np.nan))])
+        length += count
+    return columns, length
+
+
+def resample_gaze(t, x, y, rate):
+    """
+    Returns gaze resampled to a fixed rate (in Hz) as arrays of times (ms since the start of the gaze recording)
+    and x/y coordinates, holding the latest recorded sample. Coordinates are left empty (NaN) where no sample
+    was recorded within MAX_GAP_INTERVALS intervals before, e.g. while the face of the participant was not found.
+    """
+    interval = 1000 / rate
+    t, x, y = (np.asarray(values, dtype=float) for values in (t, x, y))
+    recorded = ~(np.isnan(t) | np.isnan(x) | np.isnan(y))
+    order = np.argsort(t[recorded], kind='stable')
+    t, x, y = t[recorded][order], x[recorded][order], y[recorded][order]
+    if not len(t):
+        return np.empty(0), np.empty(0), np.empty(0)
+
+    times = np.arange(int(t[-1] * rate // 1000) + 1) * 1000 / rate
+    index = np.searchsorted(t, times, side='right') - 1
+    held = (index >= 0)
+    held[held] = times[held] - t[index[held]] <= MAX_GAP_INTERVALS * interval
+    return times, np.where(held, x[index], np.nan), np.where(held, y[index], np.nan)
+
+
+def summarise_gaze(t, x, y, width, height, rows, cols, rate):
+    """
+    Returns a summary of the gaze of a trial on the areas of interest of its grid, computed from the gaze resampled
+    to `rate` Hz: the dwell time (ms), the time of the first look (ms) and the number of looks per area,
+    where a look is a run of resampled samples in the same area.
+    """
+    interval = 1000 / rate
+    times, x, y = resample_gaze(t, x, y, rate)
+    valid = ~np.isnan(x)
+    labels = np.full(len(times), '', dtype=object)
+    if valid.any():
+        labels[valid] = get_grid(width, height, rows, cols).label(x[valid], y[valid])
+    look_starts = valid & np.concatenate([[True], labels[1:] != labels[:-1]])[:len(labels)]
+
+    areas = {f'({r},{c})': None for r in range(1, rows + 1) for c in range(1, cols + 1)}
+    areas.update((label, None) for label in sorted(set(labels[valid])) if label not in areas)
+    for label in areas:
+        in_area = (labels == label)
+        areas[label] = {
+            'area': label,
+            'dwell': round(float(in_area.sum() * interval), 3),
+            'first_look': round(float(times[in_area.argmax()]), 3) if in_area.any() else None,
+            'looks': int((in_area & look_starts).sum()),
+        }
+    return {
+        'rate': rate,
+        'samples': len(t),
+        'valid': int(valid.sum()),
+        'duration': round(float(len(times) * interval), 3),
+        'areas': list(areas.values()),
+    }
+
+
+def summarise_trial(webgazer_data, packed, trialitem, width, height, rate):
+    """
+    Returns the gaze summary of a trial result (see `summarise_gaze`), or None if no gaze was recorded in the trial
+    or its grid does not fit the screen resolution. The validation results of a calibration trial are left out.
+    """
+    if not trialitem.record_gaze or (not webgazer_data and packed is None):
+        return None
+    samples = webgazer_data if isinstance(webgazer_data, list) else []
+    if trialitem.is_calibration and samples:
+        samples = samples[1:]
+    try:
+        columns, count = get_sample_columns([sample for sample in samples if isinstance(sample, dict)], packed)
+        empty = np.full(count, np.nan)
+        return summarise_gaze(columns.get('t', empty), columns.get('x', empty), columns.get('y', empty),
+                              width, height, trialitem.grid_row, trialitem.grid_col, rate)
+    except (ValueError, TypeError) as e:
+        logger.warning('Failed to summarise gaze: ' + str(e))
+        return None
+
+
+def count_packed_samples(header):
+    """
+    Returns the number of packed gaze samples given the first bytes of the packed data (at least HEADER.size).
+    """
+    if header is None:
+        return 0
+    return HEADER.unpack_from(header)[2]
+
+
+class JSONArrayLength(Func):
+    """
+    Returns the number of values of a JSON array in the database, or 0 if the value is not an array.
+    """
+    function = 'JSON_ARRAY_LENGTH'
+    output_field = IntegerField()
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template="CASE WHEN JSONB_TYPEOF(%(expressions)s) = 'array' "
+                                                         "THEN JSONB_ARRAY_LENGTH(%(expressions)s) ELSE 0 END", **extra_context)
@@ -0,0 +1,159 @@
+from collections import namedtuple
+from django.conf import settings
+
+import csv
+import os.path
+import threading
+import logging
+import pandas as pd
+
+# Create a logger for this file
+logger = logging.getLogger(__name__)
+
+# Words of an instrument in the order of its word list and IRT parameters, and the word id of each word
+WordList = namedtuple('WordList', ['words', 'word_ids'])
+
+# Norm tables of an instrument per sex, e.g. 'lm_np_mean' for the fields 'f_lm_np_mean' and 'm_lm_np_mean'
+NORM_TABLES = ('lm_np_mean', 'lm_np_sd', 'lm_p_mean', 'lm_p_sd', 'bmin', 'slope')
+FEMALE = 'f'
+MALE = 'm'
+
+
+class NormTable:
+    """
+    Values of a norm table of an instrument with a column per age (in months),
+    and rows which are looked up by word id if the table has a 'word_id' column.
+    """
+
+    def __init__(self, table):
+        self.rows = {}
+        if 'word_id' in table.columns:
+            self.rows = {int(word_id): row for row, word_id in reversed(list(enumerate(table['word_id'])))}
+        self.columns = {str(column): i for i, column in enumerate(table.columns)}
+        self.values = table.to_numpy()
+
+    def row(self, word_id):
+        """
+        Returns the row of a word, raising a KeyError if the table has no row for it.
+        """
+        return self.rows[word_id]
+
+    def at(self, row, age):
+        """
+        Returns the value of a row at an age, raising a KeyError if the table has no column for the age.
+        """
+        return self.values[row, self.columns[str(age)]]
+
+
+def read_word_list(path):
+    """
+    Returns the words of a word list with columns 'word' and 'word_id'.
+    """
+    with open(path, mode='r', encoding='utf-8-sig') as csv_file:
+        rows = list(csv.DictReader(csv_file, delimiter=','))
+    word_ids = {}
+    for row in rows:
+        word_ids[row['word']] = int(row['word_id'])
+    return WordList([row['word'] for row in rows], word_ids)
+
+
+def read_item_params(path):
+    """
+    Returns the IRT parameters stored in the second to fifth column of a csv file as an array with a row per item.
+    """
+    return pd.read_csv(path).iloc[:, 1:5].to_numpy()
+
+
+def read_norm_table(path):
+    """
+    Returns a norm table stored in a csv file (see `NormTable`).
+    """
+    return NormTable(pd.read_csv(path))
+
+
+class InstrumentCache:
+    """
+    Process-local cache of the parsed files of CDI instruments, so that the word lists, IRT parameters and norm tables
+    of an instrument are not read again for every participant.
+    Entries are keyed by instrument and field and are read again if the path or modification time of their file
+    changes, so that a replaced file is never served from the cache, even by processes which did not see
+    the instrument being saved.
+    """
+
+    readers = {
+        'words_list': read_word_list,
+        'irt_params': read_item_params,
+    }
+
+    def __init__(self):
+        self.files = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, instrument, field):
+        """
+        Returns the parsed file stored in a field of an instrument.
+        """
+        path = os.path.join(settings.MEDIA_ROOT, getattr(instrument, field).path)
+        version = (path, os.path.getmtime(path))
+        key = (instrument.pk, field)
+        with self.lock:
+            entry = self.files.get(key)
+            if entry is not None and entry[0] == version:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value = self.readers.get(field, read_norm_table)(path)
+        with self.lock:
+            self.files[key] = (version, value)
+        return value
+
+    def invalidate(self, instrument_id):
+        """
+        Removes the files of an instrument from the cache.
+        """
+        with self.lock:
+            for key in [key for key in self.files if key[0] == instrument_id]:
+                del self.files[key]
+
+    def clear(self):
+        """
+        Removes all files from the cache and resets its counters.
+        """
+        with self.lock:
+            self.files.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Returns the counters of the cache.
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.files)}
+
+
+instrument_cache = InstrumentCache()
+
+
+def get_word_list(instrument):
+    """
+    Returns the words of an instrument (see `WordList`).
+    """
+    return instrument_cache.get(instrument, 'words_list')
+
+
+def get_item_params(instrument):
+    """
+    Returns the IRT parameters of the items of an instrument as an array with a row per item.
+    """
+    return instrument_cache.get(instrument, 'irt_params')
+
+
+def get_norm_tables(instrument, sex):
+    """
+    Returns the norm tables of an instrument for children of a sex (FEMALE or MALE) as a dictionary of `NormTable`s.
+    """
+    return {table: instrument_cache.get(instrument, sex + '_' + table) for table in NORM_TABLES}
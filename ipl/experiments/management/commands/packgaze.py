@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from experiments.models import TrialResult
+from experiments.gaze import encode_webgazer_data
+
+import logging
+
+# Create a logger for this file
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Packs the gaze samples of trial results stored as JSON, which were recorded before samples were packed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of trial results loaded and updated at once.')
+
+    def pack_batch(self, last_pk, batch_size):
+        """
+        Packs the gaze samples of the trial results following `last_pk` and returns the last trial result
+        and the number of trial results updated.
+        """
+        with transaction.atomic():
+            trial_results = list(TrialResult.objects.select_for_update()
+                                                    .filter(pk__gt=last_pk, gaze_samples__isnull=True)
+                                                    .only('pk', 'webgazer_data', 'gaze_samples')
+                                                    .order_by('pk')[:batch_size])
+            packed = []
+            for trial_result in trial_results:
+                trial_result.webgazer_data, trial_result.gaze_samples = encode_webgazer_data(trial_result.webgazer_data)
+                if trial_result.gaze_samples is not None:
+                    packed.append(trial_result)
+            TrialResult.objects.bulk_update(packed, ['webgazer_data', 'gaze_samples'])
+        return (trial_results[-1].pk if trial_results else None), len(packed)
+
+    def handle(self, *args, **options):
+        last_pk = 0
+        total = 0
+        while last_pk is not None:
+            last_pk, count = self.pack_batch(last_pk, options['batch_size'])
+            total += count
+        logger.info('Packed the gaze samples of %d trial results.' % total)
+        self.stdout.write('Packed the gaze samples of %d trial results.' % total)
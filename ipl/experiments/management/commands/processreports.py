@@ -0,0 +1,88 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from experiments.models import ReportJob
+from experiments.reporter import Reporter
+from experiments.tidy import TidyReporter
+
+import datetime
+import logging
+import os
+import time
+
+# Create a logger for this file
+logger = logging.getLogger(__name__)
+
+# A running job whose progress has not been updated for this long is assumed to be interrupted
+STALE_AFTER = datetime.timedelta(minutes=10)
+
+
+class Command(BaseCommand):
+    help = 'Generates the reports requested on the admin site in the background.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Process all waiting reports and exit instead of waiting for new ones.')
+        parser.add_argument('--interval', type=int, default=5,
+                            help='Number of seconds to wait before checking for new reports.')
+        parser.add_argument('--workers', type=int,
+                            help='Number of processes rendering workbooks in parallel (default: the REPORT_WORKERS setting).')
+
+    def claim_job(self):
+        """
+        Marks the oldest waiting or interrupted job as running and returns it.
+        """
+        stale = timezone.now() - STALE_AFTER
+        with transaction.atomic():
+            job = ReportJob.objects.select_for_update(skip_locked=True) \
+                                   .filter(Q(status=ReportJob.PENDING) | Q(status=ReportJob.RUNNING, updated__lt=stale)) \
+                                   .order_by('created').first()
+            if job:
+                if job.status == ReportJob.RUNNING:
+                    logger.info('Resuming interrupted report %s.' % job.pk)
+                job.status = ReportJob.RUNNING
+                job.save(update_fields=['status', 'updated'])
+        return job
+
+    def run_job(self, job, workers=None):
+        """
+        Generates the report of a job and stores the result in the job.
+        """
+        try:
+            if job.report_format == ReportJob.WORKBOOKS:
+                reporter = Reporter(job.experiment, job, workers)
+            else:
+                reporter = TidyReporter(job.experiment, job, job.report_format)
+            filename = reporter.create_report()
+        except Exception as e:
+            logger.exception('Failed to create report %s: %s' % (job.pk, str(e)))
+            job.status = ReportJob.FAILED
+            job.error = str(e)
+            job.save(update_fields=['status', 'error', 'updated'])
+        else:
+            logger.info('Successfully created report with name %s.' % filename)
+            job.status = ReportJob.DONE
+            job.output_file = os.path.join(str(job.pk), os.path.basename(filename))
+            job.save(update_fields=['status', 'output_file', 'updated'])
+            self.remove_earlier_jobs(job)
+
+    def remove_earlier_jobs(self, job):
+        """
+        Deletes the finished and failed jobs of the experiment of a job requested before it in the same format,
+        together with their zip files, as they are superseded by the report of the job.
+        """
+        ReportJob.objects.filter(experiment=job.experiment_id, report_format=job.report_format,
+                                 status__in=[ReportJob.DONE, ReportJob.FAILED], created__lt=job.created).delete()
+
+    def handle(self, *args, **options):
+        while True:
+            job = self.claim_job()
+            if job:
+                self.stdout.write('Creating report of %s.' % job.experiment)
+                self.run_job(job, options['workers'])
+            elif options['once']:
+                break
+            else:
+                time.sleep(options['interval'])
@@ -0,0 +1,54 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from experiments.models import TrialResult
+
+import logging
+
+# Create a logger for this file
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Summarises the gaze of trial results on the areas of interest of their trials, e.g. for results recorded ' \
+           'before gaze was summarised or to summarise gaze at another sampling rate.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rate', type=int, default=None,
+                            help='Rate in Hz to which gaze is resampled (default: the GAZE_SAMPLING_RATE setting).')
+        parser.add_argument('--experiment',
+                            help='ID of the experiment whose trial results are summarised (default: all experiments).')
+        parser.add_argument('--all', action='store_true',
+                            help='Summarise trial results which have already been summarised again.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of trial results loaded and updated at once.')
+
+    def handle(self, *args, **options):
+        rate = options['rate'] or settings.GAZE_SAMPLING_RATE
+        queryset = TrialResult.objects.filter(trialitem__record_gaze=True) \
+                                      .select_related('trialitem') \
+                                      .only('pk', 'webgazer_data', 'gaze_samples', 'gaze_summary', 'resolution_w', 'resolution_h',
+                                            'trialitem__record_gaze', 'trialitem__is_calibration', 'trialitem__grid_row',
+                                            'trialitem__grid_col') \
+                                      .order_by('pk')
+        if options['experiment']:
+            queryset = queryset.filter(subject__experiment=options['experiment'])
+        if not options['all']:
+            queryset = queryset.filter(gaze_summary__isnull=True)
+
+        last_pk = 0
+        total = 0
+        while True:
+            trial_results = list(queryset.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not trial_results:
+                break
+            summarised = []
+            for trial_result in trial_results:
+                trial_result.summarise_gaze(rate)
+                if trial_result.gaze_summary is not None:
+                    summarised.append(trial_result)
+            TrialResult.objects.bulk_update(summarised, ['gaze_summary'])
+            total += len(summarised)
+            last_pk = trial_results[-1].pk
+        logger.info('Summarised the gaze of %d trial results at %d Hz.' % (total, rate))
+        self.stdout.write('Summarised the gaze of %d trial results at %d Hz.' % (total, rate))
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('experiments', '0064_reportjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportjob',
+            name='report_format',
+            field=models.CharField(choices=[('XLS', 'Workbooks per participant'), ('CSV', 'Tidy data (CSV)'), ('PAR', 'Tidy data (Parquet)')], default='XLS', max_length=3),
+        ),
+    ]
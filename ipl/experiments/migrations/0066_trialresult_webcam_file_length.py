@@ -0,0 +1,19 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import experiments.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('experiments', '0065_reportjob_report_format'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='trialresult',
+            name='webcam_file',
+            field=models.FileField(blank=True, max_length=255, null=True, upload_to=experiments.models.visual_folder),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('experiments', '0066_trialresult_webcam_file_length'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='listitem',
+            name='trial_plan',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('experiments', '0067_listitem_trial_plan'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subjectdata',
+            name='random_seed',
+            field=models.BigIntegerField(blank=True, editable=False, null=True, verbose_name='Random Seed'),
+        ),
+        migrations.AddField(
+            model_name='subjectdata',
+            name='trial_order',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
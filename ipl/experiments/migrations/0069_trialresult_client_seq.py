@@ -0,0 +1,22 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('experiments', '0068_subjectdata_trial_order'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trialresult',
+            name='client_seq',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='trialresult',
+            constraint=models.UniqueConstraint(fields=('subject', 'client_seq'), name='unique_trialresult_client_seq'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('experiments', '0071_trialresult_gaze_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='listitem',
+            name='trial_plan_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('experiments', '0072_listitem_trial_plan_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='trialresult',
+            name='client_seq',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+    ]
@@ -1,6 +1,6 @@
 from django.utils import timezone
 from django.db import models
-from django.db.models import Max
+from django.db.models import Max, F
 from django.contrib.auth.models import User
 from django.dispatch import receiver
 from django.conf import settings
@@ -13,11 +13,15 @@ from filebrowser.fields import FileBrowseField
 from tinymce import models as tinymce_models
 
 from .template_defaults import *
+from .template_cache import template_cache
+from .instruments import instrument_cache
+from .gaze import encode_webgazer_data, decode_webgazer_data, summarise_trial
 
 import datetime
 import uuid
 import os
 import random
+import shutil
 
 
 def experiment_folder(instance, filename):
@@ -187,6 +191,10 @@ class ListItem(models.Model):
     list_name = models.CharField(max_length=20)
     global_timeout = models.IntegerField('global timeout (ms)', default=300000)
     exclude_list = models.BooleanField('do not include this list', default=False)
+    # Compiled block/trial structure of the list, see `experiments.views.getTrialPlan`
+    trial_plan = models.JSONField(blank=True, null=True, editable=False)
+    # Incremented whenever the trial plan is invalidated, so that a plan compiled from outdated blocks/trials is not stored
+    trial_plan_version = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.list_name
@@ -298,6 +306,9 @@ class SubjectData(models.Model):
     updated = models.DateTimeField(auto_now=True)
     resolution_w = models.IntegerField('Resolution Width', default=0)
     resolution_h = models.IntegerField('Resolution Height', default=0)
+    # seed of the randomisation of blocks and trials and the resulting trial item ids in presented order, set at the first run
+    random_seed = models.BigIntegerField('Random Seed', blank=True, null=True, editable=False)
+    trial_order = models.JSONField(blank=True, null=True, editable=False)
 
     class Meta:
         verbose_name = "Participant data"
@@ -310,17 +321,32 @@ class TrialResult(models.Model):
     """
     A TrialResult is the data collected for a trial.
     """
+    # fields containing the webgazer data, which are deferred by queries not using it
+    GAZE_FIELDS = ('webgazer_data', 'gaze_samples')
+
     subject = models.ForeignKey(SubjectData, on_delete=models.CASCADE)
     trialitem = models.ForeignKey(TrialItem, on_delete=models.PROTECT)
     date = models.DateField(auto_now_add=True)
     start_time = models.FloatField(blank=True, null=True)
     end_time = models.FloatField(blank=True, null=True)
     key_pressed = models.CharField(blank=True, null=True, max_length=255)
-    webcam_file = models.FileField(upload_to=visual_folder, blank=True, null=True)
+    webcam_file = models.FileField(upload_to=visual_folder, blank=True, null=True, max_length=255)
     trial_number = models.IntegerField(default=0)
     resolution_w = models.IntegerField('Resolution width', default=0)
     resolution_h = models.IntegerField('Resolution height', default=0)
     webgazer_data = models.JSONField(blank=True, null=False, default=list)
+    # gaze samples following the values in webgazer_data, packed by experiments.gaze
+    gaze_samples = models.BinaryField(blank=True, null=True, editable=False)
+    # dwell times and first looks per area of interest, see experiments.gaze.summarise_gaze
+    gaze_summary = models.JSONField(blank=True, null=True, editable=False)
+    # sequence number of the result given by the experiment page (page load id and trial number),
+    # so that a result sent twice is stored once
+    client_seq = models.CharField(max_length=64, blank=True, null=True, editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['subject', 'client_seq'], name='unique_trialresult_client_seq'),
+        ]
 
     @property
     def filename(self):
@@ -329,6 +355,32 @@ class TrialResult(models.Model):
         """
         return os.path.basename(self.webcam_file.name)
 
+    @property
+    def has_webgazer_data(self):
+        """
+        Returns whether any webgazer data was recorded in the trial
+        """
+        return bool(self.webgazer_data) or self.gaze_samples is not None
+
+    def get_webgazer_data(self):
+        """
+        Returns the webgazer data of the trial as recorded, including the packed gaze samples
+        """
+        return decode_webgazer_data(self.webgazer_data, self.gaze_samples)
+
+    def set_webgazer_data(self, webgazer_data):
+        """
+        Stores the webgazer data of the trial, packing its gaze samples
+        """
+        self.webgazer_data, self.gaze_samples = encode_webgazer_data(webgazer_data)
+
+    def summarise_gaze(self, rate=None):
+        """
+        Stores the summary of the gaze on the areas of interest of the trial, resampled to `rate` Hz (default: GAZE_SAMPLING_RATE)
+        """
+        self.gaze_summary = summarise_trial(self.webgazer_data, self.gaze_samples, self.trialitem,
+                                            self.resolution_w, self.resolution_h, rate or settings.GAZE_SAMPLING_RATE)
+
 
 def _delete_file(path):
    """ 
@@ -345,6 +397,53 @@ def delete_file(sender, instance, *args, **kwargs):
     if instance.webcam_file.name:
         _delete_file(os.path.join(settings.WEBCAM_ROOT, instance.webcam_file.name))
 
+@receiver(models.signals.post_save, sender=Experiment, dispatch_uid='experiment_templates_save_signal')
+@receiver(models.signals.post_delete, sender=Experiment, dispatch_uid='experiment_templates_delete_signal')
+def invalidate_templates(sender, instance, *args, **kwargs):
+    """ 
+    Removes the compiled page templates of an experiment from the template cache on `post_save` and `post_delete` 
+    """
+    template_cache.invalidate(instance.pk)
+
+@receiver(models.signals.post_save, sender=Instrument, dispatch_uid='instrument_files_save_signal')
+@receiver(models.signals.post_delete, sender=Instrument, dispatch_uid='instrument_files_delete_signal')
+def invalidate_instrument_files(sender, instance, *args, **kwargs):
+    """ 
+    Removes the parsed files of an instrument from the instrument cache on `post_save` and `post_delete` 
+    """
+    instrument_cache.invalidate(instance.pk)
+
+def invalidate_trial_plans(experiment_lists):
+    """
+    Removes the compiled trial plans of the lists of an experiment, to be compiled again when they are next used.
+    """
+    ListItem.objects.filter(experiment__in=experiment_lists.values('experiment')) \
+                    .update(trial_plan=None, trial_plan_version=F('trial_plan_version') + 1)
+
+@receiver(models.signals.post_save, sender=OuterBlockItem, dispatch_uid='outerblockitem_plan_save_signal')
+@receiver(models.signals.post_delete, sender=OuterBlockItem, dispatch_uid='outerblockitem_plan_delete_signal')
+def invalidate_outer_block_plans(sender, instance, *args, **kwargs):
+    """ 
+    Removes the trial plans of the experiment of an outer block item on `post_save` and `post_delete` 
+    """
+    invalidate_trial_plans(ListItem.objects.filter(pk=instance.listitem_id))
+
+@receiver(models.signals.post_save, sender=BlockItem, dispatch_uid='blockitem_plan_save_signal')
+@receiver(models.signals.post_delete, sender=BlockItem, dispatch_uid='blockitem_plan_delete_signal')
+def invalidate_block_plans(sender, instance, *args, **kwargs):
+    """ 
+    Removes the trial plans of the experiment of a block item on `post_save` and `post_delete` 
+    """
+    invalidate_trial_plans(ListItem.objects.filter(outerblockitem=instance.outerblockitem_id))
+
+@receiver(models.signals.post_save, sender=TrialItem, dispatch_uid='trialitem_plan_save_signal')
+@receiver(models.signals.post_delete, sender=TrialItem, dispatch_uid='trialitem_plan_delete_signal')
+def invalidate_trial_item_plans(sender, instance, *args, **kwargs):
+    """ 
+    Removes the trial plans of the experiment of a trial item on `post_save` and `post_delete` 
+    """
+    invalidate_trial_plans(ListItem.objects.filter(outerblockitem__blockitem=instance.blockitem_id))
+
 def validate_list(value):
     """
     Takes a text value and verifies that there is at least 1 comma.
@@ -503,4 +602,79 @@ class CdiResult(models.Model):
     """
     subject = models.ForeignKey(SubjectData, on_delete=models.CASCADE)
     given_label = models.CharField('item', blank=True, null=True, max_length=255)
-    response = models.BooleanField(blank=True, null=True)
\ No newline at end of file
+    response = models.BooleanField(blank=True, null=True)
+
+
+class ReportJob(models.Model):
+    """
+    A ReportJob is a request for the results of an experiment.
+
+    Reports are generated in the background by the `processreports` management command.
+    As the workbooks of the participants are cached (see Reporter), an interrupted job 
+    is resumed without recreating the workbooks that were already written.
+    Instead of workbooks, a report can contain tidy tables of the whole experiment (see TidyReporter).
+    """
+    PENDING = 'PEN'
+    RUNNING = 'RUN'
+    DONE = 'FIN'
+    FAILED = 'ERR'
+
+    STATUS_OPTIONS = (
+     (PENDING, 'Waiting'),
+     (RUNNING, 'Running'),
+     (DONE, 'Done'),
+     (FAILED, 'Failed'),
+    )
+
+    WORKBOOKS = 'XLS'
+    CSV = 'CSV'
+    PARQUET = 'PAR'
+
+    FORMAT_OPTIONS = (
+     (WORKBOOKS, 'Workbooks per participant'),
+     (CSV, 'Tidy data (CSV)'),
+     (PARQUET, 'Tidy data (Parquet)'),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    experiment = models.ForeignKey(Experiment, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True)
+    status = models.CharField(max_length=3, choices=STATUS_OPTIONS, default=PENDING)
+    report_format = models.CharField(max_length=3, choices=FORMAT_OPTIONS, default=WORKBOOKS)
+    total = models.IntegerField('number of participants', default=0)
+    completed = models.IntegerField('number of completed participants', default=0)
+    output_file = models.CharField(max_length=255, blank=True)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['created']
+
+    def __str__(self):
+        return '%s (%s)' % (self.experiment, self.get_status_display())
+
+    @property
+    def folder(self):
+        """
+        Returns the folder containing the zip file of the report.
+        """
+        return os.path.join(settings.REPORTS_ROOT, str(self.id))
+
+    @property
+    def progress(self):
+        """
+        Returns the percentage of participants whose results have been written.
+        """
+        if self.status == ReportJob.DONE:
+            return 100
+        if not self.total:
+            return 0
+        return int(100 * self.completed / self.total)
+
+@receiver(models.signals.post_delete, sender=ReportJob, dispatch_uid='reportjob_folder_delete_signal')
+def delete_report_folder(sender, instance, *args, **kwargs):
+    """ 
+    Deletes the folder containing the zip file of a report on `post_delete` 
+    """
+    shutil.rmtree(instance.folder, ignore_errors=True)
\ No newline at end of file
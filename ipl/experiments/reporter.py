@@ -1,23 +1,181 @@
 from django.conf import settings
 from django.utils.text import get_valid_filename
 from django.core.exceptions import ObjectDoesNotExist
-from .models import SubjectData, OuterBlockItem, BlockItem, TrialResult, AnswerBase, AnswerText, AnswerInteger, \
-                    Question, AnswerRadio, AnswerSelect, AnswerSelectMultiple, ConsentQuestion, CdiResult
-
+from django.db.models import F, Window
+from django.db import connections
+from django.db.models.functions import RowNumber
+from .models import SubjectData, ListItem, OuterBlockItem, BlockItem, TrialItem, TrialResult, AnswerBase, AnswerText, \
+                    AnswerInteger, Question, AnswerRadio, AnswerSelect, AnswerSelectMultiple, ConsentQuestion, CdiResult
+from .aoi import get_grid
+from .gaze import get_sample_columns
+from .archive import write_archive, stream_archive
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+import django
 import datetime
+import hashlib
+import io
 import uuid
 import os
-import zipfile
 import xlsxwriter
 import shutil
 import re
 import logging
+import numpy as np
 import pandas as pd
 import simplejson as json
 
 # Create a logger for this file
 logger = logging.getLogger(__name__)
 
+# Increase whenever the content of the workbooks changes, so that cached workbooks are recreated
+WORKBOOK_VERSION = 2
+
+# Number of participants whose trial results are loaded at once
+BATCH_SIZE = 20
+
+
+def create_gaze_frames(trial_results, id_columns=()):
+    """
+    Returns the eye-tracking results and the validation results of the given trial results as two data frames.
+    The values of each trial are converted to arrays, which are concatenated once per column at the end,
+    instead of concatenating a data frame per trial.
+    `id_columns` are (column, function) pairs of columns inserted first, e.g. identifying the participant of a result.
+    """
+    trial_info = []
+    lengths = []
+    gaze_columns = {}
+    areas = []
+    validation_frames = []
+    for result in trial_results:
+        # skip trials where gaze is not recorded
+        if (not result.trialitem.record_gaze) or (not result.webgazer_data and result.gaze_samples is None):
+            continue
+        trialitem = result.trialitem
+        samples = result.webgazer_data or []
+        if trialitem.is_calibration and samples:
+            samples = samples[1:]
+            validation = {key: value for key, value in result.webgazer_data[0].items() if key != 'trial_type'}
+            curr_validation_data = pd.DataFrame(validation)
+            for i, (column, value) in enumerate(id_columns):
+                curr_validation_data.insert(i, column, value(result))
+            curr_validation_data.insert(len(id_columns), 'Trial Number', result.report_trial_number)
+            curr_validation_data.insert(len(id_columns) + 1, 'Trial Label', trialitem.label)
+            curr_validation_data.insert(len(id_columns) + 2, 'Trial Code', trialitem.code)
+            validation_frames.append(curr_validation_data)
+
+        # convert the recorded values of this trial to an array per column, or read them from the packed samples,
+        # leaving values missing in some samples or trials empty
+        sample_columns, num_samples = get_sample_columns(samples, result.gaze_samples)
+        for key, values in sample_columns.items():
+            if key not in gaze_columns:
+                gaze_columns[key] = [np.full(length, np.nan) for length in lengths]
+            gaze_columns[key].append(values)
+        for values in gaze_columns.values():
+            if len(values) == len(lengths):
+                values.append(np.full(num_samples, np.nan))
+
+        if (trialitem.grid_row != 1 or trialitem.grid_col != 1) and num_samples:
+            grid = get_grid(result.resolution_w, result.resolution_h, trialitem.grid_row, trialitem.grid_col)
+            areas.append(grid.label(gaze_columns['x'][-1], gaze_columns['y'][-1]))
+        else:
+            areas.append(np.full(num_samples, '', dtype=object))
+        trial_info.append([value(result) for column, value in id_columns] +
+                          [result.report_trial_number, trialitem.label, trialitem.code, trialitem.grid_row, trialitem.grid_col])
+        lengths.append(num_samples)
+
+    if not trial_info:
+        return [pd.DataFrame(), pd.DataFrame()]
+
+    # repeat the values of each trial for all its samples and join the arrays of all trials,
+    # releasing the arrays of the trials once they have been joined
+    trial_columns = [column for column, value in id_columns] + ['Trial Number', 'Trial Label', 'Trial Code']
+    trial_data = pd.DataFrame(trial_info, columns=trial_columns + ['Nrows', 'Ncols'])
+    columns = {column: np.repeat(trial_data.pop(column).to_numpy(), lengths) for column in trial_columns}
+    for key in list(gaze_columns):
+        columns[key] = np.concatenate(gaze_columns.pop(key))
+    for column in ['Nrows', 'Ncols']:
+        columns[column] = np.repeat(trial_data.pop(column).to_numpy(), lengths)
+    columns['Gaze Area (row,col)'] = np.concatenate(areas)
+    del areas
+    webgazer_data = pd.DataFrame(columns, copy=False)
+    validation_data = pd.concat(validation_frames) if validation_frames else pd.DataFrame()
+    return [webgazer_data, validation_data]
+
+
+def create_gaze_summary_frame(trial_results, id_columns=()):
+    """
+    Returns the stored gaze summaries of the given trial results as a data frame with a row per trial and area of interest,
+    without reading the recorded gaze samples. `id_columns` are inserted first, see `create_gaze_frames`.
+    """
+    rows = []
+    for result in trial_results:
+        summary = result.gaze_summary
+        if not result.trialitem.record_gaze or not summary:
+            continue
+        trialitem = result.trialitem
+        for area in summary['areas']:
+            rows.append([value(result) for column, value in id_columns] +
+                        [result.report_trial_number, trialitem.label, trialitem.code, trialitem.grid_row, trialitem.grid_col,
+                         summary['rate'], area['area'], area['dwell'], area['first_look'], area['looks']])
+    if not rows:
+        return pd.DataFrame()
+    return pd.DataFrame(rows, columns=[column for column, value in id_columns] +
+                                      ['Trial Number', 'Trial Label', 'Trial Code', 'Nrows', 'Ncols', 'Sampling Rate (Hz)',
+                                       'Gaze Area (row,col)', 'Dwell Time (ms)', 'First Look (ms)', 'Looks'])
+
+
+def gaze_trial(result):
+    """
+    Returns the values of a trial result used in the eye-tracking worksheets, without the rest of the model instances.
+    """
+    trialitem = result.trialitem
+    return SimpleNamespace(
+        trialitem=SimpleNamespace(label=trialitem.label, code=trialitem.code, record_gaze=trialitem.record_gaze, 
+                                  is_calibration=trialitem.is_calibration, grid_row=trialitem.grid_row, 
+                                  grid_col=trialitem.grid_col),
+        webgazer_data=result.webgazer_data,
+        gaze_samples=bytes(result.gaze_samples) if result.gaze_samples is not None else None,
+        gaze_summary=result.gaze_summary,
+        report_trial_number=result.report_trial_number,
+        resolution_w=result.resolution_w,
+        resolution_h=result.resolution_h,
+    )
+
+
+def render_workbook_data(workbook_data):
+    """
+    Returns the content of an excel report created from the data returned by `Reporter.get_workbook_data`.
+    Does not access the database, so that workbooks can be rendered in worker processes.
+    """
+    output = io.BytesIO()
+
+    # Create Pandas Excel writer using XlsxWriter as the engine
+    writer = pd.ExcelWriter(output, engine='xlsxwriter')
+    writer.book.set_properties({'created': workbook_data['created']})
+
+    # Create subject data worksheet
+    pd.DataFrame.from_dict(workbook_data['subject_data'], orient='index').to_excel(writer, sheet_name='Participant', header=False)
+
+    if workbook_data['trial_data'] is not None:
+        # Create trial data worksheet
+        pd.DataFrame(workbook_data['trial_data'], columns=Reporter.trial_columns).to_excel(writer, sheet_name='Trials', index=False)
+        if workbook_data['gaze_trials'] is not None:
+            # Create webgazer worksheet
+            webgazer_worksheets = create_gaze_frames(workbook_data['gaze_trials'])
+            webgazer_worksheets[0].to_excel(writer, sheet_name='EyeTrackingData', index=False)
+            webgazer_worksheets[1].to_excel(writer, sheet_name='EyeTrackingValidation', index=False)
+            create_gaze_summary_frame(workbook_data['gaze_trials']).to_excel(writer, sheet_name='EyeTrackingSummary', index=False)
+
+    # Close the Pandas Excel writer
+    writer.close()
+
+    return output.getvalue()
+
+
 class Reporter:
     """
     Utility for generating results as a zip file to be downloaded.
@@ -49,28 +207,34 @@ class Reporter:
         'Record Gaze',
     ]
 
-    def __init__(self, experiment):
+    def __init__(self, experiment, job=None, workers=None):
         self.experiment = experiment
+        self.job = job
+
+        # Number of processes rendering workbooks in parallel, see iter_workbooks()
+        self.workers = workers if workers is not None else settings.REPORT_WORKERS
 
         # Define report folders
         self.output_file = get_valid_filename(experiment.exp_name + '.zip')
-        self.output_folder = settings.REPORTS_ROOT
+        self.output_folder = job.folder if job else settings.REPORTS_ROOT
+        os.makedirs(self.output_folder, exist_ok=True)
 
-        # Create random folder
-        self.tmp_folder = str(uuid.uuid4())
-        os.makedirs(os.path.join(self.output_folder, self.tmp_folder))
+        # Workbooks are cached per participant and only recreated when the participant's data changes
+        self.cache_folder = os.path.join(settings.REPORTS_CACHE_ROOT, str(experiment.pk))
 
-        # Create zip file, delete if already exists
-        try:
-            os.remove(os.path.join(self.output_folder, self.output_file))
-        except OSError:
-            pass
-        self.zip_file = zipfile.ZipFile(os.path.join(self.output_folder, self.output_file),
-                                        "w", zipfile.ZIP_DEFLATED)
+        # Blocks of each list, see get_blocks()
+        self.blocks = {}
+
+        # Trial results of the participants whose workbooks are being created, see load_trial_results()
+        self.trial_results = {}
+
+        # Answers and CDI results of the participants whose workbooks are being created, see load_answers()
+        self.answers = {}
+        self.cdi_results = {}
 
-        # Create webcam directory if it doesn't exist
-        if not os.path.exists('webcam'):
-            os.makedirs('webcam')
+        # Questions and consent questions of the experiment, see get_question() and get_consent_questions()
+        self.questions = None
+        self.consent_questions = None
 
 
     def calc_trial_duration(self, t1, t2):
@@ -86,23 +250,9 @@ class Reporter:
         """
         Determines row and col responded to (click/gaze) based on grid size defined for the trial. 
         """
-        width = result.resolution_w
-        height = result.resolution_h
-        boundaries_r = list(range(0, height, int(height/result.trialitem.grid_row)))
-        boundaries_r.append(height)
-        boundaries_c = list(range(0, width, int(width/result.trialitem.grid_col)))
-        boundaries_c.append(width)
-
         if len(coords) == 2:
-            if coords[0] > max(boundaries_c):
-                col_num = len(boundaries_c) - 1
-            else:
-                col_num = next(i for i,c in enumerate(boundaries_c) if c >= coords[0])
-            if coords[1] > max(boundaries_r):
-                row_num = len(boundaries_r) - 1
-            else:
-                row_num = next(i for i,r in enumerate(boundaries_r) if r >= coords[1])
-            return f'({row_num},{col_num})'
+            grid = get_grid(result.resolution_w, result.resolution_h, result.trialitem.grid_row, result.trialitem.grid_col)
+            return grid.label(coords[0], coords[1])
         return ''
 
     
@@ -117,13 +267,21 @@ class Reporter:
         Creates a dataframe for each participant containing the data 
         obtained from the consent form and the demographic/participant data form.
         """
+        return pd.DataFrame.from_dict(self.get_subject_data(subject), orient='index')
+
+
+    def get_subject_data(self, subject):
+        """
+        Returns a dictionary containing the data of a participant obtained from the consent form 
+        and the demographic/participant data form.
+        """
         gcd = self.gcd(subject.resolution_w, subject.resolution_h)
         if gcd == 0:
             gcd = 1
         try:
             subject_data = {
                 'Report Date': datetime.datetime.now().strftime("%d.%m.%Y %H:%M:%S"),
-                'Experiment Name': subject.experiment.exp_name,
+                'Experiment Name': self.experiment.exp_name,
                 'Global Timeout': subject.listitem.global_timeout if subject.listitem else '',
                 'List': subject.listitem.list_name if subject.listitem else '',
                 'Participant Number': subject.participant_id,
@@ -131,69 +289,210 @@ class Reporter:
                 'Participation Date': subject.created.strftime("%d.%m.%Y %H:%M:%S"),
                 'Aspect Ratio': f'{int(subject.resolution_h / gcd)}:{int(subject.resolution_w / gcd)}',
                 'Resolution': f'{subject.resolution_w}x{subject.resolution_h}',
+                'Random Seed': subject.random_seed if subject.random_seed is not None else '',
                 'Consent Questions': '',
             }
         
-            consent_questions = ConsentQuestion.objects.filter(experiment_id=subject.experiment.id)
-            for consent_question in consent_questions:
+            for consent_question in self.get_consent_questions():
                 # format dictionary key with pos to ensure uniqueness 
                 subject_data[f'{consent_question.position + 1}. {consent_question.text}'] = 'Y'
 
-            answer_bases = AnswerBase.objects.filter(subject_data_id=subject.id)
             subject_data['Participant Form Responses'] = ''
-            for answer_base in answer_bases:
+            for question_id, bodies in self.get_answers(subject):
+                question = self.get_question(question_id)
                 value = ''
-                if answer_base.question.question_type == Question.TEXT:
-                    value = str(AnswerText.objects.get(pk=answer_base.pk).body)
-                elif answer_base.question.question_type == Question.AGE:
-                    if AnswerText.objects.filter(pk=answer_base.pk).first():
-                        value = str(AnswerText.objects.get(pk=answer_base.pk).body)
+                if question.question_type == Question.TEXT:
+                    value = str(self.get_answer_body(bodies, AnswerText))
+                elif question.question_type == Question.AGE:
+                    if AnswerText in bodies:
+                        value = str(bodies[AnswerText])
                         dob = datetime.date.fromisoformat(value)
                         value += ' (' + str(round(((subject.created.date() - dob).days)/(365/12))) + ' mo.)'
                     else:
-                        value = str(AnswerInteger.objects.get(pk=answer_base.pk).body)
-                elif answer_base.question.question_type == Question.INTEGER or answer_base.question.question_type == Question.NUM_RANGE:
-                    value = str(AnswerInteger.objects.get(pk=answer_base.pk).body)
-                elif answer_base.question.question_type == Question.RADIO or answer_base.question.question_type == Question.SEX:
-                    value = str(AnswerRadio.objects.get(pk=answer_base.pk).body)
-                elif answer_base.question.question_type == Question.SELECT:
-                    value = str(AnswerSelect.objects.get(pk=answer_base.pk).body)
-                elif answer_base.question.question_type == Question.SELECT_MULTIPLE:
-                    value = str(AnswerSelectMultiple.objects.get(pk=answer_base.pk).body)
+                        value = str(self.get_answer_body(bodies, AnswerInteger))
+                elif question.question_type == Question.INTEGER or question.question_type == Question.NUM_RANGE:
+                    value = str(self.get_answer_body(bodies, AnswerInteger))
+                elif question.question_type == Question.RADIO or question.question_type == Question.SEX:
+                    value = str(self.get_answer_body(bodies, AnswerRadio))
+                elif question.question_type == Question.SELECT:
+                    value = str(self.get_answer_body(bodies, AnswerSelect))
+                elif question.question_type == Question.SELECT_MULTIPLE:
+                    value = str(self.get_answer_body(bodies, AnswerSelectMultiple))
                 # format dictionary key with pos to ensure uniqueness 
-                subject_data[f'{answer_base.question.position + 1}. {answer_base.question.text}'] = value
+                subject_data[f'{question.position + 1}. {question.text}'] = value
 
-            cdi_results = CdiResult.objects.filter(subject=subject.id)
             subject_data['CDI estimate'] = subject.cdi_estimate
-            subject_data['CDI instrument'] = subject.experiment.instrument.instr_name if subject.experiment.instrument else ''
-            for cdi_result in cdi_results:
-                subject_data[cdi_result.given_label] = cdi_result.response
+            subject_data['CDI instrument'] = self.experiment.instrument.instr_name if self.experiment.instrument else ''
+            for given_label, response in self.get_cdi_results(subject):
+                subject_data[given_label] = response
         except ObjectDoesNotExist as e:
             logger.exception('Object does not exist: ' + str(e))
         finally:
-            return pd.DataFrame.from_dict(subject_data, orient='index')
+            return subject_data
+
+
+    def get_consent_questions(self):
+        """
+        Returns the consent questions of the experiment, loaded once per report.
+        """
+        if self.consent_questions is None:
+            self.consent_questions = list(ConsentQuestion.objects.filter(experiment_id=self.experiment.pk))
+        return self.consent_questions
+
+
+    def get_question(self, question_id):
+        """
+        Returns a question of the participant data form, the questions of the experiment being loaded once per report.
+        """
+        if self.questions is None:
+            self.questions = Question.objects.filter(experiment_id=self.experiment.pk).in_bulk()
+        if question_id not in self.questions:
+            self.questions[question_id] = Question.objects.get(pk=question_id)
+        return self.questions[question_id]
+
+
+    def load_answers(self, subjects):
+        """
+        Loads the answers to the participant data form and the CDI results of several participants, 
+        in a query per type of answer.
+
+        The answers of a participant are stored as a list of (question ID, bodies) pairs, 
+        where bodies maps each answer model to the body of the answer.
+        """
+        subject_ids = [subject.id for subject in subjects]
+        answers = {subject_id: [] for subject_id in subject_ids}
+        answer_bodies = {}
+        for answer_id, subject_id, question_id in AnswerBase.objects.filter(subject_data__in=subject_ids).order_by('pk') \
+                                                                     .values_list('pk', 'subject_data', 'question'):
+            answer_bodies[answer_id] = {}
+            answers[subject_id].append((question_id, answer_bodies[answer_id]))
+        for model in [AnswerText, AnswerInteger, AnswerRadio, AnswerSelect, AnswerSelectMultiple]:
+            for answer_id, body in model.objects.filter(subject_data__in=subject_ids).values_list('pk', 'body'):
+                answer_bodies[answer_id][model] = body
+        self.answers.update(answers)
+
+        cdi_results = {subject_id: [] for subject_id in subject_ids}
+        for subject_id, given_label, response in CdiResult.objects.filter(subject__in=subject_ids).order_by('pk') \
+                                                                  .values_list('subject', 'given_label', 'response'):
+            cdi_results[subject_id].append((given_label, response))
+        self.cdi_results.update(cdi_results)
+
+
+    def get_answers(self, subject):
+        """
+        Returns the answers of a participant to the participant data form, see load_answers().
+        """
+        if subject.id not in self.answers:
+            self.load_answers([subject])
+        return self.answers[subject.id]
+
+
+    def get_answer_body(self, bodies, model):
+        """
+        Returns the body of an answer stored as the given answer model.
+        """
+        if model not in bodies:
+            raise model.DoesNotExist('%s matching query does not exist.' % model._meta.object_name)
+        return bodies[model]
+
+
+    def get_cdi_results(self, subject):
+        """
+        Returns the (item, response) pairs of a participant's CDI results, see load_answers().
+        """
+        if subject.id not in self.cdi_results:
+            self.load_answers([subject])
+        return self.cdi_results[subject.id]
+
+
+    def load_batch(self, subjects):
+        """
+        Loads the trial results, answers and CDI results of several participants.
+        """
+        self.load_trial_results([subject for subject in subjects if subject.listitem_id])
+        self.load_answers(subjects)
+
+
+    def release_batch(self, subjects):
+        """
+        Releases the trial results, answers and CDI results of participants whose results have been written.
+        """
+        for subject in subjects:
+            self.trial_results.pop(subject.id, None)
+            self.answers.pop(subject.id, None)
+            self.cdi_results.pop(subject.id, None)
+
+
+    def get_blocks(self, listitem_id):
+        """
+        Returns a dictionary of the (inner) blocks of a list, including their outer blocks.
+        Blocks are only loaded once per list.
+        """
+        if listitem_id not in self.blocks:
+            self.blocks[listitem_id] = BlockItem.objects.filter(outerblockitem__listitem=listitem_id) \
+                                                        .select_related('outerblockitem').in_bulk()
+        return self.blocks[listitem_id]
+
+
+    def load_trial_results(self, subjects):
+        """
+        Loads the trial results of several participants, including their trials, in a single query.
+
+        If the trial numbers of a participant are not unique, the trial number of each trial result
+        is inferred from its position among the participant's trial results.
+        """
+        trial_results = {subject.id: [] for subject in subjects}
+        queryset = TrialResult.objects.filter(subject__in=list(trial_results.keys()), 
+                                              trialitem__blockitem__outerblockitem__listitem=F('subject__listitem')) \
+                                      .select_related('trialitem') \
+                                      .annotate(inferred_trial_number=Window(expression=RowNumber(), partition_by=[F('subject')], 
+                                                                             order_by=F('pk').asc())) \
+                                      .order_by('pk', 'trial_number')
+        if self.experiment.recording_option not in ['EYE', 'ALL']:
+            # the webgazer data is only used in the eye-tracking worksheets
+            queryset = queryset.defer(*TrialResult.GAZE_FIELDS)
+        for result in queryset:
+            trial_results[result.subject_id].append(result)
+
+        for results in trial_results.values():
+            trial_numbers = [result.trial_number for result in results]
+            unique_trial_number = (len(trial_numbers) == len(set(trial_numbers))) # need to infer trial number if non-unique
+            for result in results:
+                result.report_trial_number = result.trial_number if unique_trial_number else result.inferred_trial_number
+        self.trial_results.update(trial_results)
+
+
+    def get_trial_results(self, subject):
+        """
+        Returns the trial results of a participant, shared by the trial and eye-tracking worksheets.
+        """
+        if subject.id not in self.trial_results:
+            self.load_trial_results([subject])
+        return self.trial_results[subject.id]
 
 
     def create_trial_worksheet(self, subject):
         """
-        Creates a dataframe per participant containing the trial results
-        and adds the corresponding webcam/audio files to the final zip file.
+        Creates a dataframe per participant containing the trial results.
+        """
+        return pd.DataFrame(self.get_trial_data(subject), columns=self.trial_columns)
+
+
+    def get_trial_data(self, subject):
+        """
+        Returns a row per trial result of a participant, containing the values of the trial columns.
         """
         trial_data = []
-        outer_blocks_pk = list(OuterBlockItem.objects.filter(listitem__pk=subject.listitem.pk).values_list('pk', flat=True))
-        blocks_pk = list(BlockItem.objects.filter(outerblockitem__pk__in=outer_blocks_pk).values_list('pk', flat=True))
-        trial_results = TrialResult.objects.filter(trialitem__blockitem__pk__in=blocks_pk, subject_id=subject.id).order_by('pk', 'trial_number')
-        trial_numbers = trial_results.values_list('trial_number', flat=True) 
-        unique_trial_number = (len(trial_numbers) == len(set(trial_numbers))) # need to infer trial number if non-unique
-        for result in trial_results:
+        blocks = self.get_blocks(subject.listitem_id)
+        for result in self.get_trial_results(subject):
             audio_file = result.trialitem.audio_file
             coords = list(map(int, re.findall(r'\d+', result.key_pressed)))
-            block = result.trialitem.blockitem
+            block = blocks[result.trialitem.blockitem_id]
             trial_data.append([
                 block.outerblockitem.outer_block_name,
                 block.label,
                 block.randomise_trials,
-                (result.trial_number if unique_trial_number else (trial_results.filter(pk__lt = result.pk).count() + 1)),
+                result.report_trial_number,
                 result.trialitem.label,
                 result.trialitem.code,
                 result.trialitem.visual_onset,
@@ -207,108 +506,296 @@ class Reporter:
                 result.trialitem.grid_col,
                 (self.calc_roi_response(result, coords) if 'mouse' in result.key_pressed and (result.trialitem.grid_row != 1 or result.trialitem.grid_col != 1) else ''),
                 self.calc_trial_duration(result.start_time, result.end_time),
-                (block.outerblockitem.listitem.experiment.recording_option in ['AUD', 'VID'] and result.trialitem.record_media),
+                (self.experiment.recording_option in ['AUD', 'VID'] and result.trialitem.record_media),
                 result.webcam_file.name,
                 result.resolution_w,
                 result.resolution_h,
-                (block.outerblockitem.listitem.experiment.recording_option in ['EYE', 'ALL'] and result.trialitem.record_gaze),
+                (self.experiment.recording_option in ['EYE', 'ALL'] and result.trialitem.record_gaze),
             ])
-                
-            # Add webcam file to zip
-            self.zip_file.write(os.path.join("webcam", result.webcam_file.name),
-                                result.webcam_file.name)
 
-        return pd.DataFrame(trial_data, columns=self.trial_columns)
+        return trial_data
 
 
     def create_webgazer_worksheet(self, subject):
         """
         Creates a worksheet per participant containing the eye-tracking results.
         """
-        
-        outer_blocks_pk = list(OuterBlockItem.objects.filter(listitem__pk=subject.listitem.pk).values_list('pk',flat=True))
-        blocks_pk = list(BlockItem.objects.filter(outerblockitem__pk__in=outer_blocks_pk).values_list('pk', flat=True))
-        trial_results = TrialResult.objects.filter(trialitem__blockitem__pk__in=blocks_pk, subject_id=subject.id).order_by('pk', 'trial_number')
-        trial_numbers = trial_results.values_list('trial_number', flat=True) 
-        unique_trial_number = (len(trial_numbers) == len(set(trial_numbers))) # need to infer trial number if non-unique
-        validation_data = pd.DataFrame()
-        webgazer_data = pd.DataFrame()
-        logger.info(trial_results)
-        for result in trial_results:
-            # skip trials where gaze is not recorded
-            if (not result.trialitem.record_gaze) or (not result.webgazer_data):
-                continue
-            trial_number = (result.trial_number if unique_trial_number else (trial_results.filter(pk__lt = result.pk).count() + 1))
-            if result.trialitem.is_calibration:
-                curr_webgazer_data = pd.read_json(json.dumps(result.webgazer_data[1:]))
-                curr_validation_data = pd.read_json(json.dumps(result.webgazer_data[0])).drop(columns=['trial_type'])
-                curr_validation_data.insert(0, 'Trial Number', trial_number)
-                curr_validation_data.insert(1, 'Trial Label', result.trialitem.label)
-                curr_validation_data.insert(2, 'Trial Code', result.trialitem.code)
-                validation_data = pd.concat([
-                    validation_data, 
-                    curr_validation_data,
-                ])
-            else:
-                curr_webgazer_data = pd.read_json(json.dumps(result.webgazer_data))
-            curr_webgazer_data.insert(0, 'Trial Number', trial_number)
-            curr_webgazer_data.insert(1, 'Trial Label', result.trialitem.label)
-            curr_webgazer_data.insert(2, 'Trial Code', result.trialitem.code)
-            curr_webgazer_data['Nrows'] = result.trialitem.grid_row
-            curr_webgazer_data['Ncols'] = result.trialitem.grid_col
-            if (result.trialitem.grid_row != 1 or result.trialitem.grid_col != 1):
-                curr_webgazer_data['Gaze Area (row,col)'] = curr_webgazer_data.apply(lambda x: self.calc_roi_response(result, [x.x, x.y]), axis=1)
+        return create_gaze_frames(self.get_trial_results(subject))
+
+
+    def get_workbook_filename(self, subject):
+        """
+        Returns the name of the excel report of a participant.
+        """
+        workbook_file = str(subject.participant_id) + '_' + \
+            self.experiment.exp_name + '_' + subject.created.strftime('%Y%m%d') + \
+                '_' + subject.id + '.xlsx'
+        return get_valid_filename(workbook_file)
+
+
+    def get_workbook_data(self, subject):
+        """
+        Returns the data shown in the excel report of a participant, 
+        which is rendered by `render_workbook_data`, possibly in another process.
+        """
+        workbook_data = {
+            'created': datetime.datetime.now(),
+            'subject_data': self.get_subject_data(subject),
+            'trial_data': None,
+            'gaze_trials': None,
+        }
+        if subject.listitem:
+            workbook_data['trial_data'] = self.get_trial_data(subject)
+            if self.experiment.recording_option in ['EYE', 'ALL']:
+                workbook_data['gaze_trials'] = [gaze_trial(result) for result in self.get_trial_results(subject)
+                                                if result.trialitem.record_gaze and result.has_webgazer_data]
+        return workbook_data
+
+
+    def render_workbook(self, subject):
+        """
+        Returns the content of the excel report of a participant, created in memory.
+        """
+        data = render_workbook_data(self.get_workbook_data(subject))
+
+        # Release the participant's results
+        self.release_batch([subject])
+
+        return data
+
+
+    def store_workbook(self, path, data):
+        """
+        Stores the excel report of a participant in the cache and removes the participant's outdated reports.
+        """
+        subject_folder = os.path.dirname(path)
+        os.makedirs(subject_folder, exist_ok=True)
+
+        # Write to a temporary file first, so that an interrupted report never leaves an incomplete workbook behind
+        root, extension = os.path.splitext(path)
+        tmp_path = root + '.' + uuid.uuid4().hex + '.tmp' + extension
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        for fname in os.listdir(subject_folder):
+            if fname != os.path.basename(path) and not fname.endswith('.tmp.xlsx'):
+                os.remove(os.path.join(subject_folder, fname))
+
+
+    def get_experiment_fingerprint(self):
+        """
+        Returns a hash of the experiment settings that appear in the workbooks.
+        """
+        experiment_data = [
+            WORKBOOK_VERSION,
+            self.experiment.exp_name,
+            self.experiment.recording_option,
+            self.experiment.instrument.instr_name if self.experiment.instrument else '',
+            list(ConsentQuestion.objects.filter(experiment=self.experiment.pk).order_by('pk').values_list('pk', 'position', 'text')),
+            list(Question.objects.filter(experiment=self.experiment.pk).order_by('pk').values_list('pk', 'position', 'text', 'question_type')),
+            list(ListItem.objects.filter(experiment=self.experiment.pk).order_by('pk').values_list('pk', 'list_name', 'global_timeout')),
+            list(OuterBlockItem.objects.filter(listitem__experiment=self.experiment.pk).order_by('pk').values_list('pk', 'outer_block_name')),
+            list(BlockItem.objects.filter(outerblockitem__listitem__experiment=self.experiment.pk).order_by('pk') \
+                                  .values_list('pk', 'outerblockitem', 'label', 'randomise_trials')),
+            list(TrialItem.objects.filter(blockitem__outerblockitem__listitem__experiment=self.experiment.pk).order_by('pk') \
+                                  .values_list('pk', 'blockitem', 'label', 'code', 'visual_onset', 'audio_onset', 'visual_file',
+                                               'audio_file', 'max_duration', 'user_input', 'grid_row', 'grid_col', 
+                                               'record_media', 'record_gaze', 'is_calibration')),
+        ]
+        return hashlib.sha1(json.dumps(experiment_data, default=str).encode('utf-8')).hexdigest()
+
+
+    def get_subject_fingerprints(self, subjects):
+        """
+        Returns a dictionary mapping each participant's ID to a hash of the participant's data 
+        (including trial results, CDI results and answers) and the experiment settings.
+        """
+        experiment_fingerprint = self.get_experiment_fingerprint()
+        hashes = {}
+        for subject in subjects:
+            hashes[subject.id] = hashlib.sha1(experiment_fingerprint.encode('utf-8'))
+            hashes[subject.id].update(json.dumps([subject.participant_id, subject.listitem_id, subject.created, subject.updated,
+                                                  subject.cdi_estimate, subject.resolution_w, subject.resolution_h,
+                                                  subject.random_seed], 
+                                                  default=str).encode('utf-8'))
+
+        # Trial results are only ever added or given a webcam file, the gaze data of a trial result never changes
+        related_data = [
+            TrialResult.objects.filter(subject__experiment=self.experiment.pk) \
+                               .values_list('subject', 'pk', 'trialitem', 'key_pressed', 'webcam_file', 'trial_number', 
+                                            'start_time', 'end_time', 'resolution_w', 'resolution_h', 'gaze_summary'),
+            CdiResult.objects.filter(subject__experiment=self.experiment.pk).values_list('subject', 'pk', 'given_label', 'response'),
+            AnswerBase.objects.filter(subject_data__experiment=self.experiment.pk).values_list('subject_data', 'pk', 'updated'),
+        ]
+        for queryset in related_data:
+            for row in queryset.order_by('pk').iterator():
+                if row[0] in hashes:
+                    hashes[row[0]].update(json.dumps(row[1:], default=str).encode('utf-8'))
+
+        return {subject_id: h.hexdigest() for subject_id, h in hashes.items()}
+
+
+    def get_cache_path(self, subject, fingerprint):
+        """
+        Returns the path of the cached excel report of a participant.
+        """
+        return os.path.join(self.cache_folder, get_valid_filename(subject.id), fingerprint + '.xlsx')
+
+
+    def get_cached_workbook(self, subject, fingerprint):
+        """
+        Returns the path of the cached excel report of a participant, creating it if the participant's data has changed.
+        """
+        return self.get_workbook(subject, fingerprint)[0]
+
+
+    def get_workbook(self, subject, fingerprint):
+        """
+        Returns the path of the cached excel report of a participant and, if it had to be created 
+        because the participant's data has changed, its content.
+        """
+        path = self.get_cache_path(subject, fingerprint)
+        if os.path.exists(path):
+            return path, None
+
+        data = self.render_workbook(subject)
+        self.store_workbook(path, data)
+        return path, data
+
+
+    def prune_cache(self, subject_ids):
+        """
+        Removes cached workbooks of participants who no longer exist.
+        """
+        if not os.path.isdir(self.cache_folder):
+            return
+        subject_folders = set(get_valid_filename(subject_id) for subject_id in subject_ids)
+        for fname in os.listdir(self.cache_folder):
+            if fname not in subject_folders:
+                shutil.rmtree(os.path.join(self.cache_folder, fname), ignore_errors=True)
+
+
+    def get_webcam_files(self):
+        """
+        Returns the names of all webcam/audio files recorded in the experiment.
+        """
+        return TrialResult.objects.filter(subject__experiment__pk=self.experiment.pk) \
+                                  .exclude(webcam_file__isnull=True).exclude(webcam_file='') \
+                                  .order_by('subject', 'pk').values_list('webcam_file', flat=True)
+
+
+    def iter_workbooks(self, subjects, fingerprints, batches):
+        """
+        Returns an iterator over the participants in order, with the path of each participant's cached excel report
+        and, if it had to be created, its content. The results of each batch of participants are loaded
+        when the batch's first participant is reached.
+
+        With several workers, the workbooks are rendered in a pool of processes while the next participants' data
+        is loaded. At most two workbooks per worker are pending at a time, which bounds the memory used.
+        """
+        if self.workers <= 1:
+            for subject in subjects:
+                if subject.id in batches:
+                    self.load_batch(batches[subject.id])
+                yield (subject, *self.get_workbook(subject, fingerprints[subject.id]))
+            return
+
+        # Do not share the database connections with the worker processes, they are reopened when needed.
+        # A connection in a transaction (e.g. in tests) cannot be closed, but is not used by the workers either.
+        for connection in connections.all():
+            if not connection.in_atomic_block:
+                connection.close()
+
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=django.setup) as executor:
+            # Start the workers before the connections are reopened by the first query: forked workers are all
+            # started by the first task submitted and would otherwise inherit the open connections.
+            executor.submit(int).result()
+            for subject in subjects:
+                if subject.id in batches:
+                    self.load_batch(batches[subject.id])
+                path = self.get_cache_path(subject, fingerprints[subject.id])
+                if os.path.exists(path):
+                    pending.append((subject, path, None))
+                else:
+                    pending.append((subject, path, executor.submit(render_workbook_data, self.get_workbook_data(subject))))
+                    self.release_batch([subject])
+
+                while len(pending) >= 2 * self.workers:
+                    yield self.finish_workbook(*pending.popleft())
+            while pending:
+                yield self.finish_workbook(*pending.popleft())
+
+
+    def finish_workbook(self, subject, path, future):
+        """
+        Waits for the excel report of a participant rendered by a worker process and stores it in the cache.
+        Returns the participant, the path of the report and its content (None if the report was cached).
+        """
+        if future is None:
+            return subject, path, None
+        data = future.result()
+        self.store_workbook(path, data)
+        return subject, path, data
+
+
+    def write_report(self, archive):
+        """
+        Adds all participants' results and webcam/audio files for an experiment to a report archive, 
+        yielding whenever data has been written to the archive.
+
+        Only the workbooks of participants whose data has changed since the last report are created,
+        which also allows an interrupted job to be resumed. The progress is stored in the job, if any.
+        """
+        subjects = list(SubjectData.objects.filter(experiment__pk=self.experiment.pk).select_related('listitem').order_by('created', 'pk'))
+        fingerprints = self.get_subject_fingerprints(subjects)
+        if self.job:
+            self.job.total = len(subjects)
+            self.job.completed = 0
+            self.job.save(update_fields=['total', 'completed', 'updated'])
+
+        # Load the results of participants without an up-to-date workbook in batches
+        outdated = [subject for subject in subjects 
+                    if not os.path.exists(self.get_cache_path(subject, fingerprints[subject.id]))]
+        batches = {}
+        for i in range(0, len(outdated), BATCH_SIZE):
+            batches[outdated[i].id] = outdated[i:i + BATCH_SIZE]
+
+        # For each subject, add excel report to zip, without reading back workbooks that have just been created
+        for subject, workbook_path, workbook_data in self.iter_workbooks(subjects, fingerprints, batches):
+            if workbook_data is None:
+                yield from archive.add_file(workbook_path, self.get_workbook_filename(subject))
             else:
-                curr_webgazer_data['Gaze Area (row,col)'] = ''
-            webgazer_data = pd.concat([
-                webgazer_data, 
-                curr_webgazer_data,
-            ])
+                yield from archive.add_bytes(self.get_workbook_filename(subject), workbook_data)
+
+            if self.job:
+                self.job.completed += 1
+                self.job.save(update_fields=['completed', 'updated'])
+
+        # Add webcam files to zip
+        for webcam_file in self.get_webcam_files():
+            webcam_path = os.path.join(settings.WEBCAM_ROOT, webcam_file)
+            if not os.path.isfile(webcam_path):
+                logger.warning('Webcam file %s not found, not added to report.' % webcam_file)
+                continue
+            yield from archive.add_file(webcam_path, webcam_file)
 
-        return [webgazer_data, validation_data]
+        self.prune_cache([subject.id for subject in subjects])
 
 
     def create_report(self):
         """
         Creates a zip file containing all participants' results and webcam/audio files for an experiment.
         """
-        # For each subject
-        subjects = SubjectData.objects.filter(experiment__pk=self.experiment.pk)
-        for subject in subjects:
+        output_path = os.path.join(self.output_folder, self.output_file)
+        write_archive(output_path, self.write_report)
+        return output_path
+
 
-            # Create excel report
-            workbook_file = str(subject.participant_id) + '_' + \
-                self.experiment.exp_name + '_' + subject.created.strftime('%Y%m%d') + \
-                    '_' + subject.id + '.xlsx'
-            workbook_file = get_valid_filename(workbook_file)
-
-            # Create Pandas Excel writer using XlsxWriter as the engine
-            writer = pd.ExcelWriter(os.path.join(self.output_folder,
-                                                 self.tmp_folder, workbook_file),
-                                    engine='xlsxwriter')
-            
-            # Create subject data worksheet
-            self.create_subject_worksheet(subject).to_excel(writer, sheet_name='Participant', header=False)
-
-            if subject.listitem:
-                # Create trial data worksheet
-                self.create_trial_worksheet(subject).to_excel(writer, sheet_name='Trials', index=False)
-                if self.experiment.recording_option in ['EYE', 'ALL']:
-                    # Create webgazer worksheet
-                    webgazer_worksheets = self.create_webgazer_worksheet(subject)
-                    webgazer_worksheets[0].to_excel(writer, sheet_name='EyeTrackingData', index=False)
-                    webgazer_worksheets[1].to_excel(writer, sheet_name='EyeTrackingValidation', index=False)
-            
-            # Close the Pandas Excel writer and store excel report
-            writer.close()
-            self.zip_file.write(os.path.join(self.output_folder,
-                                             self.tmp_folder, workbook_file),
-                                workbook_file)
-
-        # Close zip
-        self.zip_file.close()
-
-        # Remove tmp folder
-        shutil.rmtree(os.path.join(self.output_folder, self.tmp_folder))
-
-        return os.path.join(self.output_folder, self.output_file)
\ No newline at end of file
+    def stream_report(self):
+        """
+        Returns an iterator over the bytes of the zip file containing all participants' results and 
+        webcam/audio files for an experiment, which is created while it is being sent.
+        """
+        return stream_archive(self.write_report)
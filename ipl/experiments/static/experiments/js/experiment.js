@@ -34,6 +34,17 @@
     // Media stream object
     let mediaStream;
 
+    // Results of trials waiting to be sent together, their serialized size, and the number and size of results sent at once.
+    // The size is kept well below the 64 KiB that browsers allow for the body of the request sent when the page is closed.
+    let pendingResults = [];
+    let pendingResultBytes = 0;
+    const resultBatchSize = 10;
+    const resultBatchBytes = 32 * 1024;
+
+    // Id of this page load, so that trial numbers handed out again after a reload do not collide with earlier results
+    const pageLoadId = (window.crypto && crypto.randomUUID) ? crypto.randomUUID() :
+        Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+
     // Populate keycode dictionary with letters
     for (let i = 97; i < 123; i++) {
         codes[String.fromCharCode(i)] = i - 32;
@@ -91,12 +102,14 @@
             
             // TODO: Properly stop recording
             webcam.stopUploading();
-            if (include_pause_page.toLowerCase() == 'true') {
-                // go to pause page
-                window.location.replace('/' + subjectUuid + '/run/pause');
-            } else {
-                window.location.replace('/' + subjectUuid + '/run/thankyou');
-            }
+            flushResults().finally(function() {
+                if (include_pause_page.toLowerCase() == 'true') {
+                    // go to pause page
+                    window.location.replace('/' + subjectUuid + '/run/pause');
+                } else {
+                    window.location.replace('/' + subjectUuid + '/run/thankyou');
+                }
+            });
         }, Number(global_timeout));
     };
 
@@ -119,8 +132,8 @@
             // TODO: check here 
             webgazer.pause();
 
-            // Wait until webcam upload is done
-            waitForWebcamUploadToFinish().then(function() {
+            // Wait until the remaining results are stored and webcam upload is done
+            flushResults().then(waitForWebcamUploadToFinish).then(function() {
                 webcam.stopUploading();
                 window.location.replace('/' + subjectUuid + '/run/thankyou');
             });
@@ -220,7 +233,7 @@
                     removeTrialImage();
                 }
 
-                return postResult(trialObj);
+                return storeResult(trialObj);
                 
             }).then(function(trialObj) {
                 return webcam.stopRecording(trialObj.resultId);
@@ -453,6 +466,82 @@
         document.querySelector('.trial-video').outerHTML = '';
     };
 
+    /**
+     * Returns the results of a trial to be sent to the backend.
+     * The page load id and trial number serve as sequence number, so that a result sent twice is stored once.
+     * @param {*} trialObj 
+     */
+    let getResultData = function(trialObj) {
+        let keysPressed = trialObj.keysPressed;
+        if(keysPressed instanceof Array) {
+            keysPressed = keysPressed.join(',');
+        }
+        return {
+            'client_seq': pageLoadId + ':' + trialObj.trial_number,
+            'trialitem': trialObj.trial_id,
+            'start_time': trialObj.start_time,
+            'end_time': trialObj.end_time,
+            'key_pressed': keysPressed,
+            'trial_number': trialObj.trial_number,
+            'resolution_w': window.screen.width,
+            'resolution_h': window.screen.height,
+            'webgazer_data': trialObj.webgazer_data,
+        };
+    };
+
+    /**
+     * Store the results of a trial. Results of trials with a webcam/audio recording are sent at once,
+     * as the recording is attached to the stored result, and so are results with gaze data, as they are too large
+     * to be batched. Other results are sent in batches.
+     * Pending results are sent first, so that results are always stored in the order of the trials.
+     * @param {*} trialObj 
+     */
+    let storeResult = function(trialObj) {
+        if ((recording_option != 'NON' && recording_option != 'EYE' && trialObj.record_media) ||
+            (trialObj.webgazer_data && trialObj.webgazer_data.length > 0)) {
+            return flushResults().then(function() {
+                return postResult(trialObj);
+            });
+        }
+        pendingResults.push(trialObj);
+        pendingResultBytes += JSON.stringify(getResultData(trialObj)).length;
+        if (pendingResults.length >= resultBatchSize || pendingResultBytes >= resultBatchBytes) {
+            return flushResults().then(function() {
+                return trialObj;
+            });
+        }
+        return Promise.resolve(trialObj);
+    };
+
+    /**
+     * Send all pending trial results to backend in one request.
+     * Falls back to sending them one by one if the batch could not be stored.
+     */
+    let flushResults = function() {
+        if (pendingResults.length == 0) return Promise.resolve();
+        let batch = pendingResults;
+        pendingResults = [];
+        pendingResultBytes = 0;
+        console.log("Send batch of " + batch.length + " results");
+        return new Promise(function(resolve, reject) {
+            $.ajax({
+                url: '/' + subjectUuid + '/run/storeresults',
+                data: JSON.stringify({'results': batch.map(getResultData)}),
+                contentType: 'application/json',
+                method: 'POST'
+            }).done(function() {
+                resolve();
+            }).fail(function() {
+                console.error('Failed to post batch of results, sending them one by one.');
+                batch.reduce(function(promise, trialObj) {
+                    return promise.then(function() {
+                        return postResult(trialObj);
+                    });
+                }, Promise.resolve()).then(resolve, reject);
+            });
+        });
+    };
+
     /**
      * Send trial results to backend.
      * @param {*} trialObj 
@@ -460,22 +549,11 @@
     let postResult = function(trialObj) {
         return new Promise(function(resolve, reject) {
             console.log("Send results", trialObj);
-            let keysPressed = trialObj.keysPressed;
-            if(keysPressed instanceof Array) {
-                keysPressed = keysPressed.join(',');
-            }
+            let data = getResultData(trialObj);
+            data['webgazer_data'] = JSON.stringify(data['webgazer_data']);
             $.ajax({
                 url: '/' + subjectUuid + '/run/storeresult',
-                data: {
-                    'trialitem': trialObj.trial_id,
-                    'start_time': trialObj.start_time,
-                    'end_time': trialObj.end_time,
-                    'key_pressed': keysPressed,
-                    'trial_number': trialObj.trial_number,
-                    'resolution_w': window.screen.width,
-                    'resolution_h': window.screen.height,
-                    'webgazer_data': JSON.stringify(trialObj.webgazer_data), 
-                },
+                data: data,
                 method: 'POST'
             }).done(function(data) {
                 trialObj.resultId = data.resultId;
@@ -625,11 +703,13 @@
      * Go to exit/pause page.
      */
     let terminateStudy = function() {
-        if (include_pause_page.toLowerCase() == 'true') {
-            window.location.replace('/' + subjectUuid + '/run/pause');
-        } else {
-            window.location.replace('/' + subjectUuid + '/run/thankyou');
-        }
+        flushResults().finally(function() {
+            if (include_pause_page.toLowerCase() == 'true') {
+                window.location.replace('/' + subjectUuid + '/run/pause');
+            } else {
+                window.location.replace('/' + subjectUuid + '/run/thankyou');
+            }
+        });
     };
 
     $(document).on('mozfullscreenchange webkitfullscreenchange fullscreenchange', function() {
@@ -643,6 +723,21 @@
     $(window).on('load', function () {
         $('#fullscreen-button').prop('disabled', false); // enable fullscreen button
     });
+
+    // Send pending results when the page is closed, in a request that outlives the page
+    $(window).on('pagehide', function () {
+        if (pendingResults.length == 0) return;
+        fetch('/' + subjectUuid + '/run/storeresults', {
+            method: 'POST',
+            keepalive: true,
+            headers: {'Content-Type': 'application/json', 'X-CSRFToken': csrftoken},
+            body: JSON.stringify({'results': pendingResults.map(getResultData)})
+        }).catch(function(e) {
+            console.error('Failed to post pending results:', e);
+        });
+        pendingResults = [];
+        pendingResultBytes = 0;
+    });
     
     $('#confirmExitButton').click(function() {
         terminateStudy();
@@ -40,8 +40,15 @@ let webcam = (function () {
 	// Recorder reference
 	let mediaRecorder;
 
-	// Background upload queue
-	let uploadQueue = new Queue();
+	// Background upload queue of chunks and merge requests, in the order in which they were recorded.
+	// An item is removed once the server confirmed it.
+	let uploadQueue = [];
+
+	// Maximum number of chunks uploaded at the same time
+	const maxParallelUploads = 3;
+
+	// Number of uploads in progress
+	let activeUploads = 0;
 
 	// Currently recording
 	let recording = false;
@@ -67,6 +74,9 @@ let webcam = (function () {
 	// Upload enpoint
 	let uploadUrl;
 
+	// Endpoint returning the chunks of a recording received by the server
+	let manifestUrl;
+
 	// Currently uploading errors
 	let uploadErrors = 0;
 
@@ -93,7 +103,7 @@ let webcam = (function () {
 	 * Returns the length of the upload queue.
 	 */
 	w.getLength = function() {
-		return uploadQueue.getLength();
+		return uploadQueue.length;
 	}
 
 	/**
@@ -102,7 +112,7 @@ let webcam = (function () {
 	 */
 	w.waitForQueue = function(length) {
 		// If current queue length matches
-		if(length == uploadQueue.getLength()) {
+		if(length == uploadQueue.length) {
 			return Promise.resolve()
 		}
 
@@ -121,7 +131,7 @@ let webcam = (function () {
 	 * Notifies queue callbacks.
 	 */
 	let notify = function() {
-		let currentLength = uploadQueue.getLength();
+		let currentLength = uploadQueue.length;
 		if(currentLength in queueNotify) {
 			let callbacks = queueNotify[currentLength];
 			if((currentLength == 0 && !recording) || currentLength > 0) {
@@ -218,11 +228,13 @@ let webcam = (function () {
 			let afterStop = function() {
 				mediaRecorder.removeEventListener("stop", afterStop);
 				// Put merge request in queue
-				uploadQueue.enqueue({
+				uploadQueue.push({
 					"fileName": currentFileName,
-					"trialResultId": trialResultId
+					"trialResultId": trialResultId,
+					"state": "queued"
 				});
 				notify();
+				uploadChunks();
 				chunkCounter++;
 				recording = false;
 				console.log("Stop webcam recording");
@@ -242,65 +254,91 @@ let webcam = (function () {
 		if (uploading) return;
 
 		uploadUrl = "/" + subjectUuid + "/run/upload";
+		manifestUrl = uploadUrl + "/manifest";
 		uploading = true;
-		uploadTimer = setTimeout(uploadChunk, recordingInterval * 1.5);
+		uploadTimer = setTimeout(function () {
+			uploadTimer = null;
+			uploadChunks();
+		}, recordingInterval * 1.5);
 	};
 
 	/**
-	 * Upload the first chunk in the queue.
+	 * Start uploading the queued chunks, up to maxParallelUploads at a time.
+	 * A merge request is only sent once all chunks before it have been uploaded.
 	 */
-	let uploadChunk = function () {
-		// If queue is empty, try again later
-		if (uploadQueue.getLength() == 0 && uploading) {
-			console.log("timeout");
-			uploadTimer = setTimeout(uploadChunk, recordingInterval);
-			return;
-		}
-
+	let uploadChunks = function () {
 		// Abort if upload was stopped
 		if (!uploading) {
 			return;
 		}
 
-		// Prepare upload data
-		let formData = new FormData();
-		let chunkData = uploadQueue.peek();
+		for (let chunkData of uploadQueue) {
+			if (activeUploads >= maxParallelUploads) break;
+			if (chunkData.state != "queued") continue;
+			if ('trialResultId' in chunkData) {
+				if (uploadQueue[0] === chunkData && activeUploads == 0) {
+					uploadChunk(chunkData);
+				}
+				break;
+			}
+			uploadChunk(chunkData);
+		}
+	};
+
+	/**
+	 * Upload a chunk or send a merge request.
+	 * @param {object} chunkData queued chunk or merge request
+	 */
+	let uploadChunk = function (chunkData) {
+		// Prepare upload request: chunks are sent as the raw request body, merge requests as a form
 		let chunkFileName;
+		let request;
 		if('trialResultId' in chunkData) {
+			let formData = new FormData();
 			formData.append('trialResultId', chunkData.trialResultId)
 			formData.append('filename', chunkData.fileName);
+			request = { url: uploadUrl, method: 'POST', data: formData, contentType: false };
 		}else{
 			chunkFileName = chunkData.fileName + '-' + formatNumber(chunkData.number, 5) + ".webm";
-			let file = new File([chunkData.data], chunkFileName, { type: codec });
-			formData.append('file', file);
-			formData.append('type', codec);
+			request = {
+				// Slashes would end the URL path, they are removed from filenames by the server anyway
+				url: uploadUrl + "/" + encodeURIComponent(chunkFileName.replace(/\//g, "")),
+				method: 'PUT',
+				data: chunkData.data,
+				contentType: 'application/octet-stream'
+			};
 		}
+		request.processData = false;
+		chunkData.state = "uploading";
+		activeUploads++;
 
 		// Upload
-		$.ajax({
-			url: uploadUrl,
-			method: 'POST',
-			data: formData,
-			processData: false,
-			contentType: false
-		}).done(function (data, status, xhr) {
-			// Do upload
+		$.ajax(request).done(function (data, status, xhr) {
 			console.log("Upload of " + chunkFileName + " was successful.");
 			uploadErrors = 0; // Reset upload errors after successful upload
-
-			// In case of error, try again
-			uploadQueue.dequeue();
-			notify();
+			activeUploads--;
+			removeFromQueue(chunkData);
 
 			// Continue uploading
-			uploadChunk();
+			uploadChunks();
 		}).fail(function (xhr, status, error) {
+			activeUploads--;
+			if (xhr.status == 409) {
+				// The recording has already been finished, the chunk cannot be added anymore
+				console.warn("Chunk " + chunkFileName + " arrived after its recording was finished.");
+				removeFromQueue(chunkData);
+				uploadChunks();
+				return;
+			}
 			uploadErrors++;
+			chunkData.state = "failed";
 			console.error("Upload of " + chunkFileName + " failed.", error);
 
 			// Try again
 			if (uploadErrors < maxUploadErrors) {
-				uploadChunk();
+				if (uploadTimer == null) {
+					uploadTimer = setTimeout(function () { resumeRecording(chunkData.fileName); }, recordingInterval);
+				}
 			} else {
 				console.error("Too many errors while uploading. Stop uploading.");
 				w.stopUploading();
@@ -308,6 +346,46 @@ let webcam = (function () {
 		});
 	};
 
+	/**
+	 * Resume uploading after failed uploads: the server may have received chunks whose response was lost,
+	 * so ask which chunks of the recording it has and only upload the missing ones again.
+	 * @param {string} fileName of the recording
+	 */
+	let resumeRecording = function (fileName) {
+		uploadTimer = null;
+		$.ajax({
+			url: manifestUrl,
+			method: 'GET',
+			data: { 'filename': fileName }
+		}).done(function (manifest) {
+			let received = new Set(manifest.received);
+			for (let chunkData of uploadQueue.slice()) {
+				if (chunkData.fileName == fileName && chunkData.state != "uploading" && received.has(chunkData.number)) {
+					removeFromQueue(chunkData);
+				}
+			}
+		}).always(function () {
+			for (let chunkData of uploadQueue) {
+				if (chunkData.state == "failed") {
+					chunkData.state = "queued";
+				}
+			}
+			uploadChunks();
+		});
+	};
+
+	/**
+	 * Remove a confirmed chunk or merge request from the upload queue.
+	 * @param {object} chunkData queued chunk or merge request
+	 */
+	let removeFromQueue = function (chunkData) {
+		let index = uploadQueue.indexOf(chunkData);
+		if (index >= 0) {
+			uploadQueue.splice(index, 1);
+		}
+		notify();
+	};
+
 	/**
 	 * Stop background uploading process.
 	 */
@@ -316,6 +394,7 @@ let webcam = (function () {
 
 		uploading = false;
 		clearTimeout(uploadTimer);
+		uploadTimer = null;
 	};
 
 	/**
@@ -334,14 +413,16 @@ let webcam = (function () {
 	 * @param {event} event of the MediaRecorder
 	 */
 	let handleStreamData = function (event) {
-		uploadQueue.enqueue({
+		uploadQueue.push({
 			"number": chunkCounter,
 			"data": event.data,
-			"fileName": currentFileName
+			"fileName": currentFileName,
+			"state": "queued"
 		});
 		notify();
 		chunkCounter++;
-		console.log("Queue size:", uploadQueue.getLength());
+		console.log("Queue size:", uploadQueue.length);
+		uploadChunks();
 	};
 
 	return w;
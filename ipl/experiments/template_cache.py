@@ -0,0 +1,83 @@
+from collections import OrderedDict
+from django.conf import settings
+from django.template import Template
+
+import hashlib
+import threading
+import logging
+
+# Create a logger for this file
+logger = logging.getLogger(__name__)
+
+
+class TemplateCache:
+    """
+    Process-local LRU cache of the compiled page templates of experiments, so that the templates stored
+    in an experiment are not lexed and parsed again on every request.
+    Entries are keyed by experiment, field and a hash of the template, so that a changed template is never served
+    from the cache, even by processes which did not see the experiment being saved.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.templates = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, experiment, field):
+        """
+        Returns the compiled template stored in a field of an experiment.
+        """
+        source = getattr(experiment, field)
+        key = (str(experiment.pk), field, hashlib.sha1(source.encode('utf-8')).hexdigest())
+        with self.lock:
+            template = self.templates.get(key)
+            if template is not None:
+                self.templates.move_to_end(key)
+                self.hits += 1
+                return template
+            self.misses += 1
+
+        template = Template(source)
+        with self.lock:
+            self.templates[key] = template
+            self.templates.move_to_end(key)
+            while len(self.templates) > self.max_size:
+                self.templates.popitem(last=False)
+        return template
+
+    def invalidate(self, experiment_id):
+        """
+        Removes the templates of an experiment from the cache.
+        """
+        experiment_id = str(experiment_id)
+        with self.lock:
+            for key in [key for key in self.templates if key[0] == experiment_id]:
+                del self.templates[key]
+
+    def clear(self):
+        """
+        Removes all templates from the cache and resets its counters.
+        """
+        with self.lock:
+            self.templates.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Returns the counters of the cache.
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.templates), 'max_size': self.max_size}
+
+
+template_cache = TemplateCache(settings.TEMPLATE_CACHE_SIZE)
+
+
+def get_page_template(experiment, field):
+    """
+    Returns the compiled page template stored in a field of an experiment, e.g. 'information_page_tpl'.
+    """
+    return template_cache.get(experiment, field)
@@ -1,10 +1,41 @@
 import datetime
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import zipfile
 
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.template import Context
 from django.utils import timezone
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from filebrowser.base import FileObject
 
-from .models import Question
+from .models import Question, Experiment, ListItem, OuterBlockItem, BlockItem, TrialItem, SubjectData, TrialResult, \
+                    ReportJob, ConsentQuestion, AnswerText, AnswerInteger, AnswerRadio, CdiResult, Instrument
+from .reporter import Reporter, create_gaze_frames, create_gaze_summary_frame, render_workbook_data
+from .aoi import AOIGrid
+from .views import createTrialDict, buildTrialPlan, getTrialPlan, orderTrialPlan, applyTrialPlan
+from .template_cache import TemplateCache, template_cache, get_page_template
+from .instruments import instrument_cache, get_word_list, get_item_params, get_norm_tables, NORM_TABLES, FEMALE
+from . import chunks
+from .archive import member_compression
+from .tidy import TidyReporter, CsvTableWriter, parquet_available
+from .gaze import pack_samples, unpack_samples, encode_webgazer_data, decode_webgazer_data, resample_gaze, summarise_gaze
 
 # Create your tests here.
 class QuestionModelTests(TestCase):
@@ -122,3 +153,1385 @@ class QuestionDetailViewTests(TestCase):
         url = reverse('experiments:detail', args=(past_question.id,))
         response = self.client.get(url)
         self.assertContains(response, past_question.question_text)
+
+
+def create_experiment(num_subjects=1, num_blocks=2, num_trials=3, recording_option=Experiment.NONE):
+    """
+    Create an experiment with a single list of `num_blocks` inner blocks of `num_trials` trials each,
+    and `num_subjects` participants who completed all trials.
+    """
+    user = User.objects.create_user(username='researcher-%d' % User.objects.count(), password='secret')
+    experiment = Experiment.objects.create(user=user, exp_name='Test experiment', recording_option=recording_option)
+    list_item = ListItem.objects.create(experiment=experiment, list_name='List 1')
+    outer_block = OuterBlockItem.objects.create(listitem=list_item, outer_block_name='Outer', position=0)
+    trial_items = []
+    for b in range(num_blocks):
+        block = BlockItem.objects.create(outerblockitem=outer_block, label='Block %d' % b, position=b)
+        for t in range(num_trials):
+            trial_items.append(TrialItem.objects.create(
+                blockitem=block, label='Trial %d' % t, code='T%d%d' % (b, t), max_duration=1000,
+                visual_file=FileObject('uploads/experiments/test/visual.png'), grid_row=2, grid_col=2, position=t))
+    for s in range(num_subjects):
+        subject = SubjectData.objects.create(id='subject-%d' % s, participant_id=s + 1, experiment=experiment,
+                                             listitem=list_item, resolution_w=1920, resolution_h=1080)
+        for n, trial_item in enumerate(trial_items):
+            TrialResult.objects.create(subject=subject, trialitem=trial_item, trial_number=n + 1,
+                                       start_time=0, end_time=500, key_pressed='mouseX: 100 - mouseY: 900',
+                                       resolution_w=1920, resolution_h=1080)
+    return experiment
+
+
+def use_temporary_folders(test_case, **folders):
+    """
+    Overrides settings with folders in a new temporary directory for the duration of a test,
+    e.g. REPORTS_ROOT='reports', or with the directory itself for an empty name. Returns the temporary directory.
+    """
+    root = tempfile.mkdtemp()
+    test_case.addCleanup(shutil.rmtree, root, ignore_errors=True)
+    folder_settings = override_settings(**{name: os.path.join(root, folder) if folder else root
+                                           for name, folder in folders.items()})
+    folder_settings.enable()
+    test_case.addCleanup(folder_settings.disable)
+    return root
+
+
+class TemplateCacheTests(TestCase):
+    def setUp(self):
+        template_cache.clear()
+        self.experiment = create_experiment(num_subjects=0)
+        self.url = reverse('experiments:informationPage', args=(self.experiment.pk,))
+
+    def test_cached_page(self):
+        """
+        Page templates are compiled once per experiment and template, and compiled again when they change.
+        """
+        for _ in range(3):
+            self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertEqual(template_cache.stats()['misses'], 1)
+        self.assertEqual(template_cache.stats()['hits'], 2)
+
+        self.experiment.information_page_tpl = '<p>{{ experiment.exp_name }} changed</p>'
+        self.experiment.save()
+        self.assertEqual(template_cache.stats()['size'], 0)
+        self.assertContains(self.client.get(self.url), 'Test experiment changed')
+        self.assertEqual(template_cache.stats()['misses'], 2)
+
+    def test_changed_template(self):
+        """
+        A template changed by another process is not served from the cache.
+        """
+        get_page_template(self.experiment, 'information_page_tpl')
+        Experiment.objects.filter(pk=self.experiment.pk).update(information_page_tpl='<p>updated</p>')
+        experiment = Experiment.objects.get(pk=self.experiment.pk)
+        self.assertEqual(get_page_template(experiment, 'information_page_tpl').render(Context()), '<p>updated</p>')
+
+    def test_lru(self):
+        """
+        The least recently used templates are removed from a full cache.
+        """
+        cache = TemplateCache(2)
+        experiment = SimpleNamespace(pk=1, a='a', b='b', c='c')
+        first = cache.get(experiment, 'a')
+        cache.get(experiment, 'b')
+        self.assertIs(cache.get(experiment, 'a'), first)
+        cache.get(experiment, 'c')
+        self.assertEqual([key[1] for key in cache.templates], ['a', 'c'])
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 3, 'size': 2, 'max_size': 2})
+
+    def test_stats_view(self):
+        """
+        The counters of the cache are only shown to superusers.
+        """
+        url = reverse('experiments:templateCacheStats')
+        self.client.force_login(self.experiment.user)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(User.objects.create_superuser(username='admin', password='secret'))
+        self.assertEqual(self.client.get(url).json()['max_size'], settings.TEMPLATE_CACHE_SIZE)
+
+
+class InstrumentCacheTests(TestCase):
+    def setUp(self):
+        instrument_cache.clear()
+        self.media_root = use_temporary_folders(self, MEDIA_ROOT='')
+        files = {
+            'words.csv': 'word,word_id\nball,3\ncat,1\n',
+            'irt.csv': 'word,a,b,c,d\nball,1.5,-1,0,1\ncat,0.5,2,0,1\n',
+            'norm.csv': 'word_id,16,17\n1,10.5,11.5\n3,20.5,21.5\n',
+        }
+        for name, content in files.items():
+            with open(os.path.join(self.media_root, name), 'w') as csv_file:
+                csv_file.write(content)
+        norm = FileObject('norm.csv')
+        self.instrument = Instrument.objects.create(instr_name='Test instrument', words_list=FileObject('words.csv'),
+                                                    irt_params=FileObject('irt.csv'),
+                                                    **{sex + '_' + table: norm for sex in 'fm' for table in NORM_TABLES})
+
+    def test_cached_files(self):
+        """
+        The files of an instrument are parsed once, with the rows of the norm tables looked up by word.
+        """
+        word_list = get_word_list(self.instrument)
+        self.assertEqual(word_list.words, ['ball', 'cat'])
+        self.assertIs(get_word_list(self.instrument), word_list)
+        np.testing.assert_array_equal(get_item_params(self.instrument), [[1.5, -1, 0, 1], [0.5, 2, 0, 1]])
+
+        norms = get_norm_tables(self.instrument, FEMALE)
+        self.assertEqual(norms['lm_np_mean'].at(norms['lm_np_mean'].row(word_list.word_ids['ball']), 17), 21.5)
+        with self.assertRaises(KeyError):
+            norms['slope'].at(0, 18)
+        self.assertEqual(instrument_cache.stats(), {'hits': 1, 'misses': 8, 'size': 8})
+
+    def test_changed_files(self):
+        """
+        The files of an instrument are parsed again when they are replaced or the instrument is saved.
+        """
+        get_word_list(self.instrument)
+        with open(os.path.join(self.media_root, 'words.csv'), 'w') as csv_file:
+            csv_file.write('word,word_id\ndog,2\n')
+        os.utime(os.path.join(self.media_root, 'words.csv'), (0, 0))
+        self.assertEqual(get_word_list(self.instrument).words, ['dog'])
+
+        self.instrument.save()
+        self.assertEqual(instrument_cache.stats()['size'], 0)
+        self.assertEqual(get_word_list(self.instrument).word_ids, {'dog': 2})
+        self.assertEqual(instrument_cache.stats()['misses'], 3)
+
+
+class TrialPlanTests(TestCase):
+    def setUp(self):
+        self.experiment = create_experiment(num_subjects=0)
+        self.list_item = ListItem.objects.get(experiment=self.experiment)
+        self.subject = SubjectData.objects.create(id='0f8fad5b-d9cb-469f-a165-70867728950e', participant_id=1,
+                                                  experiment=self.experiment, listitem=self.list_item)
+        self.url = reverse('experiments:experimentRun', args=(self.subject.pk,))
+
+    def get_trials(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.context['trials'])
+
+    def test_plan(self):
+        """
+        The trials of a participant are taken from the trial plan of the list, which is compiled once.
+        """
+        trials = self.get_trials()
+        expected = [createTrialDict(t, t.blockitem, n + 1) for n, t in enumerate(
+            TrialItem.objects.filter(blockitem__outerblockitem__listitem=self.list_item)
+                             .order_by('blockitem__position', 'position'))]
+        self.assertEqual(trials, expected)
+        self.list_item.refresh_from_db()
+        self.assertIsNotNone(self.list_item.trial_plan)
+
+        # Blocks and trials are not queried again, only the participant with its experiment and list, and the trial results
+        with self.assertNumQueries(2):
+            self.assertEqual(self.get_trials(), trials)
+
+    def test_invalidation(self):
+        """
+        Changing, adding or deleting a trial or block of an experiment compiles its trial plans again.
+        """
+        self.get_trials()
+        trial_item = TrialItem.objects.filter(blockitem__outerblockitem__listitem=self.list_item).first()
+        trial_item.label = 'Changed'
+        trial_item.save()
+        self.assertIn('Changed', [t['label'] for t in self.get_trials()])
+
+        BlockItem.objects.filter(outerblockitem__listitem=self.list_item).first().delete()
+        self.assertEqual(len(self.get_trials()), 3)
+
+        OuterBlockItem.objects.create(listitem=self.list_item, outer_block_name='Second', position=1)
+        ListItem.objects.filter(pk=self.list_item.pk).update(trial_plan={'outer_blocks': []})
+        BlockItem.objects.create(outerblockitem=OuterBlockItem.objects.get(outer_block_name='Second'), label='B', position=0)
+        self.list_item.refresh_from_db()
+        self.assertIsNone(self.list_item.trial_plan)
+
+    def test_outdated_plan(self):
+        """
+        A plan compiled while the trials of the list are being changed is not stored.
+        """
+        list_item = ListItem.objects.get(pk=self.list_item.pk)
+        trial_item = TrialItem.objects.filter(blockitem__outerblockitem__listitem=self.list_item).first()
+        original = buildTrialPlan(list_item)
+        trial_item.label = 'Changed'
+        trial_item.save()
+        with mock.patch('experiments.views.buildTrialPlan', return_value=original):
+            self.assertEqual(getTrialPlan(list_item), original)
+        self.list_item.refresh_from_db()
+        self.assertIsNone(self.list_item.trial_plan)
+        self.assertIn('Changed', [t['label'] for t in self.get_trials()])
+        self.list_item.refresh_from_db()
+        self.assertIsNotNone(self.list_item.trial_plan)
+
+    def test_randomisation(self):
+        """
+        Trials are randomised per participant and completed trials are left out.
+        """
+        BlockItem.objects.filter(outerblockitem__listitem=self.list_item).update(randomise_trials=True)
+        plan = getTrialPlan(self.list_item)
+        orders = {tuple(orderTrialPlan(plan, random.Random(seed))) for seed in range(20)}
+        self.assertGreater(len(orders), 1)
+        self.assertEqual(orderTrialPlan(plan, random.Random(1)), orderTrialPlan(plan, random.Random(1)))
+
+        trial_order = orderTrialPlan(plan, random.Random(1))
+        completed = set(trial_order[:2])
+        trials = applyTrialPlan(plan, trial_order, completed, 3)
+        self.assertEqual([t['trial_id'] for t in trials], trial_order[2:])
+        self.assertEqual([t['trial_number'] for t in trials], [3, 4, 5, 6])
+
+    def test_stored_order(self):
+        """
+        The trial order of a participant is drawn once, so that reloading or resuming presents the same order.
+        """
+        BlockItem.objects.filter(outerblockitem__listitem=self.list_item).update(randomise_trials=True)
+        trials = self.get_trials()
+        self.subject.refresh_from_db()
+        self.assertIsNotNone(self.subject.random_seed)
+        self.assertEqual(self.subject.trial_order, [t['trial_id'] for t in trials])
+        self.assertEqual(self.subject.trial_order, orderTrialPlan(getTrialPlan(self.list_item),
+                                                                  random.Random(self.subject.random_seed)))
+        for _ in range(5):
+            self.assertEqual(self.get_trials(), trials)
+
+        TrialResult.objects.create(subject=self.subject, trialitem_id=trials[0]['trial_id'], trial_number=1, key_pressed='space')
+        self.assertEqual([t['trial_id'] for t in self.get_trials()], self.subject.trial_order[1:])
+
+        # Trials added after the order was drawn are presented after the others
+        block_item = BlockItem.objects.filter(outerblockitem__listitem=self.list_item).first()
+        trial_item = TrialItem.objects.create(blockitem=block_item, label='Added', code='added', max_duration=1000,
+                                              visual_file=FileObject('uploads/experiments/test/visual.png'), position=10)
+        self.assertEqual([t['trial_id'] for t in self.get_trials()], self.subject.trial_order[1:] + [trial_item.pk])
+
+    def test_resume(self):
+        """
+        Resuming a session late queries the completed trials at once, however many there are.
+        """
+        experiment = create_experiment(num_subjects=0, num_blocks=3, num_trials=100)
+        subject = SubjectData.objects.create(id='7c9e6679-7425-40de-944b-e07fc1f90ae7', participant_id=1, experiment=experiment,
+                                             listitem=ListItem.objects.get(experiment=experiment))
+        trial_items = list(TrialItem.objects.filter(blockitem__outerblockitem__listitem__experiment=experiment)
+                                            .order_by('blockitem__position', 'position'))
+        TrialResult.objects.bulk_create([TrialResult(subject=subject, trialitem=t, trial_number=n + 1, key_pressed='space')
+                                         for n, t in enumerate(trial_items[:250])])
+        TrialResult.objects.create(subject=subject, trialitem=trial_items[249], key_pressed='PAUSE', trial_number=251)
+        # The first run draws and stores the trial order of the participant
+        self.client.get(reverse('experiments:experimentRun', args=(subject.pk,)))
+
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('experiments:experimentRun', args=(subject.pk,)))
+        trials = json.loads(response.context['trials'])
+        self.assertEqual([t['trial_id'] for t in trials], [t.pk for t in trial_items[250:]])
+        self.assertEqual(trials[0]['trial_number'], 252)
+
+
+class StoreResultsTests(TestCase):
+    def setUp(self):
+        self.experiment = create_experiment(num_subjects=0, num_trials=10)
+        self.subject = SubjectData.objects.create(id='0f8fad5b-d9cb-469f-a165-70867728950e', participant_id=1,
+                                                  experiment=self.experiment, listitem=ListItem.objects.get(experiment=self.experiment))
+        self.trial_items = list(TrialItem.objects.filter(blockitem__outerblockitem__listitem__experiment=self.experiment)
+                                                 .order_by('blockitem__position', 'position'))
+        self.url = reverse('experiments:storeResults', args=(self.subject.pk,))
+
+    def post_results(self, trial_items, first=1, page_load='a'):
+        results = [{'client_seq': '%s:%d' % (page_load, first + n), 'trialitem': t.pk, 'start_time': 10.5, 'end_time': 510.5, 'key_pressed': 'space',
+                    'trial_number': first + n, 'resolution_w': 1920, 'resolution_h': 1080, 'webgazer_data': [[0, 1, 2]]}
+                   for n, t in enumerate(trial_items)]
+        return self.client.post(self.url, json.dumps({'results': results}), content_type='application/json')
+
+    def test_batch(self):
+        """
+        A batch of results is stored with a fixed number of queries, and sending it again stores nothing.
+        """
+        with CaptureQueriesContext(connection) as small:
+            response = self.post_results(self.trial_items[:2])
+        self.assertEqual(response.json(), {'stored': ['a:1', 'a:2'], 'duplicates': []})
+        with CaptureQueriesContext(connection) as large:
+            self.post_results(self.trial_items[2:], first=3)
+        self.assertEqual(len(small), len(large))
+
+        results = TrialResult.objects.filter(subject=self.subject).order_by('trial_number')
+        self.assertEqual([r.trialitem_id for r in results], [t.pk for t in self.trial_items])
+        self.assertEqual(results[0].webgazer_data, [[0, 1, 2]])
+        self.assertEqual(results[0].end_time, 510.5)
+
+        response = self.post_results(self.trial_items[:4])
+        self.assertEqual(response.json(), {'stored': [], 'duplicates': ['a:1', 'a:2', 'a:3', 'a:4']})
+        self.assertEqual(TrialResult.objects.filter(subject=self.subject).count(), len(self.trial_items))
+
+    def test_reload(self):
+        """
+        Results of another page load are stored even if their trial numbers were sent before.
+        """
+        self.post_results(self.trial_items[:2])
+        response = self.post_results(self.trial_items[2:4], page_load='b')
+        self.assertEqual(response.json(), {'stored': ['b:1', 'b:2'], 'duplicates': []})
+        self.assertEqual(TrialResult.objects.filter(subject=self.subject).count(), 4)
+
+    def test_invalid_batch(self):
+        """
+        A batch is rejected as a whole if it is malformed or contains trials of another experiment.
+        """
+        other = create_experiment(num_subjects=0)
+        other_trial = TrialItem.objects.filter(blockitem__outerblockitem__listitem__experiment=other).first()
+        self.assertEqual(self.post_results(self.trial_items[:2] + [other_trial]).status_code, 404)
+        self.assertEqual(self.client.post(self.url, '{"results": 1}', content_type='application/json').status_code, 400)
+        self.assertEqual(self.client.post(self.url, 'results', content_type='application/json').status_code, 400)
+        self.assertEqual(self.post_results(self.trial_items[:1], page_load='a' * 64).status_code, 400)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.assertFalse(TrialResult.objects.filter(subject=self.subject).exists())
+
+    def test_single_result(self):
+        """
+        A result sent to storeResult with a sequence number already stored returns the stored result.
+        """
+        data = {'client_seq': 'a:1', 'trialitem': self.trial_items[0].pk, 'start_time': 0, 'end_time': 500, 'key_pressed': 'space',
+                'trial_number': 1, 'resolution_w': 1920, 'resolution_h': 1080, 'webgazer_data': '[]'}
+        url = reverse('experiments:storeResult', args=(self.subject.pk,))
+        result_id = self.client.post(url, data).json()['resultId']
+        self.assertEqual(self.client.post(url, data).json()['resultId'], result_id)
+        self.assertEqual(self.post_results(self.trial_items[:1]).json()['duplicates'], ['a:1'])
+        self.assertEqual(TrialResult.objects.filter(subject=self.subject).count(), 1)
+
+
+class WebgazerDataTests(TestCase):
+    def setUp(self):
+        self.experiment = create_experiment(num_subjects=1, recording_option=Experiment.EYE)
+        self.samples = [{'x': n, 'y': 900, 't': n * 16.5} for n in range(1000)]
+        for result in TrialResult.objects.all():
+            result.set_webgazer_data(self.samples)
+            result.save()
+        self.result = TrialResult.objects.order_by('pk').first()
+        self.result.set_webgazer_data([{'x': 1.5, 'y': 2, 't': 3}, {'x': 2.5, 'y': 2, 't': 4}])
+        self.result.save()
+
+    def test_admin_counts(self):
+        """
+        The participant admin shows the number of recorded values per trial instead of the values.
+        """
+        self.client.force_login(User.objects.create_superuser(username='admin', password='secret'))
+        response = self.client.get(reverse('admin:experiments_subjectdata_change', args=('subject-0',)))
+        self.assertContains(response, '>1000</a>', count=5)
+        self.assertContains(response, '>2</a>', count=1)
+        self.assertContains(response, reverse('experiments:trialResultWebgazerData', args=(self.result.pk,)))
+        self.assertNotContains(response, "'t':")
+
+    def test_detail(self):
+        """
+        The webgazer data of a trial is loaded on request by users with access to the experiment.
+        """
+        result = TrialResult.objects.order_by('pk').last()
+        url = reverse('experiments:trialResultWebgazerData', args=(result.pk,))
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.force_login(User.objects.create_user(username='other', password='secret'))
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.client.force_login(self.experiment.user)
+        self.assertEqual(self.client.get(url).json(), self.samples)
+
+    def test_deferred(self):
+        """
+        Reports of experiments without eye-tracking and the pause page do not load the webgazer data.
+        """
+        Experiment.objects.filter(pk=self.experiment.pk).update(recording_option=Experiment.NONE)
+        reporter = Reporter(Experiment.objects.get(pk=self.experiment.pk))
+        subject = SubjectData.objects.get(experiment=self.experiment)
+        reporter.load_trial_results([subject])
+        for result in reporter.get_trial_results(subject):
+            self.assertEqual(result.get_deferred_fields(), set(TrialResult.GAZE_FIELDS))
+        self.assertEqual(len(reporter.get_trial_data(subject)), 6)
+
+        subject = SubjectData.objects.create(id='0f8fad5b-d9cb-469f-a165-70867728950e', participant_id=2,
+                                             experiment=self.experiment, listitem=subject.listitem)
+        TrialResult.objects.create(subject=subject, trialitem=self.result.trialitem, trial_number=1, key_pressed='space')
+        self.client.get(reverse('experiments:experimentPause', args=(subject.pk,)))
+        pause = TrialResult.objects.get(subject=subject, key_pressed='PAUSE')
+        self.assertEqual((pause.trialitem_id, pause.trial_number), (self.result.trialitem_id, 2))
+
+
+class ReportJobTests(TestCase):
+    def setUp(self):
+        use_temporary_folders(self, REPORTS_ROOT='reports', REPORTS_CACHE_ROOT='cache')
+
+    def test_report_requested_in_background(self):
+        """
+        Requesting a report creates a job instead of generating the report,
+        and requesting it again while the job is waiting reuses the job.
+        """
+        experiment = create_experiment()
+        self.client.force_login(experiment.user)
+        response = self.client.get(reverse('experiments:experimentReport', args=(experiment.pk,)))
+        job = ReportJob.objects.get(experiment=experiment)
+        self.assertRedirects(response, reverse('experiments:reportStatus', args=(job.pk,)))
+        self.client.get(reverse('experiments:experimentReport', args=(experiment.pk,)))
+        self.assertEqual(ReportJob.objects.filter(experiment=experiment).count(), 1)
+        self.assertEqual(job.status, ReportJob.PENDING)
+        response = self.client.get(reverse('experiments:reportProgress', args=(job.pk,)))
+        self.assertEqual(response.json()['status'], ReportJob.PENDING)
+        self.assertContains(self.client.get(reverse('experiments:reportStatus', args=(job.pk,))), 'Waiting')
+
+    def test_process_reports(self):
+        """
+        The worker creates the zip file of a waiting job and stores its progress.
+        """
+        experiment = create_experiment(num_subjects=2)
+        job = ReportJob.objects.create(experiment=experiment)
+        call_command('processreports', '--once', stdout=open(os.devnull, 'w'))
+        job.refresh_from_db()
+        self.assertEqual(job.status, ReportJob.DONE)
+        self.assertEqual((job.completed, job.total, job.progress), (2, 2, 100))
+        with zipfile.ZipFile(os.path.join(settings.REPORTS_ROOT, job.output_file)) as zip_file:
+            self.assertEqual(len(zip_file.namelist()), 2)
+
+    def test_remove_earlier_jobs(self):
+        """
+        A finished job deletes the earlier reports of its experiment in the same format.
+        """
+        experiment = create_experiment(num_subjects=1)
+        ReportJob.objects.create(experiment=experiment)
+        call_command('processreports', '--once', stdout=open(os.devnull, 'w'))
+        tidy = ReportJob.objects.create(experiment=experiment, report_format=ReportJob.CSV)
+        job = ReportJob.objects.create(experiment=experiment)
+        call_command('processreports', '--once', stdout=open(os.devnull, 'w'))
+
+        self.assertEqual(set(ReportJob.objects.values_list('pk', flat=True)), {tidy.pk, job.pk})
+        self.assertEqual(sorted(os.listdir(settings.REPORTS_ROOT)), sorted([str(tidy.pk), str(job.pk)]))
+
+    def test_resume_interrupted_job(self):
+        """
+        Workbooks written before a job was interrupted are not created again.
+        """
+        experiment = create_experiment(num_subjects=2)
+        job = ReportJob.objects.create(experiment=experiment, status=ReportJob.RUNNING)
+        ReportJob.objects.filter(pk=job.pk).update(updated=timezone.now() - datetime.timedelta(hours=1))
+        reporter = Reporter(experiment, job)
+        subjects = list(SubjectData.objects.order_by('participant_id'))
+        finished_path = reporter.get_cached_workbook(subjects[0], reporter.get_subject_fingerprints(subjects)[subjects[0].id])
+        modified = os.path.getmtime(finished_path)
+
+        call_command('processreports', '--once', stdout=open(os.devnull, 'w'))
+        job.refresh_from_db()
+        self.assertEqual(job.status, ReportJob.DONE)
+        self.assertEqual(os.path.getmtime(finished_path), modified)
+
+
+class ReportCacheTests(TestCase):
+    def setUp(self):
+        use_temporary_folders(self, REPORTS_ROOT='reports', REPORTS_CACHE_ROOT='cache')
+
+    def test_fingerprint_changes_with_data(self):
+        """
+        Only the fingerprint of the participant whose trial results changed is different.
+        """
+        experiment = create_experiment(num_subjects=2)
+        subjects = list(SubjectData.objects.order_by('participant_id'))
+        before = Reporter(experiment).get_subject_fingerprints(subjects)
+        TrialResult.objects.filter(subject=subjects[0]).update(webcam_file='recording.webm')
+        after = Reporter(experiment).get_subject_fingerprints(subjects)
+        self.assertNotEqual(before[subjects[0].id], after[subjects[0].id])
+        self.assertEqual(before[subjects[1].id], after[subjects[1].id])
+
+    def test_fingerprint_changes_with_experiment(self):
+        """
+        Changing a trial shown in the workbooks changes the fingerprints of all participants.
+        """
+        experiment = create_experiment(num_subjects=2)
+        subjects = list(SubjectData.objects.order_by('participant_id'))
+        before = Reporter(experiment).get_subject_fingerprints(subjects)
+        TrialItem.objects.filter(blockitem__outerblockitem__listitem__experiment=experiment).update(code='changed')
+        after = Reporter(experiment).get_subject_fingerprints(subjects)
+        self.assertNotEqual(before[subjects[0].id], after[subjects[0].id])
+        self.assertNotEqual(before[subjects[1].id], after[subjects[1].id])
+
+    def test_report_reuses_cached_workbooks(self):
+        """
+        A second report only recreates the workbooks of participants whose data changed,
+        and drops the workbooks of deleted participants.
+        """
+        experiment = create_experiment(num_subjects=3)
+        subjects = list(SubjectData.objects.order_by('participant_id'))
+        reporter = Reporter(experiment)
+        reporter.create_report()
+        fingerprints = reporter.get_subject_fingerprints(subjects)
+        paths = [reporter.get_cached_workbook(subject, fingerprints[subject.id]) for subject in subjects]
+        modified = [os.path.getmtime(path) for path in paths]
+
+        TrialResult.objects.filter(subject=subjects[0]).update(key_pressed='-')
+        subjects[2].delete()
+        filename = Reporter(experiment).create_report()
+
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertEqual(os.path.getmtime(paths[1]), modified[1])
+        self.assertFalse(os.path.exists(os.path.dirname(paths[2])))
+        with zipfile.ZipFile(filename) as zip_file:
+            self.assertEqual(len(zip_file.namelist()), 2)
+
+
+
+class ReportArchiveTests(TestCase):
+    def setUp(self):
+        use_temporary_folders(self, REPORTS_ROOT='reports', REPORTS_CACHE_ROOT='cache', WEBCAM_ROOT='webcam')
+        os.makedirs(settings.WEBCAM_ROOT)
+
+    def create_recording(self, experiment):
+        """
+        Adds a webcam file to the first trial result of an experiment.
+        """
+        with open(os.path.join(settings.WEBCAM_ROOT, 'recording.webm'), 'wb') as f:
+            f.write(os.urandom(3 * 1024 * 1024))
+        result = TrialResult.objects.filter(subject__experiment=experiment).order_by('pk').first()
+        TrialResult.objects.filter(pk=result.pk).update(webcam_file='recording.webm')
+
+    def test_member_compression(self):
+        """
+        Already compressed media is stored, workbooks and text files are deflated.
+        """
+        self.assertEqual(member_compression('1_trial.webm'), zipfile.ZIP_STORED)
+        self.assertEqual(member_compression('1_trial.WEBM'), zipfile.ZIP_STORED)
+        self.assertEqual(member_compression('1_report.xlsx'), zipfile.ZIP_DEFLATED)
+        self.assertEqual(member_compression('gaze.csv'), zipfile.ZIP_DEFLATED)
+
+    def test_report_compression(self):
+        """
+        The report stores webcam files and deflates workbooks.
+        """
+        experiment = create_experiment(num_subjects=2)
+        self.create_recording(experiment)
+        filename = Reporter(experiment).create_report()
+        with zipfile.ZipFile(filename) as zip_file:
+            compression = {info.filename: info.compress_type for info in zip_file.infolist()}
+            self.assertIsNone(zip_file.testzip())
+        self.assertEqual(compression.pop('recording.webm'), zipfile.ZIP_STORED)
+        self.assertEqual(list(compression.values()), [zipfile.ZIP_DEFLATED] * 2)
+        self.assertEqual(os.listdir(settings.REPORTS_ROOT), [os.path.basename(filename)])
+
+    def test_stream_report(self):
+        """
+        The streamed report contains the same files as the report written to disk, without writing it to disk
+        and without starting worker processes in the request.
+        """
+        experiment = create_experiment(num_subjects=2)
+        self.create_recording(experiment)
+        self.client.force_login(experiment.user)
+        with override_settings(REPORT_WORKERS=4), mock.patch('experiments.reporter.ProcessPoolExecutor') as pool:
+            response = self.client.get(reverse('experiments:experimentReportStream', args=(experiment.pk,)))
+            self.assertTrue(response.streaming)
+            self.assertEqual(response['Content-Type'], 'application/zip')
+            content = b''.join(response.streaming_content)
+        pool.assert_not_called()
+        self.assertEqual(os.listdir(settings.REPORTS_ROOT), [])
+
+        with zipfile.ZipFile(io.BytesIO(content)) as streamed, zipfile.ZipFile(Reporter(experiment).create_report()) as written:
+            self.assertIsNone(streamed.testzip())
+            self.assertEqual(streamed.namelist(), written.namelist())
+            for name in written.namelist():
+                self.assertEqual(streamed.read(name), written.read(name))
+
+
+
+class WebcamUploadTests(TestCase):
+    def setUp(self):
+        self.webcam_root = use_temporary_folders(self, WEBCAM_ROOT='')
+        self.experiment = create_experiment(num_subjects=0, recording_option=Experiment.VIDEO)
+        self.subject = SubjectData.objects.create(id='0f8fad5b-d9cb-469f-a165-70867728950e', participant_id=1,
+                                                  experiment=self.experiment)
+        self.result = TrialResult.objects.create(subject=self.subject, trialitem=TrialItem.objects.first(), trial_number=1)
+        self.recording = '1_trial1_Trial_0_' + self.subject.pk
+        self.url = reverse('experiments:experimentWebcamUpload', args=(self.subject.pk,))
+        self.manifest_url = reverse('experiments:experimentWebcamManifest', args=(self.subject.pk,))
+
+    def upload_chunk(self, number, data):
+        chunk = SimpleUploadedFile('%s-%05d.webm' % (self.recording, number), data, content_type='video/webm')
+        return self.client.post(self.url, {'file': chunk, 'type': 'video/webm'})
+
+    def put_chunk(self, number, data):
+        url = reverse('experiments:experimentWebcamChunkUpload',
+                      args=(self.subject.pk, '%s-%05d.webm' % (self.recording, number)))
+        return self.client.put(url, data, content_type='application/octet-stream')
+
+    def merge(self):
+        return self.client.post(self.url, {'trialResultId': self.result.pk, 'filename': self.recording})
+
+    def test_merge_recording(self):
+        """
+        Chunks are kept in a folder per recording and merged in order into a folder per experiment and participant.
+        """
+        for number in [2, 0, 10, 1]:
+            self.assertEqual(self.upload_chunk(number, b'chunk %d;' % number).status_code, 204)
+        # Chunks of another recording are not merged
+        other = '1_trial2_Trial_1_' + self.subject.pk
+        self.client.post(self.url, {'file': SimpleUploadedFile(other + '-00000.webm', b'other'), 'type': 'video/webm'})
+        self.assertTrue(os.path.isdir(os.path.join(self.webcam_root, 'chunks', other)))
+
+        self.assertEqual(self.merge().status_code, 204)
+        self.result.refresh_from_db()
+        name = '%s/%s/%s.webm' % (self.experiment.pk, self.subject.pk, self.recording)
+        self.assertEqual(self.result.webcam_file.name, name)
+        with open(os.path.join(self.webcam_root, name), 'rb') as f:
+            self.assertEqual(f.read(), b'chunk 0;chunk 1;chunk 2;chunk 10;')
+        self.assertEqual(sorted(os.listdir(os.path.join(self.webcam_root, 'chunks'))), [other, other + '.lock'])
+
+    def test_append_on_arrival(self):
+        """
+        Chunks are appended to the recording as soon as their predecessors have arrived.
+        """
+        folder = os.path.join(self.webcam_root, 'chunks', self.recording)
+        part = os.path.join(folder, self.recording + '.part')
+        self.upload_chunk(1, b'b')
+        self.upload_chunk(2, b'c')
+        self.assertFalse(os.path.exists(part))
+        self.upload_chunk(0, b'a')
+        with open(part, 'rb') as f:
+            self.assertEqual(f.read(), b'abc')
+        self.assertEqual(sorted(os.listdir(folder)), sorted([self.recording + '.part', 'state']))
+
+    def test_retries(self):
+        """
+        Uploading a chunk again and finishing a recording again do not change the recording.
+        """
+        for number in [0, 1, 0, 1, 2]:
+            self.assertEqual(self.upload_chunk(number, b'%d' % number).status_code, 204)
+        self.assertEqual(self.merge().status_code, 204)
+        self.assertEqual(self.merge().status_code, 204)
+        self.result.refresh_from_db()
+        with open(os.path.join(self.webcam_root, self.result.webcam_file.name), 'rb') as f:
+            self.assertEqual(f.read(), b'012')
+        self.assertEqual(os.listdir(os.path.join(self.webcam_root, 'chunks')), [])
+
+    def test_late_chunk(self):
+        """
+        A chunk arriving after the recording has been finished is refused and does not replace the recording.
+        """
+        self.upload_chunk(0, b'a')
+        self.upload_chunk(1, b'b')
+        self.merge()
+        self.assertEqual(self.upload_chunk(2, b'c').status_code, 409)
+        self.assertEqual(self.put_chunk(2, b'c').status_code, 409)
+        self.assertEqual(os.listdir(os.path.join(self.webcam_root, 'chunks')), [])
+        self.assertEqual(self.merge().status_code, 204)
+        self.result.refresh_from_db()
+        with open(os.path.join(self.webcam_root, self.result.webcam_file.name), 'rb') as f:
+            self.assertEqual(f.read(), b'ab')
+
+    def test_interrupted_append(self):
+        """
+        Data appended after the last recorded state, e.g. by a request that was interrupted, is discarded.
+        """
+        self.upload_chunk(0, b'a')
+        with open(os.path.join(self.webcam_root, 'chunks', self.recording, self.recording + '.part'), 'ab') as f:
+            f.write(b'garbage')
+        self.upload_chunk(1, b'b')
+        self.merge()
+        self.result.refresh_from_db()
+        with open(os.path.join(self.webcam_root, self.result.webcam_file.name), 'rb') as f:
+            self.assertEqual(f.read(), b'ab')
+
+    def test_missing_chunk(self):
+        """
+        Chunks waiting for a chunk which never arrived are appended when the recording is finished.
+        """
+        for number in [0, 2, 3]:
+            self.upload_chunk(number, b'%d' % number)
+        self.merge()
+        self.result.refresh_from_db()
+        with open(os.path.join(self.webcam_root, self.result.webcam_file.name), 'rb') as f:
+            self.assertEqual(f.read(), b'023')
+
+    def test_merge_flat_chunks(self):
+        """
+        Chunks uploaded into WEBCAM_ROOT itself are still merged.
+        """
+        for number in range(3):
+            with open(os.path.join(self.webcam_root, '%s-%05d.webm' % (self.recording, number)), 'wb') as f:
+                f.write(b'%d' % number)
+        self.assertEqual(self.merge().status_code, 204)
+        self.result.refresh_from_db()
+        with open(os.path.join(self.webcam_root, self.result.webcam_file.name), 'rb') as f:
+            self.assertEqual(f.read(), b'012')
+        self.assertEqual(sorted(os.listdir(self.webcam_root)), sorted(['chunks', str(self.experiment.pk)]))
+
+    def test_manifest(self):
+        """
+        The manifest lists the chunks received so far and whether the recording has been finished.
+        """
+        manifest = lambda: self.client.get(self.manifest_url, {'filename': self.recording}).json()
+        self.assertEqual(manifest(), {'filename': self.recording, 'received': [], 'finished': False})
+        for number in [0, 1, 3]:
+            self.upload_chunk(number, b'%d' % number)
+        self.assertEqual(manifest()['received'], [0, 1, 3])
+        self.merge()
+        self.assertEqual(manifest(), {'filename': self.recording, 'received': [], 'finished': True})
+        self.assertEqual(os.listdir(os.path.join(self.webcam_root, 'chunks')), [])
+
+    def test_dropped_connections(self):
+        """
+        A client losing requests and responses uploads the missing chunks again, but not the chunks the server received.
+        """
+        chunks = [os.urandom(1000) for _ in range(40)]
+        client = UploadClient(self, self.recording, chunks)
+        self.assertEqual(client.run().status_code, 204)
+        self.result.refresh_from_db()
+        with open(os.path.join(self.webcam_root, self.result.webcam_file.name), 'rb') as f:
+            self.assertEqual(f.read(), b''.join(chunks))
+        # Chunks whose response was dropped were not uploaded again
+        self.assertGreater(client.dropped, 5)
+        self.assertEqual(sorted(client.uploads), list(range(len(chunks))))
+
+    def test_raw_upload(self):
+        """
+        Chunks sent as raw request bodies are assembled like chunks sent as forms.
+        """
+        for number in [1, 0, 3, 2]:
+            self.assertEqual(self.put_chunk(number, b'%d' % number).status_code, 204)
+        self.assertEqual(self.upload_chunk(4, b'4').status_code, 204)
+        self.assertEqual(self.merge().status_code, 204)
+        self.result.refresh_from_db()
+        with open(os.path.join(self.webcam_root, self.result.webcam_file.name), 'rb') as f:
+            self.assertEqual(f.read(), b'01234')
+        self.assertEqual(self.client.post(reverse('experiments:experimentWebcamChunkUpload',
+                                                  args=(self.subject.pk, 'x-00000.webm'))).status_code, 404)
+
+    def test_foreign_chunks(self):
+        """
+        Chunks are only accepted for existing participants and for recordings named for them.
+        """
+        put = lambda run_uuid, name: self.client.put(reverse('experiments:experimentWebcamChunkUpload', args=(run_uuid, name)),
+                                                     b'x', content_type='application/octet-stream')
+        unknown = '1b9d6bcd-bbfd-4b2d-9b5d-ab8dfbbd4bed'
+        self.assertEqual(put(unknown, '1_trial1_Trial_0_%s-00000.webm' % unknown).status_code, 404)
+        self.assertEqual(put(self.subject.pk, 'x-00000.webm').status_code, 404)
+        self.assertEqual(put(self.subject.pk, '2_trial1_Trial_0_%s-00000.webm' % self.subject.pk).status_code, 404)
+        chunk = SimpleUploadedFile('evil-00000.webm', b'x', content_type='video/webm')
+        self.assertEqual(self.client.post(self.url, {'file': chunk, 'type': 'video/webm'}).status_code, 404)
+        self.assertFalse(os.path.exists(os.path.join(self.webcam_root, 'chunks')))
+
+    def test_foreign_merge(self):
+        """
+        Only recordings named for the participant and of which chunks have been received are merged.
+        """
+        other = SubjectData.objects.create(id='1b9d6bcd-bbfd-4b2d-9b5d-ab8dfbbd4bed', participant_id=2, experiment=self.experiment)
+        other_recording = '2_trial1_Trial_0_' + other.pk
+        chunks.ChunkStore().save_chunk(other, other_recording + '-00000.webm', [b'other'])
+        response = self.client.post(self.url, {'trialResultId': self.result.pk, 'filename': other_recording})
+        self.assertEqual(response.status_code, 404)
+        self.assertTrue(os.path.isdir(os.path.join(self.webcam_root, 'chunks', other_recording)))
+        self.assertEqual(self.client.get(self.manifest_url, {'filename': other_recording}).status_code, 404)
+
+        self.assertEqual(self.merge().status_code, 404)
+        self.assertFalse(os.path.exists(os.path.join(self.webcam_root, str(self.experiment.pk), self.subject.pk, self.recording + '.webm')))
+        self.result.refresh_from_db()
+        self.assertFalse(self.result.webcam_file)
+
+    def test_incomplete_chunk(self):
+        """
+        A chunk of which fewer bytes arrived than announced is discarded.
+        """
+        store = chunks.ChunkStore()
+        for number in [0, 2]:
+            with self.assertRaises(chunks.IncompleteChunk):
+                store.save_chunk(self.subject, '%s-%05d.webm' % (self.recording, number), [b'abc'], length=10)
+        self.assertEqual(store.get_manifest(self.subject, self.recording)['received'], [])
+        store.save_chunk(self.subject, '%s-%05d.webm' % (self.recording, 0), [b'a'], length=1)
+        self.merge()
+        self.result.refresh_from_db()
+        with open(os.path.join(self.webcam_root, self.result.webcam_file.name), 'rb') as f:
+            self.assertEqual(f.read(), b'a')
+
+    def test_copy_file(self):
+        """
+        Files are appended at the current position, inside the kernel or through a buffer.
+        """
+        source = os.path.join(self.webcam_root, 'source')
+        target = os.path.join(self.webcam_root, 'target')
+        data = os.urandom(3 * 1024 * 1024 + 17)
+        with open(source, 'wb') as f:
+            f.write(data)
+        for kernel_copy in [chunks.kernel_copy, lambda in_fd, out_fd, count: None]:
+            with mock.patch('experiments.chunks.kernel_copy', kernel_copy):
+                with open(source, 'rb', buffering=0) as infile, open(target, 'wb', buffering=0) as outfile:
+                    outfile.write(b'head')
+                    self.assertEqual(chunks.copy_file(infile, outfile), len(data))
+                    self.assertEqual(outfile.tell(), len(data) + 4)
+                with open(target, 'rb') as f:
+                    self.assertEqual(f.read(), b'head' + data)
+
+    def test_invalid_names(self):
+        """
+        Chunks and recordings whose names cannot be stored in WEBCAM_ROOT are rejected.
+        """
+        for name in ['..-00000.webm', 'recording.webm']:
+            response = self.client.post(self.url, {'file': SimpleUploadedFile(name, b'data')})
+            self.assertEqual(response.status_code, 404)
+        response = self.client.post(self.url, {'trialResultId': self.result.pk, 'filename': '..'})
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(WEBCAM_ACCEL_REDIRECT_URL='')
+class WebcamFileTests(TestCase):
+    def setUp(self):
+        self.webcam_root = use_temporary_folders(self, WEBCAM_ROOT='')
+        self.experiment = create_experiment(num_subjects=0, recording_option=Experiment.VIDEO)
+        subject = SubjectData.objects.create(id='0f8fad5b-d9cb-469f-a165-70867728950e', experiment=self.experiment)
+        self.name = '%s/%s/1_trial1_Trial_0_%s.webm' % (self.experiment.pk, subject.pk, subject.pk)
+        self.data = os.urandom(5000)
+        os.makedirs(os.path.dirname(os.path.join(self.webcam_root, self.name)))
+        with open(os.path.join(self.webcam_root, self.name), 'wb') as f:
+            f.write(self.data)
+        self.url = settings.WEBCAM_URL + self.name
+        self.client.force_login(self.experiment.user)
+
+    def test_access(self):
+        """
+        Webcam files are only sent to users with access to the results of their experiment.
+        """
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, 302)
+        self.client.force_login(User.objects.create_user(username='other', password='secret'))
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        Experiment.objects.filter(pk=self.experiment.pk).update(sharing_option='PUB')
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertEqual(self.client.get(settings.WEBCAM_URL + 'chunks/recording/recording.part').status_code, 404)
+
+    def test_flat_file(self):
+        """
+        Webcam files merged into WEBCAM_ROOT itself are found through their trial result.
+        """
+        with open(os.path.join(self.webcam_root, 'recording.webm'), 'wb') as f:
+            f.write(self.data)
+        self.assertEqual(self.client.get(settings.WEBCAM_URL + 'recording.webm').status_code, 404)
+        TrialResult.objects.create(subject=SubjectData.objects.get(experiment=self.experiment),
+                                   trialitem=TrialItem.objects.first(), webcam_file='recording.webm')
+        self.assertEqual(self.client.get(settings.WEBCAM_URL + 'recording.webm').status_code, 200)
+
+    def test_range(self):
+        """
+        Byte ranges of webcam files can be requested, so that videos can be seeked.
+        """
+        response = self.client.get(self.url)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Type'], 'video/webm')
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+        for header, first, last in [('bytes=100-199', 100, 199), ('bytes=4000-', 4000, 4999),
+                                    ('bytes=-500', 4500, 4999), ('bytes=4900-9999', 4900, 4999)]:
+            response = self.client.get(self.url, HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], 'bytes %d-%d/5000' % (first, last))
+            self.assertEqual(response['Content-Length'], str(last - first + 1))
+            self.assertEqual(b''.join(response.streaming_content), self.data[first:last + 1])
+        response = self.client.get(self.url, HTTP_RANGE='bytes=5000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */5000')
+
+    def test_accel_redirect(self):
+        """
+        With an internal nginx location, Django only checks access and nginx sends the file.
+        """
+        with override_settings(WEBCAM_ACCEL_REDIRECT_URL='/protected-webcam/'):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-webcam/' + self.name)
+        self.assertEqual(response.content, b'')
+
+
+class UploadClient:
+    """
+    Uploads the chunks of a recording like webcam.js: a few chunks at a time, arriving in any order,
+    over a connection which drops requests before they reach the server, or their responses afterwards.
+    After a failed upload, the manifest of the recording is requested and only the missing chunks are uploaded again.
+    """
+
+    def __init__(self, test, recording, chunks, parallel=3, drop_rate=0.3, seed=0):
+        self.test = test
+        self.recording = recording
+        self.queue = dict(enumerate(chunks))
+        self.parallel = parallel
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.uploads = []
+        self.dropped = 0
+
+    def send(self, number):
+        """
+        Uploads a chunk and returns whether the client received the response.
+        """
+        drop = self.random.random() < self.drop_rate
+        self.dropped += drop
+        if drop and self.random.random() < 0.5:
+            return False
+        self.uploads.append(number)
+        response = self.test.upload_chunk(number, self.queue[number])
+        return response.status_code == 204 and not drop
+
+    def run(self):
+        while self.queue:
+            batch = sorted(self.queue)[:self.parallel]
+            self.random.shuffle(batch)
+            failed = False
+            for number in batch:
+                if self.send(number):
+                    del self.queue[number]
+                else:
+                    failed = True
+            if failed:
+                manifest = self.test.client.get(self.test.manifest_url, {'filename': self.recording}).json()
+                for number in manifest['received']:
+                    self.queue.pop(number, None)
+        return self.test.merge()
+
+
+class ParallelReportTests(TestCase):
+    def setUp(self):
+        use_temporary_folders(self, REPORTS_ROOT='reports', REPORTS_CACHE_ROOT='cache')
+
+    def create_gaze_experiment(self, num_subjects):
+        """
+        Creates an eye-tracking experiment whose participants recorded gaze in all trials.
+        """
+        experiment = create_experiment(num_subjects=num_subjects, recording_option=Experiment.EYE)
+        TrialItem.objects.update(record_gaze=True)
+        for result in TrialResult.objects.all():
+            result.webgazer_data = [{'x': 100 * result.pk, 'y': 900, 't': 10.5}, {'x': 1500.5, 'y': 100, 't': 20}]
+            result.save()
+        return experiment
+
+    def test_worker_renders_same_workbook(self):
+        """
+        A workbook rendered in a worker process is identical to the workbook rendered in the report process.
+        """
+        experiment = self.create_gaze_experiment(num_subjects=1)
+        reporter = Reporter(experiment)
+        subject = SubjectData.objects.get()
+        reporter.load_trial_results([subject])
+        workbook_data = reporter.get_workbook_data(subject)
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            self.assertEqual(executor.submit(render_workbook_data, workbook_data).result(), 
+                             render_workbook_data(workbook_data))
+
+    @mock.patch('experiments.reporter.BATCH_SIZE', 2)
+    @mock.patch('experiments.reporter.datetime')
+    def test_parallel_report(self, mock_datetime):
+        """
+        Rendering workbooks in parallel creates the same report as rendering them one after another,
+        with the workbooks in the same order.
+        """
+        mock_datetime.datetime.now.return_value = datetime.datetime(2024, 1, 1, 12, 0)
+        experiment = self.create_gaze_experiment(num_subjects=5)
+        with zipfile.ZipFile(Reporter(experiment, workers=1).create_report()) as zip_file:
+            serial = {name: zip_file.read(name) for name in zip_file.namelist()}
+
+        # Keep one cached workbook, which is added between the workbooks rendered in parallel
+        kept = SubjectData.objects.get(participant_id=3).id
+        cache_folder = os.path.join(settings.REPORTS_CACHE_ROOT, str(experiment.pk))
+        for subject_folder in os.listdir(cache_folder):
+            if subject_folder != kept:
+                shutil.rmtree(os.path.join(cache_folder, subject_folder))
+        job = ReportJob.objects.create(experiment=experiment)
+        with zipfile.ZipFile(Reporter(experiment, job, workers=2).create_report()) as zip_file:
+            self.assertEqual(zip_file.namelist(), list(serial))
+            for name in zip_file.namelist():
+                self.assertEqual(zip_file.read(name), serial[name])
+        self.assertEqual(len(os.listdir(cache_folder)), 5)
+        self.assertEqual(job.completed, 5)
+
+class TidyReportTests(TestCase):
+    def setUp(self):
+        use_temporary_folders(self, REPORTS_ROOT='reports', REPORTS_CACHE_ROOT='cache')
+
+    def create_gaze_experiment(self):
+        """
+        Creates an eye-tracking experiment of three participants, the first of whom did not record any gaze.
+        """
+        experiment = create_experiment(num_subjects=3, recording_option=Experiment.EYE)
+        TrialItem.objects.update(record_gaze=True)
+        TrialResult.objects.update(start_time=100)
+        for result in TrialResult.objects.exclude(subject__participant_id=1):
+            result.webgazer_data = [{'x': 100, 'y': 900, 't': 10.5}, {'x': 1500.5, 'y': 100, 't': 20}]
+            result.save()
+        return experiment
+
+    def read_tables(self, filename, read):
+        """
+        Returns the tables of a tidy report, read with the given function.
+        """
+        with zipfile.ZipFile(filename) as zip_file:
+            return {os.path.splitext(name)[0]: read(io.BytesIO(zip_file.read(name))) for name in zip_file.namelist()}
+
+    @mock.patch('experiments.tidy.BATCH_SIZE', 2)
+    def test_csv_tables(self):
+        """
+        The tables of all participants are written in batches, with a row per participant, trial and gaze sample.
+        """
+        experiment = self.create_gaze_experiment()
+        filename = TidyReporter(experiment).create_report()
+        tables = self.read_tables(filename, pd.read_csv)
+        self.assertEqual(sorted(tables), ['gaze', 'participants', 'trials'])
+        self.assertEqual(list(tables['participants']['Participant Number']), [1, 2, 3])
+        self.assertEqual(list(tables['trials'].columns[:3]), ['Participant Number', 'Participant UUID', 'Outer Block'])
+        self.assertEqual(len(tables['trials']), 3 * 6)
+        self.assertEqual(list(tables['trials']['Response Time (ms)'].unique()), [400])
+        self.assertEqual(list(tables['gaze'].columns[:6]), ['Participant Number', 'Participant UUID', 'Trial Number',
+                                                            'Trial Label', 'Trial Code', 'x'])
+        self.assertEqual(list(tables['gaze']['Participant Number'].unique()), [2, 3])
+        self.assertEqual(len(tables['gaze']), 2 * 6 * 2)
+        self.assertEqual(list(tables['gaze']['Gaze Area (row,col)'][:2]), ['(2,1)', '(1,2)'])
+
+    @mock.patch('experiments.tidy.BATCH_SIZE', 2)
+    def test_columns_of_later_batches(self):
+        """
+        Keys recorded only by participants of later batches are written as columns of the gaze table.
+        """
+        experiment = self.create_gaze_experiment()
+        result = TrialResult.objects.filter(subject__participant_id=3).order_by('pk').first()
+        result.webgazer_data = [{'x': 100, 'y': 900, 't': 10.5, 'confidence': 0.5}]
+        result.save()
+        gaze = self.read_tables(TidyReporter(experiment).create_report(), pd.read_csv)['gaze']
+        self.assertEqual(list(gaze.columns[5:9]), ['x', 'y', 't', 'confidence'])
+        self.assertEqual(list(gaze['confidence'].dropna()), [0.5])
+
+        writer = CsvTableWriter(settings.REPORTS_ROOT, 'table', {}, ['a'])
+        with self.assertRaises(ValueError):
+            writer.write(pd.DataFrame({'a': [1], 'b': [2]}))
+        writer.close()
+
+    @skipUnless(parquet_available(), 'pyarrow is not installed')
+    @mock.patch('experiments.tidy.BATCH_SIZE', 2)
+    def test_parquet_tables(self):
+        """
+        Parquet tables contain the same values as CSV tables, with the same types in all batches.
+        """
+        experiment = self.create_gaze_experiment()
+        csv_tables = self.read_tables(TidyReporter(experiment).create_report(), pd.read_csv)
+        parquet_tables = self.read_tables(TidyReporter(experiment, report_format=ReportJob.PARQUET).create_report(), 
+                                          pd.read_parquet)
+        self.assertEqual(sorted(parquet_tables), sorted(csv_tables))
+        for name, table in parquet_tables.items():
+            pd.testing.assert_frame_equal(table.astype(object).where(table.notna(), None), 
+                                          csv_tables[name].astype(object).where(csv_tables[name].notna(), None), 
+                                          check_dtype=False)
+        self.assertEqual(str(parquet_tables['gaze']['x'].dtype), 'Float64')
+
+    def test_tidy_report_job(self):
+        """
+        Requesting tidy data creates a job of that format, which the worker writes as tables.
+        """
+        experiment = create_experiment(num_subjects=2)
+        self.client.force_login(experiment.user)
+        self.client.get(reverse('experiments:experimentReport', args=(experiment.pk,)) + '?format=' + ReportJob.CSV)
+        job = ReportJob.objects.get(experiment=experiment)
+        self.assertEqual(job.report_format, ReportJob.CSV)
+        response = self.client.get(reverse('experiments:experimentReport', args=(experiment.pk,)) + '?format=XYZ')
+        self.assertEqual(response.status_code, 404)
+
+        call_command('processreports', '--once', stdout=open(os.devnull, 'w'))
+        job.refresh_from_db()
+        self.assertEqual(job.status, ReportJob.DONE)
+        with zipfile.ZipFile(os.path.join(settings.REPORTS_ROOT, job.output_file)) as zip_file:
+            self.assertEqual(sorted(zip_file.namelist()), ['participants.csv', 'trials.csv'])
+
+class ReporterQueryTests(TestCase):
+    def test_trial_worksheet_query_count(self):
+        """
+        The number of queries for the trial and eye-tracking worksheets does not grow with the number of trials,
+        blocks are only loaded once per list and trial results are shared by both worksheets.
+        """
+        experiment = create_experiment(num_subjects=2, num_blocks=3, num_trials=10, recording_option=Experiment.EYE)
+        subjects = list(SubjectData.objects.order_by('participant_id'))
+        reporter = Reporter(experiment)
+        with self.assertNumQueries(2):
+            worksheet = reporter.create_trial_worksheet(subjects[0])
+        self.assertEqual(len(worksheet.index), 30)
+        with self.assertNumQueries(0):
+            reporter.create_webgazer_worksheet(subjects[0])
+        with self.assertNumQueries(1):
+            reporter.create_trial_worksheet(subjects[1])
+
+    def test_trial_results_loaded_in_batches(self):
+        """
+        The trial results of several participants are loaded in a single query.
+        """
+        experiment = create_experiment(num_subjects=3, recording_option=Experiment.EYE)
+        subjects = list(SubjectData.objects.order_by('participant_id'))
+        reporter = Reporter(experiment)
+        with self.assertNumQueries(1):
+            reporter.load_trial_results(subjects)
+        with self.assertNumQueries(0):
+            for subject in subjects:
+                reporter.create_webgazer_worksheet(subject)
+
+    def test_answers_loaded_in_batches(self):
+        """
+        The answers and CDI results of several participants are loaded in a query per type of answer,
+        and the questions are only loaded once per report.
+        """
+        experiment = create_experiment(num_subjects=3)
+        ConsentQuestion.objects.create(experiment=experiment, text='I agree', position=0)
+        text_question = Question.objects.create(experiment=experiment, text='Name', required=True, position=0)
+        age_question = Question.objects.create(experiment=experiment, text='Age', required=True, position=1,
+                                               question_type=Question.AGE)
+        sex_question = Question.objects.create(experiment=experiment, text='Sex', required=True, position=2,
+                                               question_type=Question.SEX)
+        subjects = list(SubjectData.objects.select_related('listitem').order_by('participant_id'))
+        for subject in subjects:
+            AnswerText.objects.create(question=text_question, subject_data=subject, body=subject.id)
+            AnswerInteger.objects.create(question=age_question, subject_data=subject, body=subject.participant_id)
+            AnswerRadio.objects.create(question=sex_question, subject_data=subject, body='female')
+            CdiResult.objects.create(subject=subject, given_label='dog', response=True)
+
+        reporter = Reporter(experiment)
+        with self.assertNumQueries(7):
+            reporter.load_answers(subjects)
+        with self.assertNumQueries(2):
+            reporter.create_subject_worksheet(subjects[0])
+        with self.assertNumQueries(0):
+            worksheets = [reporter.create_subject_worksheet(subject)[0] for subject in subjects[1:]]
+        self.assertEqual(worksheets[1]['1. I agree'], 'Y')
+        self.assertEqual(worksheets[1]['1. Name'], subjects[2].id)
+        self.assertEqual(worksheets[1]['2. Age'], '3')
+        self.assertEqual(worksheets[1]['3. Sex'], 'female')
+        self.assertEqual(worksheets[1]['dog'], True)
+
+    def test_inferred_trial_numbers(self):
+        """
+        If trial numbers are not unique, trials are numbered by their position among the participant's trial results.
+        """
+        experiment = create_experiment(num_subjects=2)
+        TrialResult.objects.update(trial_number=1)
+        subjects = list(SubjectData.objects.order_by('participant_id'))
+        reporter = Reporter(experiment)
+        reporter.load_trial_results(subjects)
+        for subject in subjects:
+            self.assertEqual(list(reporter.create_trial_worksheet(subject)['Trial Number']), [1, 2, 3, 4, 5, 6])
+
+
+def reference_roi_response(width, height, rows, cols, coords):
+    """
+    Row and col responded to, as determined for a single coordinate before areas were classified with NumPy.
+    """
+    boundaries_r = list(range(0, height, int(height/rows)))
+    boundaries_r.append(height)
+    boundaries_c = list(range(0, width, int(width/cols)))
+    boundaries_c.append(width)
+    if coords[0] > max(boundaries_c):
+        col_num = len(boundaries_c) - 1
+    else:
+        col_num = next(i for i,c in enumerate(boundaries_c) if c >= coords[0])
+    if coords[1] > max(boundaries_r):
+        row_num = len(boundaries_r) - 1
+    else:
+        row_num = next(i for i,r in enumerate(boundaries_r) if r >= coords[1])
+    return f'({row_num},{col_num})'
+
+
+class AOIGridTests(TestCase):
+    def test_same_areas_as_reference(self):
+        """
+        Areas of whole coordinate arrays match those determined one coordinate at a time,
+        including coordinates on the boundaries and beyond the screen.
+        """
+        rnd = random.Random(0)
+        for width, height, rows, cols in [(1920, 1080, 2, 2), (1366, 768, 3, 7), (1000, 10, 1, 3), (1280, 1024, 5, 1)]:
+            grid = AOIGrid(width, height, rows, cols)
+            x = [rnd.randint(-100, width + 100) for _ in range(500)] + list(grid.boundaries_c) + [0.5, width + 0.5]
+            y = [rnd.randint(-100, height + 100) for _ in range(500)] + list(grid.boundaries_r)[:1] * len(grid.boundaries_c) + [height, 0.5]
+            expected = [reference_roi_response(width, height, rows, cols, coords) for coords in zip(x, y)]
+            self.assertEqual(list(grid.label(x, y)), expected)
+            self.assertEqual(grid.label(x[0], y[0]), expected[0])
+
+
+def gaze_result(trial_number, webgazer_data, is_calibration=False, grid=(2, 2)):
+    """
+    Creates an unsaved trial result with the eye-tracking data of a trial.
+    """
+    trialitem = SimpleNamespace(label='trial %s' % trial_number, code='code', record_gaze=True,
+                                is_calibration=is_calibration, grid_row=grid[0], grid_col=grid[1])
+    return SimpleNamespace(trialitem=trialitem, webgazer_data=webgazer_data, gaze_samples=None, report_trial_number=trial_number,
+                           resolution_w=1920, resolution_h=1080)
+
+
+class GazeFrameTests(TestCase):
+    def test_columns_and_areas(self):
+        """
+        Eye-tracking data of all trials is combined into one data frame with the trial and area columns.
+        """
+        validation = {'trial_type': 'validation', 'x': [1, None], 'y': [2, 3], 'accuracy': 50}
+        results = [
+            gaze_result(1, [validation, {'x': 100, 'y': 900, 't': 0.5}], is_calibration=True),
+            gaze_result(2, [{'x': 1500, 'y': 100, 't': 1.5}, {'x': 1500, 'y': 900, 't': 2.5}], grid=(1, 1)),
+            gaze_result(3, [{'x': 1500, 'y': 100, 't': 3.5}]),
+            gaze_result(4, []),
+        ]
+        webgazer_data, validation_data = create_gaze_frames(results)
+        self.assertEqual(list(webgazer_data.columns), ['Trial Number', 'Trial Label', 'Trial Code', 'x', 'y', 't',
+                                                       'Nrows', 'Ncols', 'Gaze Area (row,col)'])
+        self.assertEqual(list(webgazer_data['Trial Number']), [1, 2, 2, 3])
+        self.assertEqual(list(webgazer_data['Gaze Area (row,col)']), ['(2,1)', '', '', '(1,2)'])
+        self.assertEqual(list(validation_data.columns), ['Trial Number', 'Trial Label', 'Trial Code', 'x', 'y', 'accuracy'])
+        self.assertEqual(list(validation_data['accuracy']), [50, 50])
+        self.assertTrue(validation_data['x'].isna().iloc[1])
+
+    def test_missing_values(self):
+        """
+        Values missing in some samples and calibration trials without samples are left empty.
+        """
+        validation = {'trial_type': 'validation', 'x': [1], 'y': [2]}
+        results = [
+            gaze_result(1, [validation], is_calibration=True),
+            gaze_result(2, [{'x': 100, 'y': 900}, {'x': 1500, 'y': 100, 't': 1.5}]),
+        ]
+        webgazer_data, validation_data = create_gaze_frames(results)
+        self.assertEqual(len(webgazer_data), 2)
+        self.assertTrue(webgazer_data['t'].isna().iloc[0])
+        self.assertEqual(len(validation_data), 1)
+
+    def test_no_gaze(self):
+        """
+        Participants without eye-tracking data get empty data frames.
+        """
+        webgazer_data, validation_data = create_gaze_frames([gaze_result(1, None)])
+        self.assertTrue(webgazer_data.empty)
+        self.assertTrue(validation_data.empty)
+
+    def test_packed_samples(self):
+        """
+        Packed gaze samples give the same data frames as samples stored as JSON.
+        """
+        validation = {'trial_type': 'validation', 'x': [1, None], 'y': [2, 3], 'accuracy': 50}
+        recorded = [
+            (1, [validation, {'x': 100, 'y': 900, 't': 0.5}, {'x': -5, 'y': 1200, 't': 1.25}], True),
+            (2, [{'x': 1500, 'y': 100, 't': 1}, {'x': 1500, 'y': 900, 't': 2}], False),
+            (3, [{'x': 1500, 'y': 100, 't': 3.5}, {'x': 1500.5, 'y': 100, 't': 4.5}], False),
+        ]
+        frames = create_gaze_frames([gaze_result(n, data, is_calibration) for n, data, is_calibration in recorded])
+        results = []
+        for n, data, is_calibration in recorded:
+            result = gaze_result(n, data, is_calibration)
+            result.webgazer_data, result.gaze_samples = encode_webgazer_data(data)
+            results.append(result)
+        self.assertEqual([r.webgazer_data for r in results], [[validation], [], recorded[2][1]])
+        for frame, expected in zip(create_gaze_frames(results), frames):
+            pd.testing.assert_frame_equal(frame, expected)
+
+
+class GazeSamplesTests(TestCase):
+    def test_round_trip(self):
+        """
+        Gaze samples are packed without loss, and compressed if that makes them smaller.
+        """
+        samples = [{'x': 100 + n % 3, 'y': -900, 't': n * 16.7} for n in range(1000)]
+        packed = pack_samples(samples)
+        self.assertLess(len(packed), 10 * len(samples))
+        self.assertLess(len(packed), len(pack_samples(samples, compress=False)))
+        self.assertEqual(decode_webgazer_data([], packed), samples)
+        self.assertEqual(unpack_samples(packed)['t'].dtype, np.float64)
+
+        samples = [{'x': 1, 'y': 2, 't': 3}]
+        self.assertEqual(decode_webgazer_data([], pack_samples(samples)), samples)
+        self.assertEqual(unpack_samples(pack_samples(samples))['t'].dtype, np.int64)
+
+    def test_unpackable(self):
+        """
+        Values which are not plain gaze samples are kept as JSON.
+        """
+        for data in [[], [{'x': 1.5, 'y': 2, 't': 3}], [{'x': 1, 'y': 2}], [{'x': 1, 'y': 2, 't': 3, 'z': 4}],
+                     [{'x': True, 'y': 2, 't': 3}], [{'x': 2 ** 40, 'y': 2, 't': 3}], [{'x': 1, 'y': 2, 't': 3}, [1]]]:
+            self.assertEqual(encode_webgazer_data(data), (data, None))
+
+    def test_store_and_pack(self):
+        """
+        Stored results pack their gaze samples, and packgaze packs the samples of results stored before.
+        """
+        experiment = create_experiment(num_subjects=1, num_trials=2)
+        samples = [{'x': 100, 'y': 900, 't': 10.5}, {'x': 1500, 'y': 100, 't': 20}]
+        TrialResult.objects.update(webgazer_data=samples)
+        result = TrialResult.objects.first()
+        result.set_webgazer_data([{'x': 1.5, 'y': 2, 't': 3}])
+        result.save()
+
+        call_command('packgaze', '--batch-size', '1', stdout=open(os.devnull, 'w'))
+        results = TrialResult.objects.order_by('pk')
+        self.assertIsNone(results[0].gaze_samples)
+        for result in results[1:]:
+            self.assertEqual(result.webgazer_data, [])
+            self.assertTrue(result.has_webgazer_data)
+            self.assertEqual(result.get_webgazer_data(), samples)
+
+        subject = SubjectData.objects.create(id='0f8fad5b-d9cb-469f-a165-70867728950e', participant_id=2,
+                                             experiment=experiment, listitem=ListItem.objects.get(experiment=experiment))
+        data = {'trialitem': results[0].trialitem_id, 'start_time': 0, 'end_time': 500, 'key_pressed': 'space',
+                'trial_number': 1, 'resolution_w': 1920, 'resolution_h': 1080, 'webgazer_data': json.dumps(samples)}
+        self.client.post(reverse('experiments:storeResult', args=(subject.pk,)), data)
+        result = TrialResult.objects.get(subject=subject)
+        self.assertIsNotNone(result.gaze_samples)
+        self.assertEqual(result.get_webgazer_data(), samples)
+
+
+class GazeSummaryTests(TestCase):
+    def setUp(self):
+        use_temporary_folders(self, REPORTS_ROOT='reports', REPORTS_CACHE_ROOT='cache')
+
+    def test_resample(self):
+        """
+        Gaze is resampled to a fixed rate by holding the latest sample, leaving gaps in the recording empty.
+        """
+        times, x, y = resample_gaze([68, 0, 34, 300], [3, 1, 2, 4], [1, 1, 1, 1], 30)
+        self.assertEqual(len(times), 10)
+        self.assertEqual(times[3], 100)
+        self.assertEqual(list(x[:5]), [1, 1, 2, 3, 3])
+        self.assertTrue(np.isnan(x[5:9]).all())
+        self.assertEqual(x[9], 4)
+        self.assertEqual([len(values) for values in resample_gaze([], [], [], 30)], [0, 0, 0])
+
+    def test_summary(self):
+        """
+        Dwell times, first looks and looks are summarised per area of interest of the grid.
+        """
+        summary = summarise_gaze([0, 34, 68, 300, 334], [100, 100, 1800, 1800, 100], [100, 100, 100, 100, 900],
+                                 1920, 1080, 2, 2, 30)
+        self.assertEqual((summary['rate'], summary['samples'], summary['valid']), (30, 5, 7))
+        self.assertEqual(summary['areas'], [
+            {'area': '(1,1)', 'dwell': 100.0, 'first_look': 0.0, 'looks': 1},
+            {'area': '(1,2)', 'dwell': 133.333, 'first_look': 100.0, 'looks': 2},
+            {'area': '(2,1)', 'dwell': 0.0, 'first_look': None, 'looks': 0},
+            {'area': '(2,2)', 'dwell': 0.0, 'first_look': None, 'looks': 0},
+        ])
+
+    def test_store_and_report(self):
+        """
+        Gaze is summarised when results are stored or by summarisegaze, and the summaries are reported per area.
+        """
+        experiment = create_experiment(num_subjects=1, recording_option=Experiment.EYE)
+        samples = [{'x': 100, 'y': 900, 't': 34 * n} for n in range(30)]
+        validation = {'trial_type': 'validation', 'x': [1], 'y': [2], 'accuracy': 50}
+        TrialItem.objects.filter(pk=TrialItem.objects.order_by('pk').first().pk).update(is_calibration=True)
+        for result in TrialResult.objects.select_related('trialitem').order_by('pk'):
+            result.set_webgazer_data(([validation] if result.trialitem.is_calibration else []) + samples)
+            result.save()
+
+        call_command('summarisegaze', '--rate', '20', stdout=open(os.devnull, 'w'))
+        result = TrialResult.objects.order_by('pk').first()
+        self.assertEqual(result.gaze_summary['rate'], 20)
+        self.assertEqual(result.gaze_summary['samples'], 30)
+        self.assertEqual(result.gaze_summary['areas'][2], {'area': '(2,1)', 'dwell': 1000.0, 'first_look': 0.0, 'looks': 1})
+
+        subject = SubjectData.objects.create(id='0f8fad5b-d9cb-469f-a165-70867728950e', participant_id=2,
+                                             experiment=experiment, listitem=ListItem.objects.get(experiment=experiment),
+                                             resolution_w=1920, resolution_h=1080)
+        results = [{'client_seq': 'a:1', 'trialitem': result.trialitem_id, 'start_time': 0, 'end_time': 500, 'key_pressed': 'space',
+                    'trial_number': 1, 'resolution_w': 1920, 'resolution_h': 1080, 'webgazer_data': [validation] + samples}]
+        self.client.post(reverse('experiments:storeResults', args=(subject.pk,)), json.dumps({'results': results}),
+                         content_type='application/json')
+        summary = TrialResult.objects.get(subject=subject).gaze_summary
+        self.assertEqual((summary['rate'], summary['samples']), (settings.GAZE_SAMPLING_RATE, 30))
+
+        tables = {}
+        with zipfile.ZipFile(TidyReporter(experiment).create_report()) as zip_file:
+            for name in zip_file.namelist():
+                tables[name] = pd.read_csv(io.BytesIO(zip_file.read(name)))
+        summary_table = tables['gaze_summary.csv']
+        self.assertEqual(len(summary_table), 7 * 4)
+        self.assertEqual(list(summary_table.columns[-5:]), ['Sampling Rate (Hz)', 'Gaze Area (row,col)', 'Dwell Time (ms)', 'First Look (ms)', 'Looks'])
+        self.assertEqual(list(summary_table['Participant Number'].unique()), [1, 2])
+
+        workbook_data = Reporter(experiment).get_workbook_data(SubjectData.objects.get(participant_id=1))
+        self.assertEqual(len(create_gaze_summary_frame(workbook_data['gaze_trials'])), 6 * 4)
+        with zipfile.ZipFile(io.BytesIO(render_workbook_data(workbook_data))) as zip_file:
+            self.assertIn(b'name="EyeTrackingSummary"', zip_file.read('xl/workbook.xml'))
@@ -0,0 +1,332 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.text import get_valid_filename
+from .models import SubjectData, TrialResult, Question, ConsentQuestion, CdiResult, ReportJob
+from .reporter import Reporter, BATCH_SIZE, create_gaze_frames, create_gaze_summary_frame
+from .gaze import SAMPLE_KEYS
+from .archive import write_archive
+
+import os
+import shutil
+import tempfile
+import logging
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Create a logger for this file
+logger = logging.getLogger(__name__)
+
+# Types of the columns of each table, columns not listed are written as text
+PARTICIPANT_TYPES = {
+    'Global Timeout': 'Int64',
+    'Participant Number': 'Int64',
+    'CDI estimate': 'Float64',
+}
+TRIAL_TYPES = {
+    'Participant Number': 'Int64',
+    'Randomized': 'boolean',
+    'Trial Number': 'Int64',
+    'Visual Onset (ms)': 'Int64',
+    'Audio Onset (ms)': 'Int64',
+    'Max Duration (ms)': 'Int64',
+    'Nrows': 'Int64',
+    'Ncols': 'Int64',
+    'Response Time (ms)': 'Float64',
+    'Record Media': 'boolean',
+    'Screen Width': 'Int64',
+    'Screen Height': 'Int64',
+    'Record Gaze': 'boolean',
+}
+GAZE_TYPES = {
+    'Participant Number': 'Int64',
+    'Trial Number': 'Int64',
+    'x': 'Float64',
+    'y': 'Float64',
+    't': 'Float64',
+    'Nrows': 'Int64',
+    'Ncols': 'Int64',
+}
+VALIDATION_TYPES = {
+    'Participant Number': 'Int64',
+    'Trial Number': 'Int64',
+    'target_x': 'Float64',
+    'target_y': 'Float64',
+    'x': 'Float64',
+    'y': 'Float64',
+    'accuracy': 'Float64',
+    'precision_rms': 'Float64',
+    'precision_sd_x': 'Float64',
+    'precision_sd_y': 'Float64',
+}
+GAZE_SUMMARY_TYPES = {
+    'Participant Number': 'Int64',
+    'Trial Number': 'Int64',
+    'Nrows': 'Int64',
+    'Ncols': 'Int64',
+    'Sampling Rate (Hz)': 'Int64',
+    'Dwell Time (ms)': 'Float64',
+    'First Look (ms)': 'Float64',
+    'Looks': 'Int64',
+}
+
+
+def parquet_available():
+    """
+    Returns whether tables can be written as Parquet files, which requires the optional pyarrow package.
+    """
+    return pq is not None
+
+
+def convert_types(frame, column_types):
+    """
+    Converts the columns of a data frame to the given types, so that the types do not depend on the values of a chunk.
+    Empty values are converted to missing values.
+    """
+    for column in frame.columns:
+        column_type = column_types.get(column, 'string')
+        values = frame[column].mask(frame[column] == '')
+        if column_type in ['Int64', 'Float64']:
+            values = pd.to_numeric(values)
+        frame[column] = values.astype(column_type)
+    return frame
+
+
+class TableWriter:
+    """
+    Writes a table in chunks of rows, all having the given columns or else the columns of the first chunk.
+    A chunk with other columns raises a ValueError instead of losing their values.
+    """
+    extension = ''
+
+    def __init__(self, folder, name, column_types, columns=None):
+        self.name = name + self.extension
+        self.path = os.path.join(folder, self.name)
+        self.column_types = column_types
+        self.columns = columns
+        self.written = False
+
+    def write(self, frame):
+        """
+        Appends the rows of a data frame to the table.
+        """
+        if frame.columns.empty:
+            return
+        if self.columns is None:
+            self.columns = list(frame.columns)
+        unknown = [column for column in frame.columns if column not in self.columns]
+        if unknown:
+            raise ValueError('Columns %s are not columns of table %s.' % (', '.join(map(str, unknown)), self.name))
+        frame = frame.reindex(columns=self.columns)
+        self.write_chunk(convert_types(frame.reset_index(drop=True), self.column_types))
+        self.written = True
+
+
+class CsvTableWriter(TableWriter):
+    """
+    Writes a table to a CSV file.
+    """
+    extension = '.csv'
+
+    def __init__(self, folder, name, column_types, columns=None):
+        super().__init__(folder, name, column_types, columns)
+        self.file = None
+
+    def write_chunk(self, frame):
+        header = self.file is None
+        if header:
+            self.file = open(self.path, 'w', newline='', encoding='utf-8')
+        frame.to_csv(self.file, header=header, index=False)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+class ParquetTableWriter(TableWriter):
+    """
+    Writes a table to a Parquet file, with a row group per chunk.
+    """
+    extension = '.parquet'
+
+    def __init__(self, folder, name, column_types, columns=None):
+        super().__init__(folder, name, column_types, columns)
+        self.writer = None
+
+    def write_chunk(self, frame):
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+class TidyReporter(Reporter):
+    """
+    Utility for generating the results of an experiment as tidy tables in a zip file to be downloaded:
+    one row per participant, per trial and per gaze sample, instead of a workbook per participant.
+    The participants are processed in batches, so that memory use does not grow with the size of the experiment.
+    """
+
+    def __init__(self, experiment, job=None, report_format=ReportJob.CSV):
+        super().__init__(experiment, job)
+        if report_format == ReportJob.PARQUET:
+            if not parquet_available():
+                raise ImproperlyConfigured('Writing Parquet files requires the pyarrow package.')
+            self.table_writer = ParquetTableWriter
+        else:
+            self.table_writer = CsvTableWriter
+        self.output_file = get_valid_filename(experiment.exp_name + '_tidy.zip')
+
+
+    def get_participant_columns(self):
+        """
+        Returns the columns of the participant table, including a column per question and CDI item.
+        """
+        columns = ['Experiment Name', 'Global Timeout', 'List', 'Participant Number', 'Participant UUID',
+                   'Participation Date', 'Aspect Ratio', 'Resolution', 'Random Seed']
+        for model in [ConsentQuestion, Question]:
+            for position, text in model.objects.filter(experiment=self.experiment.pk).order_by('position', 'pk') \
+                                               .values_list('position', 'text'):
+                columns.append(f'{position + 1}. {text}')
+        columns += ['CDI estimate', 'CDI instrument']
+        columns += CdiResult.objects.filter(subject__experiment=self.experiment.pk).order_by('given_label') \
+                                    .values_list('given_label', flat=True).distinct()
+        return columns
+
+
+    def get_gaze_columns(self):
+        """
+        Returns the columns of the gaze table and of the validation table, including a column per key recorded
+        in any trial of the experiment, as values which could not be packed may have further keys.
+        """
+        trial_columns = ['Participant Number', 'Participant UUID', 'Trial Number', 'Trial Label', 'Trial Code']
+        sample_keys = dict.fromkeys(SAMPLE_KEYS)
+        validation_keys = {}
+        # Only the values kept as JSON are read, packed samples always have the keys in SAMPLE_KEYS
+        results = TrialResult.objects.filter(subject__experiment=self.experiment.pk, trialitem__record_gaze=True) \
+                                     .order_by('subject__created', 'subject', 'pk') \
+                                     .values_list('webgazer_data', 'trialitem__is_calibration')
+        for webgazer_data, is_calibration in results.iterator():
+            if is_calibration and webgazer_data:
+                validation_keys.update(dict.fromkeys(key for key in webgazer_data[0] if key != 'trial_type'))
+                webgazer_data = webgazer_data[1:]
+            for sample in webgazer_data:
+                sample_keys.update(dict.fromkeys(sample))
+        return (trial_columns + list(sample_keys) + ['Nrows', 'Ncols', 'Gaze Area (row,col)'],
+                trial_columns + list(validation_keys))
+
+
+    def create_participant_table(self, subjects, columns):
+        """
+        Creates a dataframe containing a row per participant.
+        """
+        return pd.DataFrame([self.get_subject_data(subject) for subject in subjects], columns=columns)
+
+
+    def get_participant_id_columns(self, subjects):
+        """
+        Returns the columns identifying the participant of a trial result, see `create_gaze_frames`.
+        """
+        participant_ids = {subject.pk: subject.participant_id for subject in subjects}
+        return [('Participant Number', lambda result: participant_ids[result.subject_id]),
+                ('Participant UUID', lambda result: result.subject_id)]
+
+
+    def get_batch_trial_results(self, subjects):
+        """
+        Returns the trial results of all participants of a batch who were assigned a list.
+        """
+        return [result for subject in subjects if subject.listitem_id for result in self.get_trial_results(subject)]
+
+
+    def create_trial_table(self, subjects):
+        """
+        Creates a dataframe containing the trial results of the participants, built from the rows of all participants at once.
+        """
+        rows = [[subject.participant_id, subject.id] + row
+                for subject in subjects if subject.listitem_id for row in self.get_trial_data(subject)]
+        if not rows:
+            return pd.DataFrame()
+        return pd.DataFrame(rows, columns=['Participant Number', 'Participant UUID'] + self.trial_columns)
+
+
+    def create_gaze_tables(self, subjects):
+        """
+        Creates dataframes containing the eye-tracking results, the validation results and the gaze summaries of the participants,
+        each built from the trial results of all participants at once.
+        """
+        trial_results = self.get_batch_trial_results(subjects)
+        id_columns = self.get_participant_id_columns(subjects)
+        webgazer_data, validation_data = create_gaze_frames(trial_results, id_columns)
+        return [webgazer_data, validation_data, create_gaze_summary_frame(trial_results, id_columns)]
+
+
+    def write_tables(self, archive, tables):
+        """
+        Adds the written tables to a report archive.
+        """
+        for table in tables:
+            if table.written:
+                yield from archive.add_file(table.path, table.name)
+
+
+    def create_report(self):
+        """
+        Creates a zip file containing the tables of participants, trials and gaze samples of an experiment.
+        """
+        subject_ids = list(SubjectData.objects.filter(experiment__pk=self.experiment.pk).order_by('created', 'pk') \
+                                              .values_list('pk', flat=True))
+        if self.job:
+            self.job.total = len(subject_ids)
+            self.job.completed = 0
+            self.job.save(update_fields=['total', 'completed', 'updated'])
+
+        participant_columns = self.get_participant_columns()
+        record_gaze = self.experiment.recording_option in ['EYE', 'ALL']
+        gaze_columns, validation_columns = self.get_gaze_columns() if record_gaze else (None, None)
+        table_folder = tempfile.mkdtemp(dir=self.output_folder)
+        participants = self.table_writer(table_folder, 'participants', PARTICIPANT_TYPES, participant_columns)
+        trials = self.table_writer(table_folder, 'trials', TRIAL_TYPES)
+        gaze = self.table_writer(table_folder, 'gaze', GAZE_TYPES, gaze_columns)
+        validation = self.table_writer(table_folder, 'gaze_validation', VALIDATION_TYPES, validation_columns)
+        gaze_summary = self.table_writer(table_folder, 'gaze_summary', GAZE_SUMMARY_TYPES)
+        tables = [participants, trials, gaze, validation, gaze_summary]
+        try:
+            try:
+                for i in range(0, len(subject_ids), BATCH_SIZE):
+                    subjects = list(SubjectData.objects.filter(pk__in=subject_ids[i:i + BATCH_SIZE]) \
+                                                       .select_related('experiment', 'listitem').order_by('created', 'pk'))
+                    self.load_batch(subjects)
+
+                    participants.write(self.create_participant_table(subjects, participant_columns))
+                    trials.write(self.create_trial_table(subjects))
+                    if record_gaze:
+                        gaze_table, validation_table, summary_table = self.create_gaze_tables(subjects)
+                        gaze.write(gaze_table)
+                        validation.write(validation_table)
+                        gaze_summary.write(summary_table)
+
+                    # Release the results of the batch
+                    self.release_batch(subjects)
+
+                    if self.job:
+                        self.job.completed += len(subjects)
+                        self.job.save(update_fields=['completed', 'updated'])
+            finally:
+                # The tables are complete once closed, before they are added to the archive
+                for table in tables:
+                    table.close()
+            output_path = os.path.join(self.output_folder, self.output_file)
+            write_archive(output_path, lambda archive: self.write_tables(archive, tables))
+        finally:
+            shutil.rmtree(table_folder, ignore_errors=True)
+
+        return output_path
@@ -22,7 +22,10 @@ urlpatterns = [
 
     re_path(r'^(?P<run_uuid>[0-9A-Fa-f-]+)/run$', views.experimentRun, name='experimentRun'),
     re_path(r'^(?P<run_uuid>[0-9A-Fa-f-]+)/run/upload$', webcam.webcam_upload, name='experimentWebcamUpload'),
+    re_path(r'^(?P<run_uuid>[0-9A-Fa-f-]+)/run/upload/manifest$', webcam.webcam_upload_manifest, name='experimentWebcamManifest'),
+    re_path(r'^(?P<run_uuid>[0-9A-Fa-f-]+)/run/upload/(?P<filename>[^/]+)$', webcam.webcam_upload_chunk, name='experimentWebcamChunkUpload'),
     re_path(r'^(?P<run_uuid>[0-9A-Fa-f-]+)/run/storeresult$', views.storeResult, name='storeResult'),
+    re_path(r'^(?P<run_uuid>[0-9A-Fa-f-]+)/run/storeresults$', views.storeResults, name='storeResults'),
     re_path(r'^(?P<run_uuid>[0-9A-Fa-f-]+)/run/pause$', views.experimentPause, name='experimentPause'),
     re_path(r'^(?P<run_uuid>[0-9A-Fa-f-]+)/run/thankyou$', views.experimentEnd, name='experimentEnd'),
     re_path(r'^(?P<run_uuid>[0-9A-Fa-f-]+)/run/deletesubject$', views.deleteSubject, name='deleteSubject'),
@@ -31,8 +34,14 @@ urlpatterns = [
     re_path(r'^$', views.index, name='index'),
 
     re_path(r'^admin/experiments/experiment/(?P<experiment_id>[0-9A-Fa-f-]+)/report$', views.experimentReport, name='experimentReport'),
+    re_path(r'^admin/experiments/experiment/(?P<experiment_id>[0-9A-Fa-f-]+)/report/stream$', views.experimentReportStream, name='experimentReportStream'),
+    re_path(r'^admin/experiments/report/(?P<job_id>[0-9A-Fa-f-]+)/$', views.reportStatus, name='reportStatus'),
+    re_path(r'^admin/experiments/report/(?P<job_id>[0-9A-Fa-f-]+)/progress$', views.reportProgress, name='reportProgress'),
+    re_path(r'^admin/experiments/report/(?P<job_id>[0-9A-Fa-f-]+)/download$', views.reportDownload, name='reportDownload'),
     re_path(r'^admin/experiments/experiment/(?P<experiment_id>[0-9A-Fa-f-]+)/export$', views.experimentExport, name='experimentExport'),
     re_path(r'^admin/experiments/import$', views.experimentImport, name='experimentImport'),
+    re_path(r'^admin/experiments/trialresult/(?P<result_id>\d+)/webgazer$', views.trialResultWebgazerData, name='trialResultWebgazerData'),
+    re_path(r'^admin/experiments/templatecache$', views.templateCacheStats, name='templateCacheStats'),
 
     re_path('^accounts/', admin.site.urls),
 ]
@@ -1,18 +1,23 @@
 from django.shortcuts import get_object_or_404, render, redirect
-from django.http import HttpResponseRedirect, Http404, JsonResponse, HttpResponse
+from django.http import HttpResponseRedirect, Http404, JsonResponse, HttpResponse, StreamingHttpResponse
 from django.urls import reverse
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
-from django.template import Template, RequestContext
+from django.template import RequestContext
 from django.db.utils import DEFAULT_DB_ALIAS
+from django.core.exceptions import PermissionDenied
+from django.db import IntegrityError, transaction
 
-from random import shuffle
+import random
 
-from .models import Question, Experiment, SubjectData, ListItem, OuterBlockItem, BlockItem, TrialItem, TrialResult, ConsentQuestion
+from .models import Question, Experiment, SubjectData, ListItem, OuterBlockItem, BlockItem, TrialItem, TrialResult, ConsentQuestion, \
+                    ReportJob
 from .forms import SubjectDataForm, ConsentForm, ImportForm
-from .reporter import Reporter
 from .admin import ExperimentAdmin
 from .decorators import login_required
+from .reporter import Reporter
+from .template_cache import get_page_template, template_cache
+from .webcam import has_experiment_access
 
 import dateutil.parser
 import simplejson as json
@@ -23,6 +28,9 @@ import requests
 # Create a logger for this file
 logger = logging.getLogger(__name__)
 
+# Maximum number of trial results accepted by storeResults at once
+RESULT_BATCH_SIZE = 100
+
 def proceedToExperiment(experiment, run_uuid):
     # skip webcam/microphone test if experiment not configured to record video/audio.
     if experiment.recording_option == 'NON' or experiment.recording_option == 'EYE': 
@@ -34,17 +42,96 @@ def proceedToExperiment(experiment, run_uuid):
 @login_required(next='/admin/experiments/experiment')
 def experimentReport(request, experiment_id):
     """ 
-    Generates the zip file containing the participants' results and webcam/audio data for an experiment. 
+    Requests the zip file containing the participants' results and webcam/audio data for an experiment. 
+    The zip file is generated in the background, see the `processreports` management command.
+    The `format` parameter selects workbooks per participant (default) or tidy tables of the whole experiment.
+    """
+    experiment = get_object_or_404(Experiment, pk=experiment_id)
+    report_format = request.GET.get('format', ReportJob.WORKBOOKS)
+    if report_format not in dict(ReportJob.FORMAT_OPTIONS):
+        raise Http404('Unknown report format.')
+
+    # reuse a report of the experiment that is still being generated
+    job = ReportJob.objects.filter(experiment=experiment, report_format=report_format, 
+                                   status__in=[ReportJob.PENDING, ReportJob.RUNNING]).first()
+    if not job:
+        job = ReportJob.objects.create(experiment=experiment, user=request.user, report_format=report_format)
+        logger.info('Requested report %s.' % job.pk)
+
+    return HttpResponseRedirect(reverse('experiments:reportStatus', args=(job.pk,)))
+
+
+@login_required(next='/admin/experiments/experiment')
+def experimentReportStream(request, experiment_id):
+    """
+    Sends the zip file containing the participants' results and webcam/audio data for an experiment
+    while it is being generated, without storing it on the server.
     """
     experiment = get_object_or_404(Experiment, pk=experiment_id)
+    # Workbooks are rendered in a pool of processes by processreports only, not in a request worker
+    reporter = Reporter(experiment, workers=1)
+    response = StreamingHttpResponse(reporter.stream_report(), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="' + reporter.output_file + '"'
+    return response
+
+
+@login_required(next='/admin/experiments/experiment')
+def reportStatus(request, job_id):
+    """
+    Generates the page showing the progress of a report.
+    """
+    job = get_object_or_404(ReportJob, pk=job_id)
+    return render(request, 'experiments/report.html', {'job': job, 'experiment': job.experiment})
+
+
+@login_required(next='/admin/experiments/experiment')
+def reportProgress(request, job_id):
+    """
+    Returns the progress of a report, polled by the report page.
+    """
+    job = get_object_or_404(ReportJob, pk=job_id)
+    return JsonResponse({
+        'status': job.status,
+        'statusDisplay': job.get_status_display(),
+        'total': job.total,
+        'completed': job.completed,
+        'progress': job.progress,
+        'error': job.error,
+        'downloadUrl': reverse('experiments:reportDownload', args=(job.pk,)) if job.status == ReportJob.DONE else '',
+    })
 
-    r = Reporter(experiment)
-    filename = r.create_report()
-    logger.info('Successfully created report with name %s.' % filename)
+
+@login_required(next='/admin/experiments/experiment')
+def templateCacheStats(request):
+    """
+    Returns the hit/miss counters of the compiled page templates cached by this process.
+    """
+    if not request.user.is_superuser:
+        raise PermissionDenied
+    return JsonResponse(template_cache.stats())
+
+
+@login_required(next='/admin/experiments/subjectdata')
+def trialResultWebgazerData(request, result_id):
+    """
+    Returns the webgazer data of a trial result, which is loaded on request from the participant data admin page.
+    """
+    trial_result = get_object_or_404(TrialResult.objects.select_related('subject__experiment'), pk=result_id)
+    if not has_experiment_access(request.user, trial_result.subject.experiment):
+        raise Http404('Page not found.')
+    return JsonResponse(trial_result.get_webgazer_data(), safe=False)
+
+
+@login_required(next='/admin/experiments/experiment')
+def reportDownload(request, job_id):
+    """
+    Redirects to the zip file of a finished report.
+    """
+    job = get_object_or_404(ReportJob, pk=job_id, status=ReportJob.DONE)
 
     fs = FileSystemStorage(location=settings.REPORTS_ROOT, base_url=settings.REPORTS_URL)
 
-    return redirect(fs.url(os.path.basename(filename)))
+    return redirect(fs.url(job.output_file))
 
 
 def experimentExport(request, experiment_id):
@@ -76,7 +163,7 @@ def informationPage(request, experiment_id):
     Generates the first page, the welcome page of an experiment.
     """
     experiment = get_object_or_404(Experiment, pk=experiment_id)
-    t = Template(experiment.information_page_tpl)
+    t = get_page_template(experiment, 'information_page_tpl')
     c = RequestContext(request, {'experiment':experiment})
     return HttpResponse(t.render(c))
 
@@ -87,7 +174,7 @@ def browserCheck(request, experiment_id):
     Only Firefox and Chrome are supported. 
     """
     experiment = get_object_or_404(Experiment, pk=experiment_id)
-    t = Template(experiment.browser_check_page_tpl)
+    t = get_page_template(experiment, 'browser_check_page_tpl')
     c = RequestContext(request, {'experiment':experiment})
     return HttpResponse(t.render(c))
 
@@ -98,7 +185,7 @@ def consentForm(request, experiment_id):
     """
     experiment = get_object_or_404(Experiment, pk=experiment_id)
     form = ConsentForm(experiment=experiment)
-    t = Template(experiment.introduction_page_tpl)
+    t = get_page_template(experiment, 'introduction_page_tpl')
     c = RequestContext(request, {'consent_form': form, 'experiment': experiment})
     return HttpResponse(t.render(c))
 
@@ -114,11 +201,11 @@ def consentFormSubmit(request, experiment_id):
         for key, value in request.POST.items():
             if key.startswith('question_'):
                 if value.lower() == 'no':
-                    t = Template(experiment.consent_fail_page_tpl)
+                    t = get_page_template(experiment, 'consent_fail_page_tpl')
                     c = RequestContext(request, {'experiment': experiment})
                     return HttpResponse(t.render(c))
         return HttpResponseRedirect(reverse('experiments:subjectForm', args=(experiment_id,)))
-    t = Template(experiment.introduction_page_tpl)
+    t = get_page_template(experiment, 'introduction_page_tpl')
     c = RequestContext(request, {'consent_form': form, 'experiment': experiment})
     return HttpResponse(t.render(c))
 
@@ -129,7 +216,7 @@ def subjectForm(request, experiment_id):
     """
     experiment = get_object_or_404(Experiment, pk=experiment_id)
     form = SubjectDataForm(experiment=experiment)
-    t = Template(experiment.demographic_data_page_tpl)
+    t = get_page_template(experiment, 'demographic_data_page_tpl')
     c = RequestContext(request, {'subject_data_form': form, 'experiment': experiment, 'recaptcha_site_key': settings.GOOGLE_RECAPTCHA_SITE_KEY})
     return HttpResponse(t.render(c))
 
@@ -140,7 +227,7 @@ def subjectFormSubmit(request, experiment_id):
     """
     experiment = get_object_or_404(Experiment, pk=experiment_id)
     form = SubjectDataForm(request.POST, experiment=experiment)
-    t = Template(experiment.demographic_data_page_tpl)
+    t = get_page_template(experiment, 'demographic_data_page_tpl')
     c = RequestContext(request, {'subject_data_form': form, 'experiment': experiment, 'recaptcha_site_key': settings.GOOGLE_RECAPTCHA_SITE_KEY})
     
     if form.is_valid():
@@ -214,15 +301,104 @@ def createTrialDict(trial, block, trial_number):
     return trial_dict
 
 
+def buildTrialPlan(list_item):
+    """ 
+    Returns the compiled trial plan of a list: its outer blocks, inner blocks and trials in order,
+    with the details of each trial (see `createTrialDict`) but without trial numbers. 
+    """
+    outer_blocks = {ob.pk: {'randomise_inner_blocks': ob.randomise_inner_blocks, 'blocks': []}
+                    for ob in list_item.outerblockitem_set.all().order_by('position', 'pk')}
+    blocks = {}
+    for b in BlockItem.objects.filter(outerblockitem__listitem=list_item).order_by('position', 'pk'):
+        blocks[b.pk] = {'randomise_trials': b.randomise_trials, 'trials': []}
+        outer_blocks[b.outerblockitem_id]['blocks'].append(blocks[b.pk])
+    for t in TrialItem.objects.filter(blockitem__outerblockitem__listitem=list_item).select_related('blockitem') \
+                              .order_by('position', 'pk'):
+        blocks[t.blockitem_id]['trials'].append(createTrialDict(t, t.blockitem, None))
+    return {'outer_blocks': list(outer_blocks.values())}
+
+
+def getTrialPlan(list_item):
+    """ 
+    Returns the compiled trial plan of a list, which is compiled once and stored with the list 
+    until any of its blocks or trials change. 
+    The plan is only stored if the list has not been invalidated since it was read, so that a plan compiled
+    while blocks or trials are being changed is compiled again by the next participant instead of being kept.
+    """
+    if list_item.trial_plan is None:
+        list_item.trial_plan = buildTrialPlan(list_item)
+        ListItem.objects.filter(pk=list_item.pk, trial_plan_version=list_item.trial_plan_version) \
+                        .update(trial_plan=list_item.trial_plan)
+    return list_item.trial_plan
+
+
+def orderTrialPlan(plan, rng):
+    """ 
+    Returns the trial item ids of a trial plan in the order they are presented to a participant:
+    inner blocks and trials are randomised with `rng` (a random.Random) if required. 
+    """
+    trial_order = []
+    block_items = []
+
+    # retrieve all block items from all outer blocks
+    for ob in plan['outer_blocks']:
+        inner_blocks = list(ob['blocks'])
+
+        if ob['randomise_inner_blocks']:
+            rng.shuffle(inner_blocks)
+
+        block_items += inner_blocks
+
+    # retrieve all trial items from all block items
+    for b in block_items:
+        trial_items = [t['trial_id'] for t in b['trials']]
+
+        if b['randomise_trials']:
+            rng.shuffle(trial_items)
+
+        trial_order += trial_items
+    return trial_order
+
+
+def getTrialOrder(subject_data, plan):
+    """ 
+    Returns the trial order of a participant, which is drawn with a new random seed at the first run 
+    and stored with the participant, so that reloading or resuming the experiment presents the same order. 
+    """
+    if subject_data.trial_order is None:
+        subject_data.random_seed = random.SystemRandom().getrandbits(63)
+        subject_data.trial_order = orderTrialPlan(plan, random.Random(subject_data.random_seed))
+        SubjectData.objects.filter(pk=subject_data.pk).update(random_seed=subject_data.random_seed,
+                                                              trial_order=subject_data.trial_order)
+    return subject_data.trial_order
+
+
+def applyTrialPlan(plan, trial_order, completed_trials, trial_number):
+    """ 
+    Returns the trials of a participant from a trial plan in the given trial order: completed trials (a set of trial item ids) 
+    are left out and the remaining trials are numbered starting from `trial_number`. 
+    Trials no longer in the plan are skipped and trials added to the plan after the order was drawn follow in plan order. 
+    """
+    trial_dicts = {t['trial_id']: t for ob in plan['outer_blocks'] for b in ob['blocks'] for t in b['trials']}
+    ordered = set(trial_order)
+    trial_order = list(trial_order) + [trial_id for trial_id in trial_dicts if trial_id not in ordered]
+
+    trials = []
+    for trial_id in trial_order:
+        # subtract completed trials from trial list
+        if trial_id in completed_trials or trial_id not in trial_dicts:
+            continue
+        trials.append(dict(trial_dicts[trial_id], trial_number=trial_number))
+        trial_number += 1
+    return trials
+
+
 def experimentRun(request, run_uuid):
     """ 
     Generates the (main) experimental task of an experiment. 
     """
-    subject_data = get_object_or_404(SubjectData, pk=run_uuid)
-    experiment = get_object_or_404(Experiment, pk=subject_data.experiment.pk)
-    trials = []
-    completed_trials = []
-    block_items = []
+    subject_data = get_object_or_404(SubjectData.objects.select_related('experiment', 'listitem'), pk=run_uuid)
+    experiment = subject_data.experiment
     loading_image = experiment.loading_image if experiment.loading_image else ''
     trial_number = 1
 
@@ -235,48 +411,22 @@ def experimentRun(request, run_uuid):
             subject_data.save()
         list_item = subject_data.listitem
 
-        # QuerySet of all outer block items of the list
-        outer_block_items = list_item.outerblockitem_set.all().order_by('position')
-
         # search for existing trial results
-        all_trial_results = TrialResult.objects.filter(subject__id=run_uuid)
-        trial_number += all_trial_results.count()
-        
-        # exclude pause trials
-        trial_results = all_trial_results.exclude(key_pressed='PAUSE')
-        if trial_results.exists():
-            # construct list of completed trials
-            for tr in list(trial_results):
-                completed_trials.append(get_object_or_404(TrialItem, pk=tr.trialitem.id))
-
-        # retrieve all block items from all outer blocks
-        for ob in outer_block_items:
-            inner_blocks = list(ob.blockitem_set.all().order_by('position'))
+        all_trial_results = list(TrialResult.objects.filter(subject__id=run_uuid).values_list('trialitem', 'key_pressed'))
+        trial_number += len(all_trial_results)
 
-            if ob.randomise_inner_blocks:
-                shuffle(inner_blocks)
-            
-            block_items += inner_blocks
+        # construct set of completed trials, excluding pause trials
+        completed_trials = {trialitem for trialitem, key_pressed in all_trial_results if key_pressed != 'PAUSE'}
 
-        # retrieve all trial items from all block items
-        for b in block_items:
-            trial_items = list(b.trialitem_set.all().order_by('position'))
-
-            if b.randomise_trials:
-                shuffle(trial_items)
-
-            # subtract completed trials from trial list
-            trial_items = [x for x in trial_items if x not in completed_trials]
-
-            for t in trial_items:
-                trials.append(createTrialDict(t, b, trial_number))
-                trial_number += 1
+        # apply the stored trial order of the participant to the compiled trial plan of the list
+        plan = getTrialPlan(list_item)
+        trials = applyTrialPlan(plan, getTrialOrder(subject_data, plan), completed_trials, trial_number)
 
     except (KeyError, AttributeError, OuterBlockItem.DoesNotExist, BlockItem.DoesNotExist, TrialItem.DoesNotExist) as e:
         logger.exception('Failed to run experiment: ' + str(e))
         return HttpResponseRedirect(reverse('experiments:experimentError', args=(run_uuid,)))
     else:
-        t = Template(experiment.experiment_page_tpl)
+        t = get_page_template(experiment, 'experiment_page_tpl')
         c = RequestContext(request, {
             'subject_data': subject_data,
             'loading_image': loading_image,
@@ -290,14 +440,35 @@ def experimentRun(request, run_uuid):
         return HttpResponse(t.render(c))
 
 
+def parseClientSeq(value):
+    """
+    Returns the sequence number given by the experiment page to a trial result, raising a ValueError if it is invalid.
+    """
+    client_seq = str(value)
+    if not client_seq or len(client_seq) > TrialResult._meta.get_field('client_seq').max_length:
+        raise ValueError('Invalid sequence number.')
+    return client_seq
+
+
 def storeResult(request, run_uuid):
     """ 
     Stores the results of a trial to a TrialResult object. 
     """
     if request.method == 'POST':
+        client_seq = request.POST.get('client_seq') or None
+        if client_seq:
+            try:
+                client_seq = parseClientSeq(client_seq)
+            except ValueError:
+                return HttpResponse(status=400)
+            # the result was stored before, but the response did not reach the experiment page
+            existing = TrialResult.objects.filter(subject=run_uuid, client_seq=client_seq).values_list('pk', flat=True).first()
+            if existing is not None:
+                return JsonResponse({'resultId': existing})
         trialresult = TrialResult()
         trialresult.subject = get_object_or_404(SubjectData, pk=run_uuid)
         trialresult.trialitem = get_object_or_404(TrialItem, pk=int(request.POST.get('trialitem')))
+        trialresult.client_seq = client_seq
         trialresult.start_time = request.POST.get('start_time')
         trialresult.end_time = request.POST.get('end_time')
         trialresult.key_pressed = request.POST.get('key_pressed')
@@ -305,14 +476,76 @@ def storeResult(request, run_uuid):
         trialresult.trial_number = int(request.POST.get('trial_number'))
         trialresult.resolution_w = int(request.POST.get('resolution_w'))
         trialresult.resolution_h = int(request.POST.get('resolution_h'))
-        trialresult.webgazer_data = json.loads(request.POST.get('webgazer_data'))
-        trialresult.save()
+        trialresult.set_webgazer_data(json.loads(request.POST.get('webgazer_data')))
+        trialresult.summarise_gaze()
+        try:
+            with transaction.atomic():
+                trialresult.save()
+        except IntegrityError:
+            # the same result was stored by a concurrent request
+            trialresult = get_object_or_404(TrialResult, subject=run_uuid, client_seq=trialresult.client_seq)
         return JsonResponse({'resultId': trialresult.pk})
     else:
         logger.error('Failed to store result.')
         raise Http404('Page not found.')
 
 
+def storeResults(request, run_uuid):
+    """ 
+    Stores the results of several trials at once. The request body is a JSON object {"results": [...]} containing
+    the fields posted to storeResult per trial, with webgazer_data as a list, and a sequence number (client_seq) per result.
+    Results whose sequence number has already been stored are skipped, so that a batch can safely be sent again.
+    """
+    if request.method != 'POST':
+        logger.error('Failed to store results.')
+        raise Http404('Page not found.')
+
+    subject_data = get_object_or_404(SubjectData.objects.only('id', 'experiment'), pk=run_uuid)
+    try:
+        results = json.loads(request.body)['results']
+        if not isinstance(results, list) or len(results) > RESULT_BATCH_SIZE:
+            raise ValueError('Expected a list of at most %d results.' % RESULT_BATCH_SIZE)
+        trial_results = [TrialResult(
+            subject=subject_data,
+            trialitem_id=int(result['trialitem']),
+            client_seq=parseClientSeq(result['client_seq']),
+            start_time=float(result['start_time']),
+            end_time=float(result['end_time']),
+            key_pressed=result.get('key_pressed'),
+            trial_number=int(result['trial_number']),
+            resolution_w=int(result.get('resolution_w', 0)),
+            resolution_h=int(result.get('resolution_h', 0)),
+            webgazer_data=result.get('webgazer_data', []),
+        ) for result in results]
+        seqs = [trial_result.client_seq for trial_result in trial_results]
+        if len(set(seqs)) != len(seqs):
+            raise ValueError('Invalid sequence numbers.')
+        if not all(isinstance(trial_result.webgazer_data, list) for trial_result in trial_results):
+            raise ValueError('Invalid gaze data.')
+        for trial_result in trial_results:
+            trial_result.set_webgazer_data(trial_result.webgazer_data)
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logger.error('Failed to store results: ' + str(e))
+        return HttpResponse(status=400)
+
+    # all trial items have to belong to the experiment of the participant
+    trial_ids = {trial_result.trialitem_id for trial_result in trial_results}
+    trial_items = TrialItem.objects.filter(pk__in=trial_ids, blockitem__outerblockitem__listitem__experiment=subject_data.experiment_id) \
+                                   .only('pk', 'record_gaze', 'is_calibration', 'grid_row', 'grid_col').in_bulk()
+    if len(trial_ids) != len(trial_items):
+        raise Http404('Trial not found.')
+    for trial_result in trial_results:
+        trial_result.trialitem = trial_items[trial_result.trialitem_id]
+        trial_result.summarise_gaze()
+
+    with transaction.atomic():
+        stored = set(TrialResult.objects.filter(subject=subject_data, client_seq__in=seqs).values_list('client_seq', flat=True))
+        trial_results = [trial_result for trial_result in trial_results if trial_result.client_seq not in stored]
+        # conflicts only arise from a concurrent request storing the same results
+        TrialResult.objects.bulk_create(trial_results, ignore_conflicts=True)
+    return JsonResponse({'stored': [trial_result.client_seq for trial_result in trial_results], 'duplicates': sorted(stored)})
+
+
 def experimentPause(request, run_uuid):
     """ 
     Generates the pause page of an experiment.
@@ -326,18 +559,18 @@ def experimentPause(request, run_uuid):
 
     # retrieve completed trials
     all_trial_results = TrialResult.objects.filter(subject=subject_data)
-    # retrieve the last trial result as a TrialItem is required for the creation of a TrialResult.
-    last_trial_result = all_trial_results.exclude(key_pressed='PAUSE').order_by('-id').first()
+    # retrieve the trial item of the last trial result as a TrialItem is required for the creation of a TrialResult.
+    last_trialitem = all_trial_results.exclude(key_pressed='PAUSE').order_by('-id').values_list('trialitem', flat=True).first()
         
-    if last_trial_result: # only store pause as trial result when not the first trial
+    if last_trialitem: # only store pause as trial result when not the first trial
         trialresult = TrialResult()
         trialresult.subject = subject_data
-        trialresult.trialitem = last_trial_result.trialitem
+        trialresult.trialitem_id = last_trialitem
         trialresult.key_pressed = 'PAUSE'
         trialresult.trial_number = all_trial_results.count() + 1
         trialresult.save()
     
-    t = Template(experiment.pause_page_tpl)
+    t = get_page_template(experiment, 'pause_page_tpl')
     c = RequestContext(request, {'subject_id': run_uuid, 'trial_id': trial_id,'experiment': experiment,})
     return HttpResponse(t.render(c))
 
@@ -348,7 +581,7 @@ def experimentError(request, run_uuid):
     """
     subject_data = get_object_or_404(SubjectData, pk=run_uuid)
     experiment = get_object_or_404(Experiment, pk=subject_data.experiment.pk)
-    t = Template(experiment.error_page_tpl)
+    t = get_page_template(experiment, 'error_page_tpl')
     c = RequestContext(request, {})
     return HttpResponse(t.render(c))
 
@@ -359,7 +592,7 @@ def experimentEnd(request, run_uuid):
     """
     subject_data = get_object_or_404(SubjectData, pk=run_uuid)
     experiment = get_object_or_404(Experiment, pk=subject_data.experiment.pk)
-    t = Template(experiment.thank_you_page_tpl)
+    t = get_page_template(experiment, 'thank_you_page_tpl')
     c = RequestContext(request, {'experiment':experiment, 'subject_id': run_uuid})
     
     if subject_data.listitem:
@@ -380,7 +613,7 @@ def experimentEnd(request, run_uuid):
 
         # if experiment incomplete, render end page after discontinuation
         if completed_count < tr_count:
-            t = Template(experiment.thank_you_abort_page_tpl)
+            t = get_page_template(experiment, 'thank_you_abort_page_tpl')
     return HttpResponse(t.render(c))
 
 
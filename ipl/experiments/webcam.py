@@ -1,23 +1,37 @@
 from django.shortcuts import get_object_or_404, render
-from django.http import Http404, JsonResponse, HttpResponse, HttpResponseRedirect
+from django.http import Http404, JsonResponse, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.urls import reverse
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
-from django.utils.text import get_valid_filename
-from django.template import Template, RequestContext
+from django.template import RequestContext
 from django.views.decorators.csrf import ensure_csrf_cookie
+from django.contrib.auth.decorators import login_required
+from django.utils.http import http_date
+from urllib.parse import quote
 
 from .models import SubjectData, TrialResult, Experiment
+from .chunks import ChunkStore, IncompleteChunk, RecordingFinished, MissingRecording, split_chunk_name, is_subject_recording
+from .template_cache import get_page_template
 
 import os.path
-import uuid
 import re
+import uuid
 import logging
+import mimetypes
 
 
 # Create a logger for this file
 logger = logging.getLogger(__name__)
 
+# Number of bytes of a raw chunk upload read from the request at once
+CHUNK_READ_SIZE = 256 * 1024
+
+# Number of bytes of a webcam file sent at once when it is served by Django
+FILE_BLOCK_SIZE = 256 * 1024
+
+# Single byte range of a Range header, e.g. bytes=0-1023, bytes=1024- or bytes=-500
+RANGE_HEADER = re.compile(r'^bytes=(\d*)-(\d*)$')
+
 @ensure_csrf_cookie
 def webcam_test(request, run_uuid):
     """
@@ -28,9 +42,9 @@ def webcam_test(request, run_uuid):
     c = RequestContext(request, {'subject_data': subject_data, 'experiment': experiment,})
     
     if experiment.recording_option == 'VID' or experiment.recording_option == 'ALL':
-        t = Template(experiment.webcam_check_page_tpl)
+        t = get_page_template(experiment, 'webcam_check_page_tpl')
     elif experiment.recording_option == 'AUD': # audio
-        t = Template(experiment.microphone_check_page_tpl)  
+        t = get_page_template(experiment, 'microphone_check_page_tpl')  
     else: # no recording required
         return HttpResponseRedirect(reverse('experiments:experimentRun', args = (str(run_uuid),)))
     #return render(request, experiment.webcam_check_page_tpl.path, {'subject_data': subject_data, 'experiment': experiment,})
@@ -62,42 +76,53 @@ def webcam_test_upload(request, run_uuid):
         raise Http404('Page not found.')
 
 
+def check_recording_name(subject_data, recording):
+    """
+    Raises a ValueError if a recording is not a recording of the participant it was requested for.
+    """
+    if not is_subject_recording(subject_data, recording):
+        raise ValueError('%r is not a recording of participant %s.' % (recording, subject_data.pk))
+
+
+def check_chunk_name(subject_data, name):
+    """
+    Raises a ValueError if an uploaded chunk is not a chunk of a recording of the participant it was uploaded for.
+    """
+    check_recording_name(subject_data, split_chunk_name(name)[0])
+
+
 def webcam_upload(request, run_uuid):
     """
     Receives upload requests for video/audio chunks during the experiment and
     merges these chunks into a file.
     """
 
-    fs = FileSystemStorage(location=settings.WEBCAM_ROOT)
+    store = ChunkStore()
 
     # Upload request
     if request.method == 'POST' and request.FILES.get('file'):
+        subject_data = get_object_or_404(SubjectData, pk=run_uuid)
         webcam_file = request.FILES.get('file')
         # webcam_file_type = request.POST.get('type')
 
-        # Delete existing file
-        if fs.exists(webcam_file.name):
-            fs.delete(webcam_file.name)
-
-        fs.save(get_valid_filename(webcam_file.name), webcam_file)
+        try:
+            check_chunk_name(subject_data, webcam_file.name)
+            store.save_chunk(subject_data, webcam_file.name, webcam_file.chunks())
+        except ValueError as e:
+            logger.exception('Failed to save webcam chunk: ' + str(e))
+            raise Http404('Invalid filename.')
+        except RecordingFinished as e:
+            logger.warning('Refused webcam chunk %s: %s' % (webcam_file.name, e))
+            return HttpResponse(status=409)
         logger.info('Received upload request of %s.' % webcam_file.name)
         return HttpResponse(status=204)
 
     # Merge request
     elif request.method == 'POST' and request.POST.get('trialResultId'):
-        # Get base filename, by removing chunk number at the end
+        # Get base filename, without chunk number at the end
         base_filename = request.POST.get('filename')
-        base_filename = get_valid_filename(base_filename)
         logger.info('Received last file of %s, merge files.' % base_filename)
 
-        # Find and merge individual chunks
-        webcam_files = find_files(base_filename)
-        merge_files(base_filename + '.webm', webcam_files)
-
-        # Delete chunks
-        for webcam_file in webcam_files:
-            fs.delete(webcam_file)
-
         # Add filename to trial result
         trial_result_id = 0
         try:
@@ -105,9 +130,20 @@ def webcam_upload(request, run_uuid):
         except ValueError as e:
             logger.exception('Failed to retrieve trial result ID: ' + str(e))
             raise Http404('Invalid trialResultId.')
-        trial_result = get_object_or_404(TrialResult, pk=trial_result_id, subject=run_uuid)
-        trial_result.webcam_file = base_filename + '.webm'
-        trial_result.save()
+        trial_result = get_object_or_404(TrialResult.objects.select_related('subject').defer(*TrialResult.GAZE_FIELDS),
+                                         pk=trial_result_id, subject=run_uuid)
+
+        # Merge individual chunks and delete them
+        try:
+            check_recording_name(trial_result.subject, base_filename)
+            trial_result.webcam_file = store.merge(trial_result.subject, base_filename)
+        except ValueError as e:
+            logger.exception('Failed to merge webcam chunks: ' + str(e))
+            raise Http404('Invalid filename.')
+        except MissingRecording as e:
+            logger.error('Failed to merge webcam chunks: ' + str(e))
+            raise Http404('Recording not found.')
+        trial_result.save(update_fields=['webcam_file'])
         logger.info('Successfully saved webcam file to trial result.')
         return HttpResponse(status=204)
 
@@ -116,39 +152,149 @@ def webcam_upload(request, run_uuid):
         raise Http404('Page not found.')
 
 
-def find_files(base_filename):
+def webcam_upload_chunk(request, run_uuid, filename):
+    """
+    Receives a video/audio chunk during the experiment as the raw body of a PUT request,
+    which is streamed to the recording without being parsed or spooled to a temporary file.
+    """
+    if request.method != 'PUT':
+        logger.error('Failed to upload webcam chunk.')
+        raise Http404('Page not found.')
+    subject_data = get_object_or_404(SubjectData, pk=run_uuid)
+
+    try:
+        length = int(request.META.get('CONTENT_LENGTH'))
+    except (TypeError, ValueError):
+        return HttpResponse('Content-Length required.', status=411)
+
+    try:
+        check_chunk_name(subject_data, filename)
+        ChunkStore().save_chunk(subject_data, filename, iter(lambda: request.read(CHUNK_READ_SIZE), b''), length)
+    except ValueError as e:
+        logger.exception('Failed to save webcam chunk: ' + str(e))
+        raise Http404('Invalid filename.')
+    except RecordingFinished as e:
+        logger.warning('Refused webcam chunk %s: %s' % (filename, e))
+        return HttpResponse(status=409)
+    except IncompleteChunk as e:
+        logger.error('Incomplete upload of %s: %s' % (filename, e))
+        return HttpResponse(status=400)
+    logger.info('Received upload request of %s.' % filename)
+    return HttpResponse(status=204)
+
+
+def webcam_upload_manifest(request, run_uuid):
+    """
+    Returns the manifest of a recording: the numbers of the chunks received so far and whether it has been finished.
+    """
+    subject_data = get_object_or_404(SubjectData, pk=run_uuid)
+    try:
+        check_recording_name(subject_data, request.GET.get('filename'))
+        manifest = ChunkStore().get_manifest(subject_data, request.GET.get('filename'))
+    except ValueError as e:
+        logger.exception('Failed to read manifest of webcam recording: ' + str(e))
+        raise Http404('Invalid filename.')
+    return JsonResponse(manifest)
+
+
+def has_experiment_access(user, experiment):
+    """
+    Returns whether a user has access to the results of an experiment.
+    """
+    if user.is_superuser or experiment.user_id == user.pk or experiment.sharing_option == 'PUB':
+        return True
+    return experiment.sharing_option == 'GRP' and \
+        experiment.sharing_groups.filter(pk__in=user.groups.values_list('pk', flat=True)).exists()
+
+
+def get_webcam_experiment(path):
+    """
+    Returns the experiment of a webcam file, given its name relative to WEBCAM_ROOT.
+    """
+    parts = path.split('/')
+    if len(parts) == 3:
+        # <experiment>/<participant>/<recording>.webm
+        try:
+            experiment_id = uuid.UUID(parts[0])
+        except ValueError:
+            return None
+        subject = SubjectData.objects.filter(pk=parts[1], experiment=experiment_id).select_related('experiment').first()
+        return subject.experiment if subject else None
+    # Recordings merged before they were sharded into folders per experiment and participant
+    result = TrialResult.objects.filter(webcam_file=path).select_related('subject__experiment').defer(*TrialResult.GAZE_FIELDS).first()
+    return result.subject.experiment if result else None
+
+
+def parse_range(header, size):
     """
-    Retrieves uploaded chunks for merging. 
+    Returns the first and last byte of a single byte range requested by a Range header,
+    None if the whole file should be sent, or raises ValueError if the range cannot be satisfied.
     """
-    result = []
-    for fname in os.listdir(settings.WEBCAM_ROOT):
-        if fname.startswith(base_filename + '-'):
-            result.append(fname)
+    match = RANGE_HEADER.match(header.replace(' ', '')) if header else None
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        first = int(first)
+        last = min(int(last), size - 1) if last else size - 1
+    else:
+        # Suffix range: the last bytes of the file
+        first = max(size - int(last), 0)
+        last = size - 1
+    if first > last or first >= size:
+        raise ValueError('Range %s cannot be satisfied.' % header)
+    return first, last
 
-    # Sort alphabetically
-    result.sort()
 
-    return result
+def read_range(path, first, last):
+    """
+    Yields the bytes of a file from `first` to `last`.
+    """
+    with open(path, 'rb') as f:
+        f.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            data = f.read(min(FILE_BLOCK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
 
-def merge_files(target, files):
+@login_required
+def webcam_file(request, path):
     """
-    Merges chunks into a file.
+    Sends a webcam/audio file to a user with access to the results of its experiment.
+    If WEBCAM_ACCEL_REDIRECT_URL is set, the file is sent by nginx from that internal location,
+    otherwise it is sent by Django, supporting Range requests so that videos can be seeked.
     """
-    fs = FileSystemStorage(location=settings.WEBCAM_ROOT)
+    experiment = get_webcam_experiment(path)
+    if not experiment or not has_experiment_access(request.user, experiment):
+        raise Http404('File not found.')
 
-    destination_file = os.path.join(
-        settings.WEBCAM_ROOT, target)
+    full_path = os.path.join(settings.WEBCAM_ROOT, *path.split('/'))
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    if settings.WEBCAM_ACCEL_REDIRECT_URL:
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.WEBCAM_ACCEL_REDIRECT_URL + quote(path)
+        return response
 
-    # Delete any existing file
-    if fs.exists(target):
-        fs.delete(target)
+    if not os.path.isfile(full_path):
+        raise Http404('File not found.')
+    stat = os.stat(full_path)
+    try:
+        byte_range = parse_range(request.META.get('HTTP_RANGE'), stat.st_size)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % stat.st_size
+        return response
 
-    # Merge
-    with open(destination_file, 'wb') as outfile:
-        for fname in files:
-            with open(os.path.join(settings.WEBCAM_ROOT, fname), 'rb') as infile:
-                while True:
-                    data = infile.read(65536)
-                    if not data:
-                        break
-                    outfile.write(data)
+    first, last = byte_range or (0, stat.st_size - 1)
+    response = StreamingHttpResponse(read_range(full_path, first, last), content_type=content_type,
+                                     status=206 if byte_range else 200)
+    if byte_range:
+        response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, stat.st_size)
+    response['Content-Length'] = str(last - first + 1)
+    response['Accept-Ranges'] = 'bytes'
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    return response
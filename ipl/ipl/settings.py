@@ -84,6 +84,9 @@ TEMPLATES = [
     },
 ]
 
+# Number of compiled page templates of experiments cached by each process
+TEMPLATE_CACHE_SIZE = config('TEMPLATE_CACHE_SIZE', default=256, cast=int)
+
 WSGI_APPLICATION = 'ipl.wsgi.application'
 
 # Logging
@@ -223,9 +226,19 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 WEBCAM_URL = '/webcam/'
 WEBCAM_ROOT = os.path.join(BASE_DIR, 'webcam')
+# Internal nginx location of WEBCAM_ROOT, e.g. /protected-webcam/, to which Django hands webcam files
+# after checking access (leave empty to let Django send them)
+WEBCAM_ACCEL_REDIRECT_URL = config('WEBCAM_ACCEL_REDIRECT_URL', default='')
 
 WEBCAM_TEST_URL = '/webcam-test/'
 WEBCAM_TEST_ROOT = os.path.join(WEBCAM_ROOT, 'test')
 
 REPORTS_URL = '/reports/'
 REPORTS_ROOT = os.path.join(BASE_DIR, 'reports')
+REPORTS_CACHE_ROOT = os.path.join(BASE_DIR, 'cache', 'reports')
+
+# Number of processes rendering the workbooks of a report in parallel (1 renders them in the report process)
+REPORT_WORKERS = config('REPORT_WORKERS', default=1, cast=int)
+
+# Fixed rate (in Hz) to which gaze is resampled when summarising the gaze of a trial on its areas of interest
+GAZE_SAMPLING_RATE = config('GAZE_SAMPLING_RATE', default=30, cast=int)
@@ -15,12 +15,13 @@ Including another URLconf
 """
 from django.conf.urls import include, re_path
 from django.contrib import admin
-from django.contrib.auth.decorators import login_required
-from django.views.static import serve
 from django.conf import settings
 from django.conf.urls.static import static
 from filebrowser.sites import site
 from django.urls import path
+from experiments import webcam
+
+import re
 
 admin.autodiscover()
 
@@ -42,10 +43,8 @@ urlpatterns += static(settings.WEBCAM_TEST_URL, document_root=settings.WEBCAM_TE
 # Reports
 urlpatterns += static(settings.REPORTS_URL, document_root=settings.REPORTS_ROOT)
 
-# Webcam uploads
-@login_required
-def protected_serve(request, path, document_root=None, show_indexes=False):
-    return serve(request, path, document_root, show_indexes)
-
-urlpatterns += static(settings.WEBCAM_URL, protected_serve, document_root=settings.WEBCAM_ROOT)
+# Webcam uploads, only sent to users with access to their experiment
+urlpatterns += [
+    re_path(r'^%s(?P<path>.+)$' % re.escape(settings.WEBCAM_URL.lstrip('/')), webcam.webcam_file, name='webcamFile'),
+]
 urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file